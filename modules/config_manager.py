@@ -1,17 +1,66 @@
-from typing import Dict, Any, Optional
+import os
+import time
+import threading
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Dict, Any, Optional, Mapping, Iterable
 from modules.database import DatabaseConnection
 from modules.sensor_registry import SensorRegistry
+from modules.device_manager import ThresholdEngine
+
+
+def _freeze(value: Any) -> Any:
+    """Copia de solo lectura (dicts anidados -> MappingProxyType)."""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    return value
+
+
+@dataclass(frozen=True)
+class ThresholdPlan:
+    """
+    Umbrales resueltos y compilados UNA vez por versión de configuración:
+    globales (DB o defaults del SensorRegistry), específicos por dispositivo ('thresholds' +
+    'umbrales' ya normalizados) y el ThresholdEngine listo para clasificar.
+    Inmutable: se comparte entre sesiones y con el hilo del snapshot.
+    """
+    version: int
+    built_at: float
+    global_thresholds: Mapping[str, Mapping[str, Any]]
+    device_thresholds: Mapping[str, Mapping[str, Mapping[str, Any]]]
+    engine: ThresholdEngine
+
+    def for_device(self, device_id: str, sensor_name: str) -> Mapping[str, Any]:
+        """Config efectiva de un sensor: específica del dispositivo > global."""
+        specific = self.device_thresholds.get(device_id, {})
+        return specific.get(sensor_name, self.global_thresholds.get(sensor_name, {}))
 
 
 class ConfigManager:
     
     CONFIG_ID = "sensor_thresholds"
     
+    # Un cambio hecho por OTRO proceso se ve a lo más tras este tiempo
+    PLAN_MAX_AGE_SECONDS = 60
+    
+    # Versión de configuración del proceso: cada escritura de umbrales la incrementa
+    _config_version = 0
+    _plan: Optional[ThresholdPlan] = None
+    _plan_lock = threading.Lock()
+    
+    # Cache de la colección 'devices' (todas las fuentes), compartido por el proceso.
+    # Las escrituras de esta app lo actualizan al instante (write-through); el TTL
+    # solo acota cuánto tarda en verse un cambio hecho desde fuera.
+    DEVICES_TTL_SECONDS = float(os.getenv("DEVICES_CACHE_TTL_SECONDS", 30))
+    _devices_cache: Optional[Dict[str, Dict[str, Any]]] = None  # device_id -> doc normalizado
+    _devices_loaded_at = 0.0
+    _devices_meta: Optional[Dict[str, Dict[str, Any]]] = None  # Derivado: get_device_metadata
+    _devices_version = 0  # Cambia con cada recarga o escritura (índices derivados, p.ej. búsqueda)
+    _devices_lock = threading.Lock()
+    
     def __init__(self, db: DatabaseConnection):
         self.db = db
         self._cached_config = None
-        # Cache para metadatos de dispositivos para evitar queries constantes en bucles
-        self._cached_devices_meta = None
     
     def get_sensor_config(self, force_refresh: bool = False) -> Dict[str, Any]:
         """Obtiene la configuración GLOBAL de sensores (defaults)."""
@@ -46,6 +95,43 @@ class ConfigManager:
         }
         return initial_config
     
+    # --- PLAN DE UMBRALES COMPILADO ---
+    @classmethod
+    def config_version(cls) -> int:
+        return cls._config_version
+
+    @classmethod
+    def invalidate_threshold_plan(cls):
+        """Marca el plan como obsoleto (se recompila en el próximo get_threshold_plan)."""
+        with cls._plan_lock:
+            cls._config_version += 1
+
+    def get_threshold_plan(self) -> ThresholdPlan:
+        """Plan compilado vigente; solo se reconstruye si cambió la versión o expiró."""
+        cls = ConfigManager
+        with cls._plan_lock:
+            plan = cls._plan
+            if plan is not None and plan.version == cls._config_version \
+                    and time.time() - plan.built_at < self.PLAN_MAX_AGE_SECONDS:
+                return plan
+            version = cls._config_version
+
+        # Construir fuera del lock (consulta a Mongo)
+        global_thresholds = self.get_sensor_config(force_refresh=True).get("sensors", {})
+        device_thresholds = {k: v.get("thresholds", {}) for k, v in self.get_device_metadata().items()}
+        plan = ThresholdPlan(
+            version=version,
+            built_at=time.time(),
+            global_thresholds=_freeze(global_thresholds),
+            device_thresholds=_freeze(device_thresholds),
+            engine=ThresholdEngine(global_thresholds, device_thresholds),
+        )
+        with cls._plan_lock:
+            # Si hubo una escritura mientras se construía, este plan ya nace obsoleto
+            if version == cls._config_version:
+                cls._plan = plan
+        return plan
+
     def get_threshold_for_sensor(self, sensor_name: str) -> Optional[Dict[str, Any]]:
         config = self.get_sensor_config()
         sensors = config.get("sensors", {})
@@ -69,6 +155,7 @@ class ConfigManager:
         
         if success:
             self._cached_config = None
+            self.invalidate_threshold_plan()
         
         return success
     
@@ -88,6 +175,7 @@ class ConfigManager:
         
         if success:
             self._cached_config = None
+            self.invalidate_threshold_plan()
         
         return success
     
@@ -103,12 +191,17 @@ class ConfigManager:
         
         if success:
             self._cached_config = None
+            self.invalidate_threshold_plan()
         
         return success
     
     def reset_to_defaults(self, detected_sensors: set) -> bool:
         # Esto borrara la config personalizada en DB
-        return self.db.delete_config(self.CONFIG_ID)
+        success = self.db.delete_config(self.CONFIG_ID)
+        if success:
+            self._cached_config = None
+            self.invalidate_threshold_plan()
+        return success
     
     def sync_with_detected_sensors(self, detected_sensors: set) -> bool:
         # Solo sincronizamos si YA existe una config en DB que queramos mantener al día.
@@ -118,12 +211,17 @@ class ConfigManager:
         if config.get("_is_default"):
             return True # No hacer nada si estamos en modo default
             
+        known = set(config.get("sensors", {}))
+        if not set(detected_sensors) - known:
+            return True # Nada nuevo: no reescribir (ni invalidar el plan) en cada refresco
+        
         updated_config = SensorRegistry.merge_configs(config, detected_sensors)
         
         success = self.db.save_config(self.CONFIG_ID, updated_config)
         
         if success:
             self._cached_config = None
+            self.invalidate_threshold_plan()
         
         return success
     
@@ -133,14 +231,63 @@ class ConfigManager:
     
     # --- MÉTODOS DE METADATOS Y DISPOSITIVOS (NUEVO ESQUEMA) ---
 
+    def _registered_devices(self, force_refresh: bool = False) -> Dict[str, Dict[str, Any]]:
+        """Docs normalizados de 'devices' desde el cache (una consulta por fuente al vencer el TTL)."""
+        cls = ConfigManager
+        with cls._devices_lock:
+            if not force_refresh and cls._devices_cache is not None \
+                    and time.time() - cls._devices_loaded_at < self.DEVICES_TTL_SECONDS:
+                return cls._devices_cache
+
+        docs = {d["_id"]: d for d in self.db.get_all_registered_devices()}
+        with cls._devices_lock:
+            cls._devices_cache = docs
+            cls._devices_loaded_at = time.time()
+            cls._devices_meta = None
+            cls._devices_version += 1
+        return docs
+
+    @classmethod
+    def devices_version(cls) -> int:
+        return cls._devices_version
+
+    @classmethod
+    def invalidate_device_cache(cls):
+        """Fuerza la relectura de 'devices' en el próximo acceso."""
+        with cls._devices_lock:
+            cls._devices_cache = None
+            cls._devices_meta = None
+            cls._devices_version += 1
+
+    def _write_through(self, device_id: str, update_data: Dict[str, Any]):
+        """Aplica al cache un $set ya confirmado en Mongo (soporta 'umbrales.<sensor>')."""
+        cls = ConfigManager
+        with cls._devices_lock:
+            if cls._devices_cache is None: return
+            doc = dict(cls._devices_cache.get(device_id) or {"_id": device_id, "alias": device_id, "location": "Desconocido", "umbrales": {}})
+            for key, value in update_data.items():
+                if key.startswith("umbrales."):
+                    doc["umbrales"] = {**(doc.get("umbrales") or {}), key.split(".", 1)[1]: value}
+                else:
+                    doc[key] = value
+            # Copia nueva del dict: quien ya leyó el cache no ve cambios a mitad de iteración
+            cls._devices_cache = {**cls._devices_cache, device_id: doc}
+            cls._devices_meta = None
+            cls._devices_version += 1
+
     def get_device_metadata(self) -> Dict[str, Dict[str, Any]]:
         """
-        Recupera metadatos de la colección 'devices'.
+        Recupera metadatos de la colección 'devices' (cacheados, ver DEVICES_TTL_SECONDS).
         Retorna un dict: {device_id: {alias: ..., location: ..., thresholds: ...}}
         """
-        raw_devices = self.db.get_all_registered_devices()
+        docs = self._registered_devices()
+        cls = ConfigManager
+        with cls._devices_lock:
+            if cls._devices_meta is not None and cls._devices_cache is docs:
+                return dict(cls._devices_meta)
+
         meta_map = {}
-        for d in raw_devices:
+        for d in docs.values():
             d_id = d.get("_id")
             if d_id:
                 # Normalizar umbrales: Fusionar 'thresholds' (legacy) y 'umbrales' (UI actual)
@@ -160,7 +307,11 @@ class ConfigManager:
                     "location": d.get("location", ""),
                     "thresholds": norm_thresholds
                 }
-        return meta_map
+        
+        with cls._devices_lock:
+            if cls._devices_cache is docs:
+                cls._devices_meta = meta_map
+        return dict(meta_map)
 
     def _normalize_thresholds(self, raw: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
         """Convierte formato plano (ph_min) a anidado ({ph: {min: ...}}) si es necesario."""
@@ -202,21 +353,33 @@ class ConfigManager:
             "alias": alias,
             "location": location
         }
-        return self.db.update_device_doc(device_id, update_data)
+        success = self.db.update_device_doc(device_id, update_data)
+        if success:
+            self._write_through(device_id, update_data)
+        return success
 
     def get_device_info(self, device_id: str) -> Dict[str, str]:
-        """Obtiene la info enriquecida de un dispositivo."""
-        doc = self.db.get_device_doc(device_id)
-        if doc:
-            return {
-                "alias": doc.get("alias", device_id),
-                "location": doc.get("location", "Desconocido")
-            }
-        return {"alias": device_id, "location": "Desconocido"}
+        """Obtiene la info enriquecida de un dispositivo (desde el cache de 'devices')."""
+        return self.get_device_infos([device_id])[device_id]
+
+    def get_device_infos(self, device_ids: Iterable[str]) -> Dict[str, Dict[str, str]]:
+        """Info enriquecida de varios dispositivos (p.ej. una página de tarjetas) sin consultas extra."""
+        docs = self._registered_devices()
+        infos = {}
+        for device_id in device_ids:
+            doc = docs.get(device_id)
+            if doc:
+                infos[device_id] = {
+                    "alias": doc.get("alias", device_id),
+                    "location": doc.get("location", "Desconocido")
+                }
+            else:
+                infos[device_id] = {"alias": device_id, "location": "Desconocido"}
+        return infos
         
     def get_device_thresholds(self, device_id: str) -> Dict[str, Any]:
         """Obtiene umbrales específicos de un dispositivo (campo 'umbrales')."""
-        doc = self.db.get_device_doc(device_id)
+        doc = self._registered_devices().get(device_id)
         if doc:
             return self._normalize_thresholds(doc.get("umbrales", {}))
         return {}
@@ -226,4 +389,8 @@ class ConfigManager:
         # Se requiere "dot notation" para actualizar un campo anidado en Mongo sin borrar el resto
         # Ej: "umbrales.temperatura" = {...}
         key = f"umbrales.{sensor_name}"
-        return self.db.update_device_doc(device_id, {key: threshold_data})
\ No newline at end of file
+        success = self.db.update_device_doc(device_id, {key: threshold_data})
+        if success:
+            self._write_through(device_id, {key: threshold_data})
+            self.invalidate_threshold_plan()
+        return success
\ No newline at end of file
@@ -1,14 +1,18 @@
 
 import os
 import time
+import numpy as np
 import pandas as pd
 import streamlit as st
 from pymongo import MongoClient
 from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError
+from bson.min_key import MinKey
 import certifi
 from dotenv import load_dotenv
-from typing import List, Dict, Any, Optional, Union
+from typing import List, Dict, Any, Optional, Union, Callable, Tuple
 from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, wait
+from itertools import chain
 
 # Cargar variables de entorno
 load_dotenv()
@@ -34,11 +38,33 @@ def get_mongo_client(uri: str) -> Optional[MongoClient]:
         st.error(f"Error conexión MongoDB ({uri[:20]}...): {str(e)}")
         return None
 
+# --- EJECUTOR COMPARTIDO (FAN-OUT POR FUENTE) ---
+# Un único pool acotado por proceso: todas las sesiones comparten los mismos hilos
+SOURCE_EXECUTOR_WORKERS = 8
+
+@st.cache_resource(show_spinner=False)
+def get_source_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=SOURCE_EXECUTOR_WORKERS, thread_name_prefix="db-source")
+
+# Cargas masivas SIN deadline (historial de semanas, respaldos, rollups, índices) en un pool aparte:
+# el deadline de fan_out corre desde que se encola la tarea, así que si compartieran hilos con las
+# lecturas del dashboard, estas vencerían esperando en la cola
+BULK_EXECUTOR_WORKERS = 4
+
+@st.cache_resource(show_spinner=False)
+def get_bulk_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=BULK_EXECUTOR_WORKERS, thread_name_prefix="db-bulk")
+
 class DatabaseConnection:
     CONFIG_COLLECTION = "system_config"
+    
+    # Deadline por fuente (segundos). Una fuente lenta no bloquea a las demás.
+    SOURCE_TIMEOUT_SECONDS = 15
 
     def __init__(self):
         self.sources = []
+        # Estado de la última consulta por fuente: {name: {"status": ok|error|timeout, "elapsed": s, "error": str}}
+        self.last_source_status: Dict[str, Dict[str, Any]] = {}
         
         # Cargar fuentes dinámicamente (1 y 2, y escalable a N si se quisiera)
         # Fuente 1
@@ -93,47 +119,14 @@ class DatabaseConnection:
             sensors = doc.get("datos", {})
             
         # 3. Normalizar Timestamp
-        raw_ts = doc.get("timestamp")
-        final_ts = None
-        
-        try:
-            if isinstance(raw_ts, dict) and "$date" in raw_ts:
-                raw_ts = raw_ts["$date"]
-                
-            if isinstance(raw_ts, (int, float)):
-                if raw_ts > 1e11: 
-                    final_ts = pd.to_datetime(raw_ts, unit='ms', utc=True).to_pydatetime()
-                else:
-                    final_ts = pd.to_datetime(raw_ts, unit='s', utc=True).to_pydatetime()
-            elif isinstance(raw_ts, str):
-                try:
-                    final_ts = datetime.fromisoformat(raw_ts)
-                except ValueError:
-                    final_ts = pd.to_datetime(raw_ts, errors='coerce', utc=True)
-                    if pd.isna(final_ts): final_ts = None
-                    else: final_ts = final_ts.to_pydatetime()
-            elif isinstance(raw_ts, datetime):
-                final_ts = raw_ts
-                if final_ts.tzinfo is None:
-                    final_ts = final_ts.replace(tzinfo=timezone.utc)
-        except Exception:
-            final_ts = None
-        
-        if final_ts is not None:
-             if final_ts.tzinfo is not None:
-                 chile_tz = timezone(timedelta(hours=-3))
-                 final_ts = final_ts.astimezone(chile_tz)
-                 final_ts = final_ts.replace(tzinfo=None)
+        final_ts = self._parse_timestamp(doc.get("timestamp"))
         
         oid = str(doc.get("_id", ""))
         
         # 4. Normalizar Sensores (Flattening)
         normalized_sensors = {}
         for key, value in sensors.items():
-            norm_key = key.lower().strip()
-            
-            if norm_key in ["temp", "temperatura"]: norm_key = "temperature"
-            elif norm_key in ["oxigeno", "od", "do"]: norm_key = "oxygen"
+            norm_key = self._normalize_sensor_key(key)
             
             final_value = None
             if isinstance(value, dict):
@@ -161,6 +154,48 @@ class DatabaseConnection:
             "_source_id": oid 
         }
 
+    @staticmethod
+    def _parse_timestamp(raw_ts: Any) -> Optional[datetime]:
+        """Timestamp crudo (Date / ISO / epoch s o ms / {"$date": ...}) -> datetime naive en hora de Chile."""
+        final_ts = None
+        
+        try:
+            if isinstance(raw_ts, dict) and "$date" in raw_ts:
+                raw_ts = raw_ts["$date"]
+                
+            if isinstance(raw_ts, (int, float)):
+                if raw_ts > 1e11: 
+                    final_ts = pd.to_datetime(raw_ts, unit='ms', utc=True).to_pydatetime()
+                else:
+                    final_ts = pd.to_datetime(raw_ts, unit='s', utc=True).to_pydatetime()
+            elif isinstance(raw_ts, str):
+                try:
+                    final_ts = datetime.fromisoformat(raw_ts)
+                except ValueError:
+                    final_ts = pd.to_datetime(raw_ts, errors='coerce', utc=True)
+                    if pd.isna(final_ts): final_ts = None
+                    else: final_ts = final_ts.to_pydatetime()
+            elif isinstance(raw_ts, datetime):
+                final_ts = raw_ts
+                if final_ts.tzinfo is None:
+                    final_ts = final_ts.replace(tzinfo=timezone.utc)
+        except Exception:
+            final_ts = None
+        
+        if final_ts is not None:
+             if final_ts.tzinfo is not None:
+                 chile_tz = timezone(timedelta(hours=-3))
+                 final_ts = final_ts.astimezone(chile_tz)
+                 final_ts = final_ts.replace(tzinfo=None)
+        return final_ts
+
+    @staticmethod
+    def _normalize_sensor_key(key: str) -> str:
+        norm_key = key.lower().strip()
+        if norm_key in ["temp", "temperatura"]: norm_key = "temperature"
+        elif norm_key in ["oxigeno", "od", "do"]: norm_key = "oxygen"
+        return norm_key
+
     def _normalize_device_doc(self, raw_doc: Dict[str, Any]) -> Dict[str, Any]:
         """ADAPTER: Normaliza metadatos de DISPOSITIVOS de diferentes esquemas (Propio vs Partner)."""
         if not raw_doc: return {}
@@ -196,13 +231,182 @@ class DatabaseConnection:
             "original_source": raw_doc # Guardar original por si acaso
         }
 
+    # --- FAN-OUT CONCURRENTE ---
+    def fan_out(self, task: Callable[[Dict[str, Any]], Any], sources: Optional[List[Dict[str, Any]]] = None,
+                timeout: Optional[float] = -1) -> List[Tuple[Dict[str, Any], Any]]:
+        """
+        Ejecuta task(source) sobre todas las fuentes en PARALELO usando el pool compartido.
+        - timeout: deadline en segundos (-1 = SOURCE_TIMEOUT_SECONDS, None = sin límite).
+          Sin límite se usa el pool de cargas masivas, que no compite con las lecturas con deadline.
+        - Retorna [(source, resultado)] solo de las fuentes OK, en el orden de self.sources,
+          para que la prioridad entre fuentes (Primary > Secondary) se mantenga.
+        - El detalle por fuente queda en self.last_source_status.
+        Las tareas NO deben llamar a st.* (corren fuera del hilo de Streamlit).
+        """
+        if sources is None: sources = self.sources
+        if timeout == -1: timeout = self.SOURCE_TIMEOUT_SECONDS
+        if not sources: return []
+        
+        def timed_task(source):
+            t0 = time.time()
+            try:
+                return task(source), None, time.time() - t0
+            except Exception as e:
+                return None, e, time.time() - t0
+        
+        executor = get_bulk_executor() if timeout is None else get_source_executor()
+        futures = [(source, executor.submit(timed_task, source)) for source in sources]
+        wait([f for _, f in futures], timeout=timeout)
+        
+        results = []
+        for source, future in futures:
+            if not future.done():
+                future.cancel()
+                self.last_source_status[source["name"]] = {"status": "timeout", "elapsed": timeout, "error": f"Deadline {timeout}s excedido"}
+                print(f"Timeout consultando {source['name']} ({timeout}s)")
+                continue
+            
+            result, error, elapsed = future.result()
+            if error is not None:
+                self.last_source_status[source["name"]] = {"status": "error", "elapsed": round(elapsed, 3), "error": str(error)}
+                print(f"Error consultando {source['name']}: {str(error)[:100]}")
+            else:
+                self.last_source_status[source["name"]] = {"status": "ok", "elapsed": round(elapsed, 3), "error": None}
+                results.append((source, result))
+        return results
+
+    def _telemetry_sources(self) -> List[Dict[str, Any]]:
+        return [s for s in self.sources if s["coll_telemetry"]]
+
+    def _device_sources(self) -> List[Dict[str, Any]]:
+        return [s for s in self.sources if s["coll_devices"]]
+
+    # --- LECTURA MASIVA DE TELEMETRÍA ---
+    # Solo los campos que usa _normalize_document: alerts y el resto de metadata no viajan ni se decodifican
+    TELEMETRY_PROJECTION = {
+        '_id': 1, 'timestamp': 1, 'device_id': 1, 'dispositivo_id': 1, 'metadata.device_id': 1,
+        'sensors': 1, 'datos': 1, 'location': 1, 'ubicacion': 1
+    }
+
+    # Última lectura de UN dispositivo: además las alertas explícitas (DeviceManager las evalúa como CRITICAL)
+    LATEST_PROJECTION = {**TELEMETRY_PROJECTION, 'alerts': 1}
+
+    @classmethod
+    def sensor_projection(cls, sensor_keys: List[str]) -> Dict[str, int]:
+        """Proyección con solo las claves crudas de sensores indicadas (en sensors.* y datos.*)."""
+        projection = {'_id': 1, 'timestamp': 1, 'device_id': 1, 'dispositivo_id': 1, 'metadata.device_id': 1}
+        for key in sensor_keys:
+            projection[f"sensors.{key}"] = 1
+            projection[f"datos.{key}"] = 1
+        return projection
+
+    # Documentos por batch del cursor (menos round-trips en cargas de semanas / respaldos completos)
+    TELEMETRY_BATCH_SIZE = 5000
+
+    def _telemetry_cursor(self, source: Dict[str, Any], query: Dict[str, Any], sort: bool = True, limit: int = 0,
+                          projection: Optional[Dict[str, int]] = None):
+        """Cursor proyectado sobre la telemetría de una fuente (timestamp descendente si sort=True)."""
+        collection = source["client"][source["db"]][source["coll_telemetry"]]
+        cursor = collection.find(query, projection or self.TELEMETRY_PROJECTION).batch_size(self.TELEMETRY_BATCH_SIZE)
+        if sort: cursor = cursor.sort("timestamp", -1)
+        if limit: cursor = cursor.limit(limit)
+        return cursor
+
+    # --- AGREGACIONES SERVER-SIDE ---
+    # Clave de dispositivo equivalente a la de _normalize_document (device_id > dispositivo_id > metadata.device_id)
+    DEVICE_KEY_EXPR = {"$ifNull": ["$device_id", {"$ifNull": ["$dispositivo_id", "$metadata.device_id"]}]}
+
+    # Campos de dispositivo con índice {campo: 1, timestamp: -1}, en la prioridad de _normalize_document
+    DEVICE_KEY_FIELDS = ("device_id", "dispositivo_id")
+
+    # Ventana de los "último por dispositivo" sin índice que los respalde (p.ej. solo metadata.device_id)
+    LIVE_UNINDEXED_WINDOW = timedelta(days=7)
+
+    # Limite del scan legacy (modo sin agregacion)
+    LIVE_SCAN_LIMIT = 2000
+
+    def _latest_docs_pipeline(self, key_field: str, match: Optional[Dict[str, Any]] = None,
+                              indexed: bool = True) -> List[Dict[str, Any]]:
+        """
+        Pipeline que devuelve exactamente UN documento (el más reciente) por valor de key_field.
+        indexed=True: $sort {key_field: 1, timestamp: -1} + $group por el campo; con el índice
+        del mismo prefijo Mongo lo resuelve con DISTINCT_SCAN (una entrada de índice por
+        dispositivo). Los documentos sin el campo caen en un grupo null que se descarta al leer.
+        indexed=False: sort solo por timestamp; el $match debe acotar los documentos.
+        """
+        sort = {key_field: 1, "timestamp": -1} if indexed else {"timestamp": -1}
+        return ([{"$match": match}] if match else []) + [
+            {"$sort": sort},
+            {"$group": {"_id": f"${key_field}", "doc": {"$first": "$$ROOT"}}},
+            {"$replaceRoot": {"newRoot": "$doc"}}
+        ]
+
+    def _recent_window(self) -> Dict[str, Any]:
+        """Filtro de documentos dentro de LIVE_UNINDEXED_WINDOW (timestamps Date o ISO)."""
+        since = datetime.now(timezone.utc) - self.LIVE_UNINDEXED_WINDOW
+        return {"$or": [{"timestamp": {"$gte": since}}, {"timestamp": {"$gte": since.isoformat()}}]}
+
+    def _indexed_key_fields(self, collection) -> set:
+        """Campos de DEVICE_KEY_FIELDS con un índice {campo, timestamp} apto para el $sort de _latest_docs_pipeline."""
+        fields = set()
+        for info in collection.index_information().values():
+            key = info["key"]
+            if len(key) < 2 or key[0][0] not in self.DEVICE_KEY_FIELDS or key[1][0] != "timestamp": continue
+            directions = (key[0][1], key[1][1])
+            # {campo: 1, timestamp: -1} o su inverso
+            if all(isinstance(d, (int, float)) for d in directions) and directions[0] * directions[1] < 0:
+                fields.add(key[0][0])
+        return fields
+
+    def _latest_docs(self, collection, match_by_field: Optional[Callable[[str], Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+        """
+        Último documento por dispositivo de una colección: una agregación por campo de dispositivo.
+        - Campos indexados: DISTINCT_SCAN (sin $match, o el de match_by_field).
+        - Campos sin índice: acotados a LIVE_UNINDEXED_WINDOW salvo que match_by_field ya filtre.
+        - Sin match_by_field, también los documentos que solo traen metadata.device_id (acotados).
+        Los resultados van en orden de prioridad de campo; quien normaliza se queda con el primero.
+        """
+        indexed = self._indexed_key_fields(collection)
+        docs = []
+        for field in self.DEVICE_KEY_FIELDS:
+            if match_by_field:
+                match = match_by_field(field)
+            elif field in indexed:
+                match = None
+            else:
+                match = {field: {"$ne": None}, **self._recent_window()}
+            pipeline = self._latest_docs_pipeline(field, match, indexed=field in indexed)
+            docs.extend(d for d in collection.aggregate(pipeline, allowDiskUse=True) if d.get(field) is not None)
+        
+        if not match_by_field:
+            match = {"device_id": None, "dispositivo_id": None, "metadata.device_id": {"$ne": None}, **self._recent_window()}
+            docs.extend(collection.aggregate(self._latest_docs_pipeline("metadata.device_id", match, indexed=False), allowDiskUse=True))
+        return docs
+
+    def _fetch_live_docs(self, collection, use_aggregation: bool = True) -> List[Dict[str, Any]]:
+        """
+        Obtiene los documentos 'live' de una coleccion de telemetria.
+        Modo agregacion: un doc por dispositivo (costo proporcional a N dispositivos).
+        Fallback: scan de los ultimos LIVE_SCAN_LIMIT docs (comportamiento anterior).
+        """
+        if use_aggregation:
+            try:
+                return self._latest_docs(collection)
+            except Exception as agg_error:
+                print(f"Aggregation 'latest per device' falló, usando scan: {str(agg_error)[:100]}")
+        
+        # Limitamos a LIVE_SCAN_LIMIT para tener más chance de encontrar dispositivos "lentos"
+        cursor = collection.find({}).sort("timestamp", -1).limit(self.LIVE_SCAN_LIMIT)
+        return list(cursor)
+
     # --- MÉTODO PARA DASHBOARD (Multi-DB Telemetría + Registro + Historical Fallback) ---
-    def get_latest_by_device(self, retries: int = 2) -> pd.DataFrame:
+    def get_latest_by_device(self, retries: int = 2, use_aggregation: bool = True) -> pd.DataFrame:
         """
         Obtiene el estado más reciente de TODOS los dispositivos.
         Estrategia 'Registry-Historical': 
         1. Obtiene la lista maestra de dispositivos registrados (Metadata).
-        2. Obtiene la telemetría reciente (Live).
+        2. Obtiene la telemetría reciente (Live). Con use_aggregation=True se usa
+           $sort/$group en el servidor para traer solo el último doc por dispositivo.
         3. Para los faltantes, busca su ÚLTIMO dato histórico.
         """
         if not self.sources: return pd.DataFrame()
@@ -214,137 +418,189 @@ class DatabaseConnection:
         all_docs = []
         seen_devices = set()
         
-        # 2. Obtener Telemetría Reciente (Live Data)
-        for source in self.sources:
-            if not source["coll_telemetry"]: continue
-            try:
-                db = source["client"][source["db"]]
-                collection = db[source["coll_telemetry"]]
-                
-                # Limitamos a 2000 para tener más chance de encontrar dispositivos "lentos"
-                cursor = collection.find({}).sort("timestamp", -1).limit(2000)
-                documents = list(cursor)
+        # 2. Obtener Telemetría Reciente (Live Data) - todas las fuentes en paralelo
+        def load_live(source):
+            collection = source["client"][source["db"]][source["coll_telemetry"]]
+            return self._fetch_live_docs(collection, use_aggregation)
+        
+        for source, documents in self.fan_out(load_live, self._telemetry_sources()):
+            for raw_doc in documents:
+                norm_doc = self._normalize_document(raw_doc)
+                dev_id = norm_doc["device_id"]
                 
-                for raw_doc in documents:
-                    norm_doc = self._normalize_document(raw_doc)
-                    dev_id = norm_doc["device_id"]
-                    
-                    if dev_id and dev_id != "unknown" and dev_id not in seen_devices:
-                        # Si tenemos metadata registrada para este ID, enriquecemos la location
-                        if dev_id in known_map:
-                            meta = known_map[dev_id]
-                            reg_loc = meta.get("location")
-                            reg_alias = meta.get("alias")
-                            if reg_loc: norm_doc["location"] = reg_loc
-                            if reg_alias: norm_doc["external_alias"] = reg_alias
-
-                        seen_devices.add(dev_id)
-                        all_docs.append(norm_doc)
-                        
-            except Exception as e:
-                print(f"Error fetching telemetry from {source['name']}: {str(e)}")
-                continue
+                if dev_id and dev_id != "unknown" and dev_id not in seen_devices:
+                    # Si tenemos metadata registrada para este ID, enriquecemos la location
+                    if dev_id in known_map:
+                        meta = known_map[dev_id]
+                        reg_loc = meta.get("location")
+                        reg_alias = meta.get("alias")
+                        if reg_loc: norm_doc["location"] = reg_loc
+                        if reg_alias: norm_doc["external_alias"] = reg_alias
 
-        # 3. Recuperar Dispositivos Faltantes (Historical Fetch)
-        for dev_id, meta in known_map.items():
-            if dev_id not in seen_devices:
-                # Buscar el último dato real en la historia
-                last_known_df = self.get_latest_for_single_device(dev_id)
-                reg_alias = meta.get("alias")
+                    seen_devices.add(dev_id)
+                    all_docs.append(norm_doc)
+
+        # 3. Recuperar Dispositivos Faltantes (Historical Fetch en lote, 1 round trip por fuente)
+        missing_ids = [dev_id for dev_id in known_map if dev_id not in seen_devices]
+        historical = self.get_latest_for_devices(missing_ids) if missing_ids else {}
+        
+        for dev_id in missing_ids:
+            meta = known_map[dev_id]
+            reg_alias = meta.get("alias")
+            last_known = historical.get(dev_id)
+            
+            if last_known:
+                # Usar el último estado conocido (ubicación de metadata tiene prioridad)
+                reg_loc = meta.get("location")
                 
-                if not last_known_df.empty:
-                    # Usar el último estado conocido
-                    rec = last_known_df.iloc[0].to_dict()
-                    
-                    # Asegurar ubicación de metadata si existe
-                    reg_loc = meta.get("location")
-                    if reg_loc: rec["location"] = reg_loc
-                    
-                    # Re-estructurar para all_docs
-                    doc_struct = {
-                        "device_id": rec["device_id"],
-                        "timestamp": rec["timestamp"],
-                        "location": rec["location"],
-                        "sensors": rec["sensor_data"], 
-                        "alerts": rec["alerts"], 
-                        "_source_id": "historical_fetch"
-                    }
-                    if reg_alias: doc_struct["external_alias"] = reg_alias
-                    all_docs.append(doc_struct)
-                else:
-                    # Solo falla a gris si NUNCA ha enviado datos
-                    doc_struct = {
-                        "device_id": dev_id,
-                        "timestamp": None,
-                        "location": meta.get("location", "Desconocido"),
-                        "sensors": {},
-                        "alerts": [],
-                        "_source_id": "registry_fallback"
-                    }
-                    if reg_alias: doc_struct["external_alias"] = reg_alias
-                    all_docs.append(doc_struct)
+                # Re-estructurar para all_docs
+                doc_struct = {
+                    "device_id": last_known["device_id"],
+                    "timestamp": last_known["timestamp"],
+                    "location": reg_loc or last_known["location"],
+                    "sensors": last_known["sensors"], 
+                    "alerts": last_known["alerts"], 
+                    "_source_id": "historical_fetch"
+                }
+                if reg_alias: doc_struct["external_alias"] = reg_alias
+                all_docs.append(doc_struct)
+            else:
+                # Solo falla a gris si NUNCA ha enviado datos
+                doc_struct = {
+                    "device_id": dev_id,
+                    "timestamp": None,
+                    "location": meta.get("location", "Desconocido"),
+                    "sensors": {},
+                    "alerts": [],
+                    "_source_id": "registry_fallback"
+                }
+                if reg_alias: doc_struct["external_alias"] = reg_alias
+                all_docs.append(doc_struct)
 
         return self._rows_to_dataframe_mixed(all_docs)
 
+    def get_latest_doc(self, device_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Último documento (normalizado) de UN dispositivo: un find_one proyectado por fuente
+        (índices device_id/dispositivo_id + timestamp), en paralelo; gana la primera fuente con datos.
+        """
+        if not self.sources: return None
+        
+        query = {"$or": [{"device_id": device_id}, {"dispositivo_id": device_id}]}
+        
+        def find_last(source):
+            collection = source["client"][source["db"]][source["coll_telemetry"]]
+            # Buscar solo el ultimo
+            return collection.find_one(query, self.LATEST_PROJECTION, sort=[("timestamp", -1)])
+        
+        for source, doc in self.fan_out(find_last, self._telemetry_sources()):
+            if doc:
+                return self._normalize_document(doc)
+        return None
+
     def get_latest_for_single_device(self, device_id: str) -> pd.DataFrame:
-        """Busca el dispositivo en todas las fuentes hasta encontrarlo."""
-        if not self.sources: return pd.DataFrame()
+        """Busca el dispositivo en todas las fuentes (en paralelo); gana la primera fuente con datos."""
+        norm_doc = self.get_latest_doc(device_id)
+        if norm_doc is None: return pd.DataFrame()
+        return self._rows_to_dataframe([norm_doc])
+
+    def get_latest_for_devices(self, device_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Versión en lote de get_latest_for_single_device.
+        Resuelve el último documento de VARIOS dispositivos con una agregación por fuente y campo
+        de dispositivo ($match con $in -> $sort -> $group con $first).
+        Retorna {device_id: doc_normalizado}. Igual que la versión individual,
+        la primera fuente (en orden) que tenga datos del dispositivo gana.
+        """
+        if not self.sources or not device_ids: return {}
         
-        for source in self.sources:
-            if not source["coll_telemetry"]: continue
-            try:
-                db = source["client"][source["db"]]
-                collection = db[source["coll_telemetry"]]
-                
-                query = {"$or": [{"device_id": device_id}, {"dispositivo_id": device_id}]}
-                
-                # Buscar solo el ultimo
-                doc = collection.find_one(query, sort=[("timestamp", -1)])
-                if doc:
-                    norm_doc = self._normalize_document(doc)
-                    return self._rows_to_dataframe([norm_doc])
-            except Exception:
-                continue
-        return pd.DataFrame()
+        ids = list(device_ids)
+        
+        def load_batch(source):
+            collection = source["client"][source["db"]][source["coll_telemetry"]]
+            return self._latest_docs(collection, lambda field: {field: {"$in": ids}})
+        
+        wanted = set(ids)
+        found = {}
+        for source, raw_docs in self.fan_out(load_batch, self._telemetry_sources()):
+            for raw_doc in raw_docs:
+                norm_doc = self._normalize_document(raw_doc)
+                dev_id = norm_doc["device_id"]
+                if dev_id in wanted and dev_id not in found:
+                    found[dev_id] = norm_doc
+        
+        return found
+
+    def probe_changes(self, watermarks: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[set]]:
+        """
+        Sonda barata de "qué cambió desde": por fuente, $match de documentos con _id mayor al
+        watermark + $group por dispositivo. Solo recorre el índice _id de los docs nuevos.
+        Se usa _id (y no timestamp) porque los timestamps mezclan Date / ISO / epoch entre fuentes.
+
+        watermarks: {fuente: último _id visto}. Una fuente sin watermark solo se inicializa.
+        Retorna (watermarks_nuevos, ids_cambiados); ids_cambiados es None si alguna fuente
+        se inicializó recién (no se sabe qué cambió: hacer una carga completa).
+        """
+        def probe(source):
+            collection = source["client"][source["db"]][source["coll_telemetry"]]
+            if source["name"] not in watermarks:
+                newest = collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+                # Colección vacía: MinKey hace que el primer documento cuente como cambio
+                return (newest["_id"] if newest else MinKey()), None
+            last_id = watermarks[source["name"]]
+            pipeline = [
+                {"$match": {"_id": {"$gt": last_id}}},
+                {"$group": {"_id": self.DEVICE_KEY_EXPR, "last_id": {"$max": "$_id"}}}
+            ]
+            rows = list(collection.aggregate(pipeline))
+            new_last = max((r["last_id"] for r in rows), default=last_id)
+            return new_last, {r["_id"] for r in rows if r["_id"] and r["_id"] != "unknown"}
+
+        new_watermarks = dict(watermarks)
+        changed = set()
+        for source, (last_id, ids) in self.fan_out(probe, self._telemetry_sources()):
+            new_watermarks[source["name"]] = last_id
+            if ids is None:
+                changed = None
+            elif changed is not None:
+                changed |= ids
+        # Fuentes caídas/lentas conservan su watermark: sus cambios se ven en el siguiente tick
+        return new_watermarks, changed
 
     # --- METODOS PARA HISTORIAL (Multi-DB) ---
     def fetch_data(self, start_date=None, end_date=None, device_ids=None, limit=5000) -> pd.DataFrame:
         if not self.sources: return pd.DataFrame()
         
-        all_norm_docs = []
+        all_raw_docs = []
         limit_per_source = limit // len(self.sources) + 100
         
-        for source in self.sources:
-            if not source["coll_telemetry"]: continue
+        mongo_query = {}
+        if device_ids:
+            mongo_query["$or"] = [{"device_id": {"$in": device_ids}}, {"dispositivo_id": {"$in": device_ids}}]
+        
+        def load_history(source):
             try:
-                db = source["client"][source["db"]]
-                collection = db[source["coll_telemetry"]]
-                
-                mongo_query = {}
-                if device_ids:
-                    mongo_query["$or"] = [{"device_id": {"$in": device_ids}}, {"dispositivo_id": {"$in": device_ids}}]
-                
-                raw_documents = []
-                try:
-                    cursor = collection.find(mongo_query).sort("timestamp", -1).limit(limit_per_source)
-                    raw_documents = list(cursor)
-                except Exception as sort_error:
-                    if "memory" in str(sort_error).lower() or "Sort" in str(sort_error):
-                        cursor = collection.find(mongo_query).limit(limit_per_source)
-                        raw_documents = list(cursor)
-                    else:
-                        raise sort_error
-                
-                for d in raw_documents:
-                    all_norm_docs.append(self._normalize_document(d))
-            except Exception as e:
-                st.warning(f"Error fetching history from {source['name']}: {str(e)[:100]}")
-                continue
+                return list(self._telemetry_cursor(source, mongo_query, limit=limit_per_source))
+            except Exception as sort_error:
+                if "memory" in str(sort_error).lower() or "Sort" in str(sort_error):
+                    return list(self._telemetry_cursor(source, mongo_query, sort=False, limit=limit_per_source))
+                raise sort_error
+        
+        tel_sources = self._telemetry_sources()
+        for source, raw_documents in self.fan_out(load_history, tel_sources):
+            all_raw_docs.extend(raw_documents)
         
-        if not all_norm_docs: return pd.DataFrame()
+        # Avisos en el hilo principal (st.* no es seguro dentro del pool)
+        for source in tel_sources:
+            status = self.last_source_status.get(source["name"], {})
+            if status.get("status") != "ok":
+                st.warning(f"Error fetching history from {source['name']}: {str(status.get('error'))[:100]}")
+        
+        if not all_raw_docs: return pd.DataFrame()
             
-        all_norm_docs.sort(key=lambda x: x["timestamp"] or datetime.min, reverse=True)
-        df = self._parse_historical_flat(all_norm_docs)
+        # Normalización por lotes + orden descendente (sin timestamp al final)
+        df = self._normalize_batch(all_raw_docs)
+        df = df.sort_values("timestamp", ascending=False, kind="stable", na_position="last").reset_index(drop=True)
         
         if not df.empty and (start_date or end_date):
             if df['timestamp'].dt.tz is not None:
@@ -364,37 +620,28 @@ class DatabaseConnection:
         """Recupera dispositivos de TODAS las fuentes configuradas."""
         all_devices = {} # Dict para de-duplicar por ID
         
-        for source in self.sources:
-            if not source["coll_devices"]: continue
-            try:
-                db = source["client"][source["db"]]
-                coll = db[source["coll_devices"]]
-                
-                raw_list = list(coll.find({}))
-                for raw in raw_list:
-                    norm = self._normalize_device_doc(raw)
-                    d_id = norm["_id"]
-                    if d_id and d_id not in all_devices:
-                        all_devices[d_id] = norm
-                        
-            except Exception as e:
-                print(f"Error fetching devices from {source['name']}: {e}")
+        def load_devices(source):
+            coll = source["client"][source["db"]][source["coll_devices"]]
+            return list(coll.find({}))
+        
+        for source, raw_list in self.fan_out(load_devices, self._device_sources()):
+            for raw in raw_list:
+                norm = self._normalize_device_doc(raw)
+                d_id = norm["_id"]
+                if d_id and d_id not in all_devices:
+                    all_devices[d_id] = norm
                 
         return list(all_devices.values())
 
     def get_device_doc(self, device_id: str) -> Optional[Dict[str, Any]]:
-        """Busca metadata de un dispositivo específico en todas las fuentes."""
-        for source in self.sources:
-            if not source["coll_devices"]: continue
-            try:
-                db = source["client"][source["db"]]
-                coll = db[source["coll_devices"]]
-                
-                doc = coll.find_one({"_id": device_id})
-                if doc:
-                    return self._normalize_device_doc(doc)
-            except Exception:
-                continue
+        """Busca metadata de un dispositivo específico en todas las fuentes (en paralelo)."""
+        def find_device(source):
+            coll = source["client"][source["db"]][source["coll_devices"]]
+            return coll.find_one({"_id": device_id})
+        
+        for source, doc in self.fan_out(find_device, self._device_sources()):
+            if doc:
+                return self._normalize_device_doc(doc)
         return None
 
     def update_device_doc(self, device_id: str, update_data: Dict[str, Any]) -> bool:
@@ -531,4 +778,163 @@ class DatabaseConnection:
         if "timestamp" in df.columns: df["timestamp"] = pd.to_datetime(df["timestamp"], errors='coerce')
         cols = df.columns.drop(['timestamp', 'device_id', 'location'], errors='ignore')
         for col in cols: df[col] = pd.to_numeric(df[col], errors='coerce')
-        return df
\ No newline at end of file
+        return df
+    # --- NORMALIZACIÓN POR LOTES (Vectorizada) ---
+    # Formas ISO que datetime.fromisoformat acepta en cualquier versión de Python (el resto va por el adapter escalar)
+    ISO_NAIVE_PATTERN = r"^\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d{3}(?:\d{3})?)?)?)?$"
+    ISO_AWARE_PATTERN = r"^\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d{3}(?:\d{3})?)?)?(?:Z|[+-]\d{2}:\d{2})$"
+
+    # Rango de epoch (s / ms) representable sin overflow en pandas
+    EPOCH_MIN, EPOCH_MAX = -9e9, 9e15
+
+    def _parse_timestamps_batch(self, raw_values: List[Any]) -> pd.Series:
+        """Versión vectorizada de _parse_timestamp: un pd.to_datetime por tipo de timestamp."""
+        n = len(raw_values)
+        numeros, textos, fechas, escalares = [], [], [], []
+        for i, raw in enumerate(raw_values):
+            # Camino rápido para los tipos exactos más comunes
+            tipo = type(raw)
+            if tipo is datetime:
+                fechas.append((i, raw))
+                continue
+            if tipo is str:
+                textos.append((i, raw))
+                continue
+            if isinstance(raw, dict) and "$date" in raw:
+                raw = raw["$date"]
+            if isinstance(raw, (int, float)):
+                (numeros if self.EPOCH_MIN <= raw <= self.EPOCH_MAX else escalares).append((i, raw))
+            elif isinstance(raw, str):
+                textos.append((i, raw))
+            elif isinstance(raw, datetime):
+                fechas.append((i, raw))
+            # Otros tipos -> NaT (igual que el adapter)
+
+        chile_offset = pd.Timedelta(hours=3)
+        partes = []  # (posiciones, Series naive en hora de Chile)
+
+        # 1. Epoch: segundos o milisegundos según magnitud
+        if numeros:
+            pos, vals = zip(*numeros)
+            serie = pd.Series(vals, index=pos, dtype=float)
+            es_ms = serie > 1e11
+            local = pd.Series(pd.NaT, index=serie.index, dtype="datetime64[ns, UTC]")
+            if es_ms.any():
+                local[es_ms] = pd.to_datetime(serie[es_ms], unit='ms', utc=True)
+            if (~es_ms).any():
+                local[~es_ms] = pd.to_datetime(serie[~es_ms], unit='s', utc=True)
+            # El adapter pasa por datetime de Python (precisión de microsegundos)
+            partes.append(local.dt.tz_convert(None).dt.floor('us') - chile_offset)
+
+        # 2. ISO: sin zona se mantiene (ya es local); con zona se convierte a Chile
+        if textos:
+            pos, vals = zip(*textos)
+            serie = pd.Series(vals, index=pos, dtype=object)
+            naive = serie.str.match(self.ISO_NAIVE_PATTERN).astype(bool)
+            aware = ~naive & serie.str.match(self.ISO_AWARE_PATTERN).astype(bool)
+            if naive.any():
+                partes.append(pd.to_datetime(serie[naive], format="ISO8601", errors='coerce'))
+            if aware.any():
+                utc = pd.to_datetime(serie[aware], format="ISO8601", utc=True, errors='coerce')
+                partes.append(utc.dt.tz_convert(None) - chile_offset)
+            escalares.extend((i, raw_values[i]) for i in serie.index[~(naive | aware)])
+
+        # 3. Date de Mongo: naive se asume UTC
+        if fechas:
+            pos, vals = zip(*fechas)
+            utc = pd.Series(pd.to_datetime(list(vals), utc=True, errors='coerce'), index=pos)
+            partes.append(utc.dt.tz_convert(None) - chile_offset)
+
+        # Mismo dtype que produce _parse_historical_flat a partir de datetimes de Python
+        muestra = [datetime(2000, 1, 1)] if (numeros or textos or fechas or escalares) else [None]
+        ts_dtype = pd.to_datetime(pd.Series(muestra), errors='coerce').dtype
+        out = pd.Series(pd.NaT, index=range(n), dtype=ts_dtype)
+
+        for parte in partes:
+            validos = parte.dropna()
+            out[validos.index] = validos.astype(ts_dtype)
+            # Lo que el parser vectorizado no resolvió pasa por el adapter escalar
+            escalares.extend((i, raw_values[i]) for i in parte.index[parte.isna()])
+
+        for i, raw in escalares:
+            final_ts = self._parse_timestamp(raw)
+            if final_ts is not None:
+                out[i] = final_ts
+        return out
+
+    @staticmethod
+    def _sensor_column(raw_values: List[Any]) -> Tuple[Any, Any]:
+        """Convierte una columna de valores crudos de sensor -> (valores float, máscara de válidos)."""
+        candidatos = [
+            v.get("value") if isinstance(v, dict)
+            else (v if isinstance(v, (int, float)) and not isinstance(v, bool) else None)
+            for v in raw_values
+        ]
+        ok = np.array([c is not None for c in candidatos], dtype=bool)
+        values = np.full(len(candidatos), np.nan)
+        if not ok.any(): return values, ok
+
+        try:
+            values[ok] = np.array([c for c in candidatos if c is not None], dtype=object).astype(float)
+        except (ValueError, TypeError):
+            # Algún valor no convertible: elemento a elemento como el adapter
+            for i in np.flatnonzero(ok):
+                try:
+                    values[i] = float(candidatos[i])
+                except (ValueError, TypeError):
+                    ok[i] = False
+        return values, ok
+
+    def _normalize_batch(self, docs: List[Dict[str, Any]]) -> pd.DataFrame:
+        """
+        Versión por lotes de _normalize_document + _parse_historical_flat: construye directamente
+        el DataFrame plano (timestamp, device_id, location, <sensores>...) con una fila por documento,
+        en el mismo orden. El resultado es idéntico al del adapter.
+        """
+        if not docs: return pd.DataFrame()
+
+        # 1. ID de dispositivo, location y diccionario de sensores (mismas precedencias que el adapter)
+        device_ids = []
+        for d in docs:
+            dev_id = d.get("device_id") or d.get("dispositivo_id")
+            if not dev_id:
+                dev_id = d.get("metadata", {}).get("device_id", "unknown")
+            device_ids.append(dev_id)
+        locations = [d.get("location") or d.get("ubicacion", "Sin Asignar") for d in docs]
+        sensores = [d.get("sensors", {}) or d.get("datos", {}) or {} for d in docs]
+
+        # 2. Timestamps
+        data = {
+            "timestamp": self._parse_timestamps_batch([d.get("timestamp") for d in docs]),
+            "device_id": device_ids,
+            "location": locations,
+        }
+
+        # 3. Sensores columna a columna (claves crudas agrupadas por alias normalizado)
+        grupos = {}
+        for key in dict.fromkeys(chain.from_iterable(sensores)):
+            grupos.setdefault(self._normalize_sensor_key(key), []).append(key)
+
+        columnas = {}
+        for norm_key, keys in grupos.items():
+            values, ok = self._sensor_column([s.get(keys[0]) for s in sensores])
+            for key in keys[1:]:
+                otros, otros_ok = self._sensor_column([s.get(key) for s in sensores])
+                conflicto = np.flatnonzero(ok & otros_ok)
+                values = np.where(otros_ok, otros, values)
+                ok = ok | otros_ok
+                # Varias claves con el mismo alias en un documento: gana la última válida (como el adapter)
+                for i in conflicto:
+                    values[i] = self._normalize_document(docs[i])["sensors"][norm_key]
+            if ok.any():
+                columnas[norm_key] = (values, ok)
+
+        # Orden de columnas igual al de pd.DataFrame(filas): por primera aparición
+        def primera_aparicion(norm_key):
+            fila = int(np.argmax(columnas[norm_key][1]))
+            return fila, list(self._normalize_document(docs[fila])["sensors"]).index(norm_key)
+
+        for norm_key in sorted(columnas, key=primera_aparicion):
+            data[norm_key] = columnas[norm_key][0]
+
+        return pd.DataFrame(data)
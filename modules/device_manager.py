@@ -2,7 +2,7 @@ import pandas as pd
 import numpy as np
 from enum import Enum
 from dataclasses import dataclass, field
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from datetime import datetime, timezone, timedelta
 
 # --- ENUMS ---
@@ -27,6 +27,113 @@ class DeviceInfo:
     sensor_data: Dict[str, float] = field(default_factory=dict)
     alerts: List[str] = field(default_factory=list)
 
+# --- MOTOR DE UMBRALES (Vectorizado) ---
+class ThresholdEngine:
+    """
+    Umbrales compilados UNA vez a arrays (critical_min/max y óptimo min_value/max_value por
+    dispositivo y sensor) para clasificar lecturas en formato largo (device_id, sensor, value)
+    con comparaciones NumPy. Sirve tanto para el snapshot del dashboard como para rangos históricos.
+
+    Misma semántica que la evaluación por registro:
+    - Config específica del dispositivo > global (nombres de sensor en minúsculas).
+      Una config específica vacía desactiva el sensor aunque exista una global.
+    - Crítico si value < critical_min o > critical_max; Warning si está fuera del óptimo.
+    """
+
+    STATE_OK, STATE_WARNING, STATE_CRITICAL = 0, 1, 2
+    STATES = {0: HealthStatus.OK, 1: HealthStatus.WARNING, 2: HealthStatus.CRITICAL}
+
+    # Columnas de la tabla compilada; 'active' = 0 cuando la config está vacía
+    COLUMNS = ["c_min", "c_max", "o_min", "o_max", "active"]
+
+    def __init__(self, global_thresholds: Dict[str, Any], device_specific_thresholds: Dict[str, Dict[str, Any]] = None):
+        global_rows = {k.lower(): self._compile_config(v) for k, v in (global_thresholds or {}).items()}
+        self.global_bounds = pd.DataFrame.from_dict(global_rows, orient="index", columns=self.COLUMNS, dtype=float)
+
+        device_rows = {}
+        for device_id, configs in (device_specific_thresholds or {}).items():
+            for sensor, config in {k.lower(): v for k, v in (configs or {}).items()}.items():
+                device_rows[(device_id, sensor)] = self._compile_config(config)
+        self.device_bounds = pd.DataFrame.from_dict(device_rows, orient="index", columns=self.COLUMNS, dtype=float)
+        if device_rows:
+            self.device_bounds.index = pd.MultiIndex.from_tuples(self.device_bounds.index)
+
+    @staticmethod
+    def _compile_config(config: Any) -> Tuple[float, ...]:
+        """Config de un sensor -> (c_min, c_max, o_min, o_max, active)."""
+        if not config: return (np.nan, np.nan, np.nan, np.nan, 0.0)
+
+        # Mapping robusto: Prioriza valores personalizados sobre defaults
+        # Personalizados: min_value, max_value, critical_min, critical_max
+        # Defaults JSON: min, max, optimal_min, optimal_max
+        def bound(key, fallback, default):
+            try:
+                return float(config.get(key, config.get(fallback, default)))
+            except (TypeError, ValueError):
+                return float(default)
+
+        return (
+            bound("critical_min", "min", -9999),
+            bound("critical_max", "max", 9999),
+            bound("min_value", "optimal_min", -9999),
+            bound("max_value", "optimal_max", 9999),
+            1.0,
+        )
+
+    def classify(self, readings: pd.DataFrame) -> pd.DataFrame:
+        """
+        readings: formato largo con columnas device_id, sensor, value (columnas extra se conservan).
+        Retorna una copia con 'state' (0 OK, 1 Warning, 2 Crítico) y 'configured' (hay umbral activo).
+        """
+        out = readings.copy()
+        n = len(out)
+        if n == 0:
+            out["state"] = pd.Series(dtype=int)
+            out["configured"] = pd.Series(dtype=bool)
+            return out
+
+        sensors = out["sensor"].astype(str).str.lower()
+        glob = self.global_bounds.reindex(sensors.to_numpy()).to_numpy()
+        if self.device_bounds.empty:
+            bounds = glob
+        else:
+            keys = pd.MultiIndex.from_arrays([out["device_id"].to_numpy(), sensors.to_numpy()])
+            dev = self.device_bounds.reindex(keys).to_numpy()
+            bounds = np.where(np.isnan(dev[:, [4]]), glob, dev)
+
+        values = out["value"].to_numpy(dtype=float)
+        active = bounds[:, 4] == 1
+        critical = (values < bounds[:, 0]) | (values > bounds[:, 1])
+        warning = (values < bounds[:, 2]) | (values > bounds[:, 3])
+
+        out["state"] = np.where(active & critical, self.STATE_CRITICAL,
+                                np.where(active & warning, self.STATE_WARNING, self.STATE_OK))
+        out["configured"] = active
+        return out
+
+    @staticmethod
+    def worst_state(classified: pd.DataFrame, by: str = "device_id") -> pd.Series:
+        """Peor estado por grupo (Critical > Warning > OK)."""
+        if classified.empty: return pd.Series(dtype=int)
+        return classified.groupby(by, sort=False)["state"].max()
+
+    @staticmethod
+    def breached_sensors(classified: pd.DataFrame, by: str = "device_id") -> Dict[Any, List[str]]:
+        """Sensores fuera de rango (Warning o Crítico) por grupo."""
+        fuera = classified[classified["state"] > ThresholdEngine.STATE_OK]
+        return {k: list(dict.fromkeys(g["sensor"])) for k, g in fuera.groupby(by, sort=False)}
+
+    @staticmethod
+    def readings_from_wide(df: pd.DataFrame, sensors: Optional[List[str]] = None,
+                           id_columns: Tuple[str, ...] = ("timestamp", "device_id")) -> pd.DataFrame:
+        """Historial plano (timestamp, device_id, <sensores>...) -> formato largo sin valores vacíos."""
+        id_columns = [c for c in id_columns if c in df.columns]
+        if sensors is None:
+            sensors = [c for c in df.select_dtypes(include=["number"]).columns if c not in id_columns]
+        long_df = df[id_columns + list(sensors)].melt(id_vars=id_columns, var_name="sensor", value_name="value")
+        return long_df.dropna(subset=["value"])
+
+
 # --- CLASE PRINCIPAL ---
 class DeviceManager:
     
@@ -40,17 +147,46 @@ class DeviceManager:
         self.global_thresholds = global_thresholds
         self.device_specific_thresholds = device_specific_thresholds or {}
         self._previous_health: Dict[str, HealthStatus] = previous_health or {}
+        self._engine: Optional[ThresholdEngine] = None
+    
+    @classmethod
+    def from_plan(cls, plan, previous_health: Dict[str, HealthStatus] = None) -> 'DeviceManager':
+        """Usa un ThresholdPlan (ConfigManager.get_threshold_plan) sin recompilar umbrales."""
+        manager = cls(plan.global_thresholds, previous_health, plan.device_thresholds)
+        manager._engine = plan.engine
+        return manager
     
     def get_health_states(self) -> Dict[str, HealthStatus]:
         return self._previous_health
 
+    def get_engine(self) -> ThresholdEngine:
+        """Umbrales compilados (una vez por instancia)."""
+        if self._engine is None:
+            self._engine = ThresholdEngine(self.global_thresholds, self.device_specific_thresholds)
+        return self._engine
+
     def get_all_devices_info(self, df: pd.DataFrame) -> List[DeviceInfo]:
         if df is None or df.empty:
             return []
         records = df.to_dict('records')
-        return [self._process_single_record(row) for row in records]
+        infos = [self._process_single_record(row) for row in records]
+        
+        # Evaluación vectorizada: todas las lecturas de dispositivos online sin alertas en un solo paso
+        pending = [i for i, info in enumerate(infos) if info.connection == ConnectionStatus.ONLINE and not info.alerts]
+        readings = pd.DataFrame(
+            [(i, infos[i].device_id, sensor, value) for i in pending for sensor, value in infos[i].sensor_data.items()],
+            columns=["_row", "device_id", "sensor", "value"]
+        )
+        worst = ThresholdEngine.worst_state(self.get_engine().classify(readings), by="_row")
+        
+        for i in pending:
+            health = ThresholdEngine.STATES[int(worst.get(i, ThresholdEngine.STATE_OK))]
+            infos[i].health = health
+            self._previous_health[infos[i].device_id] = health
+        return infos
     
     def _process_single_record(self, row: Dict) -> DeviceInfo:
+        """Parsea un registro; la salud de dispositivos online sin alertas la completa get_all_devices_info."""
         device_id = str(row.get("device_id", "Unknown"))
         location = str(row.get("location", "Sin ubicacion"))
         
@@ -73,8 +209,12 @@ class DeviceManager:
         # Evaluacion
         connection = self._evaluate_connection(timestamp)
         
-        if connection == ConnectionStatus.ONLINE:
-            health = self._evaluate_health(device_id, sensor_values, alerts)
+        if connection == ConnectionStatus.ONLINE and alerts:
+            # Alertas explicitas del dispositivo
+            health = HealthStatus.CRITICAL
+            self._previous_health[device_id] = health
+        elif connection == ConnectionStatus.ONLINE:
+            health = HealthStatus.OK  # Se evalúa en lote con ThresholdEngine
         else:
             health = HealthStatus.UNKNOWN # O mantener previous si queremos "memoria"
             # Para dashboard en tiempo real, si esta offline, el health es irrelevante o unknown
@@ -118,60 +258,6 @@ class DeviceManager:
             return ConnectionStatus.OFFLINE
         return ConnectionStatus.ONLINE
 
-    def _evaluate_health(self, device_id: str, sensors: Dict[str, float], alerts: List[str]) -> HealthStatus:
-        # 1. Alertas explicitas del dispositivo
-        if alerts:
-            self._previous_health[device_id] = HealthStatus.CRITICAL
-            return HealthStatus.CRITICAL
-            
-        new_health = HealthStatus.OK
-        
-        # Obtener Thresholds Específicos de este dispositivo (normalizar keys a lowercase)
-        raw_dev_thresholds = self.device_specific_thresholds.get(device_id, {})
-        dev_thresholds = {k.lower(): v for k, v in raw_dev_thresholds.items()}
-        
-        # Normalizar global thresholds también
-        global_lower = {k.lower(): v for k, v in self.global_thresholds.items()}
-        
-        for sensor, value in sensors.items():
-            sensor_key = sensor.lower() # Normalizar nombre del sensor a lowercase
-            
-            # Buscar config: Específica > Global (ambas normalizadas)
-            config = dev_thresholds.get(sensor_key, global_lower.get(sensor_key))
-            
-            if not config: continue
-            
-            # Interpretar Configuración de Umbrales
-            
-            # Mapping robusto: Prioriza valores personalizados sobre defaults
-            # Personalizados: min_value, max_value, critical_min, critical_max
-            # Defaults JSON: min, max, optimal_min, optimal_max
-            
-            c_min = float(config.get("critical_min", config.get("min", -9999)))
-            c_max = float(config.get("critical_max", config.get("max", 9999)))
-            o_min = float(config.get("min_value", config.get("optimal_min", -9999))) 
-            o_max = float(config.get("max_value", config.get("optimal_max", 9999)))
-            
-            # Evaluación
-            state = HealthStatus.OK
-            
-            # Critico
-            if value < c_min or value > c_max:
-                state = HealthStatus.CRITICAL
-            # Warning (Zona entre Crítico y Óptimo)
-            elif value < o_min or value > o_max:
-                state = HealthStatus.WARNING
-            
-            # Prioridad de Estados: Critical > Warning > OK
-            if state == HealthStatus.CRITICAL:
-                new_health = HealthStatus.CRITICAL
-                break # Ya es crítico, no puede empeorar
-            elif state == HealthStatus.WARNING and new_health != HealthStatus.CRITICAL:
-                new_health = HealthStatus.WARNING
-        
-        self._previous_health[device_id] = new_health
-        return new_health
-
     def calculate_summary_metrics(self, devices: List[DeviceInfo]) -> Dict[str, int]:
         return {
             "total": len(devices),
@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+from typing import Sequence
+
+
+def m4_indices(x: np.ndarray, columns: Sequence[np.ndarray], n_buckets: int) -> np.ndarray:
+    """
+    Downsampling M4 (primer, último, mínimo y máximo por columna de píxel) de una serie
+    ordenada por x. Retorna los índices a conservar, ordenados.
+
+    Al conservar el mínimo y el máximo de cada píxel se mantienen los picos y cualquier
+    cruce de umbral: la línea dibujada es idéntica a la de la serie completa a ese ancho.
+    Con varias columnas (p.ej. promedio y banda mín/máx de un rollup) se une la selección de cada una.
+    """
+    n = len(x)
+    if n_buckets <= 0 or n <= 4 * n_buckets:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=np.float64)
+    span = x[-1] - x[0]
+    if span <= 0:
+        return np.arange(n)
+    buckets = np.minimum(((x - x[0]) / span * n_buckets).astype(np.int64), n_buckets - 1)
+
+    # Límites de cada bucket (x viene ordenado, los buckets son no decrecientes)
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    ends = np.r_[starts[1:] - 1, n - 1]
+    keep = [starts, ends]
+
+    for y in columns:
+        y = np.asarray(y, dtype=np.float64)
+        # Dentro de cada bucket, ordenar por valor: el primero es el mínimo y el último el máximo
+        order = np.lexsort((y, buckets))
+        keep += [order[starts], order[ends]]
+
+    return np.unique(np.concatenate(keep))
+
+
+def downsample_frame(df: pd.DataFrame, columns: Sequence[str], n_buckets: int, x: str = 'timestamp') -> pd.DataFrame:
+    """Aplica m4_indices a un DataFrame ordenado por `x` (una serie de un dispositivo)."""
+    if n_buckets <= 0 or len(df) <= 4 * n_buckets:
+        return df
+    x_values = df[x].to_numpy(dtype='datetime64[ns]').astype(np.int64)
+    idx = m4_indices(x_values, [df[c].to_numpy(dtype=np.float64, na_value=np.nan) for c in columns], n_buckets)
+    return df.iloc[idx]
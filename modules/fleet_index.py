@@ -0,0 +1,87 @@
+from collections import defaultdict
+from typing import Dict, Set, Tuple, Iterable, Optional
+
+
+class FleetSearchIndex:
+    """
+    Índice invertido de n-gramas (1..GRAM caracteres, en minúsculas) sobre los textos
+    buscables de cada dispositivo: ID, alias, ubicación registrada y ubicación personalizada.
+
+    - Consultas de hasta GRAM caracteres: una sola búsqueda en el índice.
+    - Consultas más largas: intersección de los GRAM-gramas (del posting más chico al más
+      grande) y verificación de la subcadena solo sobre los candidatos.
+    Resultado idéntico a `consulta in texto.lower()` sobre cada campo.
+
+    Se mantiene de forma INCREMENTAL con upsert/remove: solo se tocan los gramas que cambian.
+    """
+
+    GRAM = 3
+
+    def __init__(self):
+        self._texts: Dict[str, Tuple[str, ...]] = {}  # device_id -> textos indexados (minúsculas)
+        self._postings: Dict[str, Set[str]] = defaultdict(set)
+
+    def copy(self) -> 'FleetSearchIndex':
+        clone = FleetSearchIndex()
+        clone._texts = dict(self._texts)
+        clone._postings = defaultdict(set, {g: set(ids) for g, ids in self._postings.items()})
+        return clone
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+    def __contains__(self, device_id: str) -> bool:
+        return device_id in self._texts
+
+    def ids(self) -> Set[str]:
+        return set(self._texts)
+
+    @classmethod
+    def _grams(cls, texts: Iterable[str]) -> Set[str]:
+        grams = set()
+        for text in texts:
+            for n in range(1, cls.GRAM + 1):
+                grams.update(text[i:i + n] for i in range(len(text) - n + 1))
+        return grams
+
+    # --- MANTENIMIENTO ---
+    def upsert(self, device_id: str, texts: Iterable[Optional[str]]) -> bool:
+        """Indexa (o re-indexa) un dispositivo. Retorna False si sus textos no cambiaron."""
+        new_texts = tuple(t.lower() for t in texts if t)
+        old_texts = self._texts.get(device_id)
+        if old_texts == new_texts: return False
+
+        old_grams = self._grams(old_texts) if old_texts is not None else set()
+        new_grams = self._grams(new_texts)
+        for g in old_grams - new_grams:
+            self._discard(g, device_id)
+        for g in new_grams - old_grams:
+            self._postings[g].add(device_id)
+        self._texts[device_id] = new_texts
+        return True
+
+    def remove(self, device_id: str):
+        old_texts = self._texts.pop(device_id, None)
+        if old_texts is None: return
+        for g in self._grams(old_texts):
+            self._discard(g, device_id)
+
+    def _discard(self, gram: str, device_id: str):
+        ids = self._postings.get(gram)
+        if ids is None: return
+        ids.discard(device_id)
+        if not ids: del self._postings[gram]
+
+    # --- CONSULTA ---
+    def search(self, query: str) -> Set[str]:
+        """IDs cuyo algún texto contiene `query` (sin distinguir mayúsculas)."""
+        q = query.lower()
+        if not q: return set(self._texts)
+        if len(q) <= self.GRAM:
+            return set(self._postings.get(q, ()))
+
+        grams = {q[i:i + self.GRAM] for i in range(len(q) - self.GRAM + 1)}
+        postings = sorted((self._postings.get(g, set()) for g in grams), key=len)
+        if not postings[0]: return set()
+        candidates = set(postings[0]).intersection(*postings[1:])
+        return {d for d in candidates if any(q in t for t in self._texts[d])}
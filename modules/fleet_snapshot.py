@@ -0,0 +1,430 @@
+import os
+import time
+import threading
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Any, Optional, List, Set, Tuple
+
+import pandas as pd
+import streamlit as st
+
+from modules.database import DatabaseConnection
+from modules.config_manager import ConfigManager
+from modules.sensor_registry import SensorRegistry
+from modules.device_manager import DeviceManager, DeviceInfo, ConnectionStatus, HealthStatus
+from modules.fleet_index import FleetSearchIndex
+
+
+class FleetView:
+    """
+    Vista consultable de UN snapshot: KPIs precalculados y consultas paginadas con filtros
+    (estado, ubicación, alias/ID, búsqueda). El dashboard solo recibe la página visible,
+    por lo que su costo es proporcional a una página de tarjetas y no al tamaño de la flota.
+
+    Los filtros se resuelven con índices precalculados (buckets por estado, ubicación y alias,
+    FleetSearchIndex para la búsqueda y el orden por alias), no recorriendo la flota:
+    - Al crear la vista de un snapshot nuevo se parte del índice anterior y solo se re-indexan
+      los dispositivos que cambiaron.
+    - sync_metadata() re-indexa cuando cambian alias/ubicaciones personalizadas
+      (ConfigManager.devices_version), que tienen prioridad sobre los del snapshot.
+    """
+
+    STATUS_LABELS = ["Normal", "Alerta", "Crítico", "Offline"]
+
+    def __init__(self, devices: List[DeviceInfo], previous: Optional['FleetView'] = None):
+        self.devices = devices
+        # Conteos de los KPI (una sola vez por snapshot)
+        self.kpis = DeviceManager({}).calculate_summary_metrics(devices)
+        self.status = {d.device_id: self.status_label(d) for d in devices}
+        self.by_id = {d.device_id: d for d in devices}
+
+        # Buckets por estado y conjuntos base (con / sin offline)
+        self.by_status: Dict[str, Set[str]] = defaultdict(set)
+        for dev_id, label in self.status.items():
+            self.by_status[label].add(dev_id)
+        self.all_ids = set(self.status)
+        self.online_ids = self.all_ids - self.by_status["Offline"]
+
+        # Cambia solo si cambió la composición o el estado de algún dispositivo (KPIs / filtros por estado);
+        # el modo auto-refresco del dashboard hace un rerun completo únicamente en ese caso
+        if previous is None: self.layout_version = 0
+        else: self.layout_version = previous.layout_version + (previous.status != self.status)
+
+        self._lock = threading.Lock()
+        if previous is None:
+            self.metadata_version = None
+            self._alias_map, self._custom_loc_map = {}, {}
+            self.index = FleetSearchIndex()
+            self._entries: Dict[str, Tuple] = {}  # device_id -> (textos buscables, ubicación efectiva, alias)
+            self.by_location: Dict[str, Set[str]] = defaultdict(set)
+            self.by_alias: Dict[str, Set[str]] = defaultdict(set)
+            self.rank: Dict[str, int] = {}
+            self._options: Dict[bool, Dict[str, List[str]]] = {}
+            reorder, online_changed = True, True
+        else:
+            # Otra sesión puede estar sincronizando metadatos sobre la vista anterior: copiar bajo su lock
+            with previous._lock:
+                self.metadata_version = previous.metadata_version
+                self._alias_map, self._custom_loc_map = previous._alias_map, previous._custom_loc_map
+                self.index = previous.index.copy()
+                self._entries = dict(previous._entries)
+                self.by_location = defaultdict(set, {k: set(v) for k, v in previous.by_location.items()})
+                self.by_alias = defaultdict(set, {k: set(v) for k, v in previous.by_alias.items()})
+                self.rank, self._options = previous.rank, previous._options
+            reorder = previous.all_ids != self.all_ids
+            online_changed = previous.online_ids != self.online_ids
+
+        # Índices: se parte de los anteriores y solo se aplican los dispositivos que cambiaron
+        for dev_id in self._entries.keys() - self.all_ids:
+            self._apply(dev_id, None)
+        self._reindex(self.devices, reorder, online_changed)
+
+    @staticmethod
+    def status_label(device: DeviceInfo) -> str:
+        if device.connection == ConnectionStatus.OFFLINE: return "Offline"
+        if device.health == HealthStatus.CRITICAL: return "Crítico"
+        if device.health == HealthStatus.WARNING: return "Alerta"
+        return "Normal"
+
+    # --- ÍNDICES ---
+    def sync_metadata(self, metadata: Optional[Dict[str, Dict[str, Any]]], version: Optional[int] = None):
+        """
+        metadata: {device_id: {alias, location, ...}} (ConfigManager.get_device_metadata).
+        Con la misma versión ya sincronizada no hace nada; si no, re-indexa solo los dispositivos
+        cuyo alias o ubicación personalizada cambió.
+        """
+        with self._lock:
+            if version is not None and version == self.metadata_version: return
+            alias_map, custom_loc_map = {}, {}
+            for dev_id, info in (metadata or {}).items():
+                alias_map[dev_id] = info.get("alias", "")
+                custom_loc_map[dev_id] = info.get("location", "")
+            old_alias, old_loc = self._alias_map, self._custom_loc_map
+            dirty = {k for k in old_alias.keys() | alias_map.keys() if old_alias.get(k) != alias_map.get(k)}
+            dirty |= {k for k in old_loc.keys() | custom_loc_map.keys() if old_loc.get(k) != custom_loc_map.get(k)}
+            self._alias_map, self._custom_loc_map = alias_map, custom_loc_map
+            self._reindex([self.by_id[k] for k in dirty if k in self.by_id])
+            self.metadata_version = version
+
+    def _apply(self, dev_id: str, entry: Optional[Tuple]):
+        """Mueve un dispositivo de su entrada anterior a `entry` (None = quitarlo) en la búsqueda y los buckets."""
+        old = self._entries.pop(dev_id, None)
+        if old is not None:
+            _, old_loc, old_alias = old
+            for buckets, key in ((self.by_location, old_loc), (self.by_alias, old_alias)):
+                if key is None: continue
+                buckets[key].discard(dev_id)
+                if not buckets[key]: del buckets[key]
+        if entry is None:
+            self.index.remove(dev_id)
+            return
+        texts, eff_loc, alias = entry
+        self.index.upsert(dev_id, texts)
+        if eff_loc is not None: self.by_location[eff_loc].add(dev_id)
+        self.by_alias[alias].add(dev_id)
+        self._entries[dev_id] = entry
+
+    def _reindex(self, devices: List[DeviceInfo], reorder: bool = False, online_changed: bool = False):
+        """
+        Aplica a los índices los dispositivos indicados cuya entrada cambió. El orden por alias se
+        recalcula solo si cambian los alias o el conjunto de dispositivos; las opciones de los
+        filtros, además, si cambia alguna ubicación o el conjunto online.
+        """
+        alias_map, custom_loc_map = self._alias_map, self._custom_loc_map
+        aliases_changed = locations_changed = False
+        for d in devices:
+            dev_id = d.device_id
+            entry = ((dev_id, d.location, alias_map.get(dev_id, ""), custom_loc_map.get(dev_id, "")),
+                     custom_loc_map.get(dev_id) or d.location or None,
+                     alias_map.get(dev_id, dev_id))
+            old = self._entries.get(dev_id)
+            if old == entry: continue
+            aliases_changed |= old is None or old[2] != entry[2]
+            locations_changed |= old is None or old[1] != entry[1]
+            self._apply(dev_id, entry)
+
+        if reorder or aliases_changed:
+            # Orden de presentación precalculado (por alias)
+            ordered = sorted((d.device_id for d in self.devices), key=lambda dev_id: alias_map.get(dev_id, dev_id.lower()))
+            self.rank = {dev_id: i for i, dev_id in enumerate(ordered)}
+
+        if reorder or aliases_changed or locations_changed or online_changed:
+            options = {}
+            for show_offline in (False, True):
+                base = self.all_ids if show_offline else self.online_ids
+                options[show_offline] = {
+                    "locations": sorted(loc for loc, ids in self.by_location.items() if not ids.isdisjoint(base)),
+                    "aliases": sorted(self._entries[dev_id][2] for dev_id in base),
+                }
+            self._options = options
+
+    # --- CONSULTAS ---
+    def options(self, show_offline: bool = False) -> Dict[str, List[str]]:
+        """Opciones de los multiselect (ubicaciones y alias) sobre los dispositivos visibles."""
+        with self._lock:
+            return self._options[bool(show_offline)]
+
+    def query(self, filters: Optional[Dict[str, Any]] = None, page: int = 0, per_page: int = 9) -> Dict[str, Any]:
+        """
+        filters: {"search": str, "show_offline": bool, "status": [...], "locations": [...], "aliases": [...]}
+        Retorna {"items": [DeviceInfo de la página], "total": n filtrados, "page": página efectiva, "pages": n páginas}.
+        """
+        filters = filters or {}
+        with self._lock:
+            base = self.all_ids if filters.get("show_offline", False) else self.online_ids
+            ids = base
+
+            if filters.get("status"):
+                status = set(filters["status"])
+                # 'Offline' explícito muestra los offline aunque el checkbox esté desmarcado
+                pool = self.all_ids if "Offline" in status else base
+                ids = set().union(*(self.by_status.get(s, ()) for s in status)) & pool
+            elif filters.get("locations"):
+                ids = set().union(*(self.by_location.get(l, ()) for l in filters["locations"])) & base
+            elif filters.get("aliases"):
+                ids = set().union(*(self.by_alias.get(a, ()) for a in filters["aliases"])) & base
+
+            if filters.get("search"):
+                ids = self.index.search(filters["search"]) & ids
+
+            ordered = sorted(ids, key=self.rank.__getitem__)
+            pages = max(1, (len(ordered) + per_page - 1) // per_page)
+            page = page if 0 <= page < pages else 0
+            return {
+                "items": [self.by_id[i] for i in ordered[page * per_page:(page + 1) * per_page]],
+                "total": len(ordered),
+                "page": page,
+                "pages": pages,
+            }
+
+
+class FleetSnapshot:
+    """
+    Snapshot de la flota compartido por TODAS las sesiones del proceso.
+
+    Un único hilo en segundo plano lo recalcula cada refresh_seconds: últimas lecturas,
+    metadatos, umbrales y DeviceInfo ya evaluados. Las sesiones solo leen el snapshot,
+    por lo que la carga en Mongo depende del intervalo y no de la cantidad de usuarios.
+    """
+
+    DEFAULT_REFRESH_SECONDS = 10
+
+    # Cada cuánto se hace una carga COMPLETA (get_latest_by_device); entre medio cada tick solo
+    # consulta la sonda de cambios (probe_changes) y re-lee los dispositivos que cambiaron
+    DEFAULT_FULL_REFRESH_SECONDS = 300
+
+    # Espera máxima de la primera carga / de un refresco pedido manualmente
+    WAIT_TIMEOUT_SECONDS = 60
+
+    def __init__(self, refresh_seconds: Optional[float] = None):
+        self.refresh_seconds = float(refresh_seconds or os.getenv("FLEET_REFRESH_SECONDS") or self.DEFAULT_REFRESH_SECONDS)
+        self.full_refresh_seconds = float(os.getenv("FLEET_FULL_REFRESH_SECONDS") or self.DEFAULT_FULL_REFRESH_SECONDS)
+        self._watermarks: Dict[str, Any] = {}  # Fuente -> último _id visto (probe_changes)
+        self._last_full = 0.0
+        self._force_full = False
+        self._data: Optional[Dict[str, Any]] = None
+        self._cond = threading.Condition()
+        self._wake = threading.Event()
+        self._started_seq = 0   # Refrescos iniciados
+        self._done_seq = 0      # Refrescos terminados
+        self._thread: Optional[threading.Thread] = None
+
+    # --- CICLO DE VIDA ---
+    def start(self):
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive(): return
+            self._thread = threading.Thread(target=self._run, name="fleet-snapshot", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            with self._cond:
+                # Leer y limpiar el pedido junto con el inicio: un request_refresh posterior espera el siguiente
+                self._started_seq += 1
+                force_full, self._force_full = self._force_full, False
+            full = force_full or self._data is None or time.time() - self._last_full >= self.full_refresh_seconds
+            data = self._build(full)
+            with self._cond:
+                self._data = data
+                self._done_seq += 1
+                self._cond.notify_all()
+            self._wake.wait(self.refresh_seconds)
+
+    # --- CONSTRUCCIÓN ---
+    def _build(self, full: bool = True) -> Dict[str, Any]:
+        start_time = time.time()
+        previous = self._data or {}
+        try:
+            db = DatabaseConnection()
+            config_manager = ConfigManager(db)
+            changed = None
+            if not full:
+                watermarks, changed = db.probe_changes(self._watermarks)
+            if changed is None:
+                # Carga completa. El watermark se toma ANTES de leer para no perder documentos
+                full = True
+                watermarks, _ = db.probe_changes({})
+                df = db.get_latest_by_device()
+            else:
+                df = self._patch_latest(db, previous.get("df"), changed, config_manager.get_device_metadata())
+            thresholds = config_manager.get_all_configured_sensors()
+            metadata = {}
+            metadata_version = None  # None = metadatos no cargados (la vista los sincroniza después)
+            plan = None
+            devices = []
+            health_states = {}
+
+            if df is not None and not df.empty:
+                try:
+                    detected = SensorRegistry.discover_sensors_from_dataframe(df)
+                    config_manager.sync_with_detected_sensors(detected)
+                    metadata_version = ConfigManager.devices_version()
+                    metadata = config_manager.get_device_metadata()
+                    # Umbrales compilados: solo se recompilan si cambió la configuración
+                    plan = config_manager.get_threshold_plan()
+                    thresholds = plan.global_thresholds
+                    manager = DeviceManager.from_plan(plan, {})
+                except Exception as e:
+                    print(f"[fleet_snapshot] Sin umbrales específicos: {e}")
+                    manager = DeviceManager(thresholds, {})
+                devices = manager.get_all_devices_info(df)
+                health_states = manager.get_health_states()
+
+            # Índices de filtros/búsqueda: incrementales respecto de la vista anterior
+            view = FleetView(devices, previous.get("view"))
+            view.sync_metadata(metadata, metadata_version)
+
+            self._watermarks = watermarks
+            if full: self._last_full = time.time()
+
+            return {
+                "df": df,
+                "devices": devices,
+                "health_states": health_states,
+                "thresholds": thresholds,
+                "metadata": metadata,
+                "plan": plan,
+                "view": view,
+                "updated_at": time.time(),
+                "elapsed": time.time() - start_time,
+                "version": previous.get("version", 0) + 1,
+                "full": full,
+                "changed": changed,  # IDs re-leídos en un tick incremental (None = carga completa)
+                "error": None,
+            }
+        except Exception as e:
+            print(f"[fleet_snapshot] Error refrescando snapshot: {e}")
+            # Mantener el último snapshot válido y registrar el error
+            return {
+                "df": previous.get("df"),
+                "devices": previous.get("devices", []),
+                "health_states": previous.get("health_states", {}),
+                "thresholds": previous.get("thresholds", {}),
+                "metadata": previous.get("metadata", {}),
+                "plan": previous.get("plan"),
+                "view": previous.get("view") or FleetView([]),
+                "updated_at": previous.get("updated_at", 0.0),
+                "elapsed": time.time() - start_time,
+                "version": previous.get("version", 0),
+                "full": full,
+                "changed": set(),
+                "error": str(e),
+            }
+
+    @staticmethod
+    def _patch_latest(db: DatabaseConnection, df: Optional[pd.DataFrame], changed: Set[str],
+                      metadata: Dict[str, Dict[str, Any]]) -> pd.DataFrame:
+        """
+        Reemplaza en el DataFrame del snapshot solo las filas de los dispositivos que cambiaron
+        (una agregación $in por fuente), con el mismo enriquecimiento que get_latest_by_device.
+        """
+        if not changed or df is None: return df
+        latest = db.get_latest_for_devices(sorted(changed))
+        if not latest: return df
+
+        docs = []
+        for dev_id, norm_doc in latest.items():
+            doc = dict(norm_doc)
+            meta = metadata.get(dev_id) or {}
+            # La ubicación registrada tiene prioridad
+            if meta.get("location"): doc["location"] = meta["location"]
+            if meta.get("alias"): doc["external_alias"] = meta["alias"]
+            docs.append(doc)
+
+        fresh = db._rows_to_dataframe_mixed(docs)
+        if df.empty: return fresh
+        # Mantener el orden original (dispositivos nuevos al final)
+        position = {dev_id: i for i, dev_id in enumerate(df["device_id"])}
+        merged = pd.concat([df[~df["device_id"].isin(latest)], fresh], ignore_index=True)
+        order = merged["device_id"].map(position).fillna(len(position)).to_numpy()
+        return merged.iloc[order.argsort(kind="stable")].reset_index(drop=True)
+
+    # --- LECTURA ---
+    def get(self) -> Dict[str, Any]:
+        """Snapshot actual. La primera vez espera a que termine la carga inicial."""
+        self.start()
+        with self._cond:
+            self._cond.wait_for(lambda: self._data is not None, self.WAIT_TIMEOUT_SECONDS)
+            return self._data or self._build_empty()
+
+    def request_refresh(self) -> Dict[str, Any]:
+        """
+        Pide un refresco inmediato y espera un snapshot iniciado DESPUÉS del pedido.
+        Varios clics simultáneos comparten el mismo refresco.
+        """
+        self.start()
+        with self._cond:
+            target = self._started_seq + 1
+            self._force_full = True
+            self._wake.set()
+            self._cond.wait_for(lambda: self._done_seq >= target, self.WAIT_TIMEOUT_SECONDS)
+            return self._data or self._build_empty()
+
+    def evaluate_doc(self, norm_doc: Dict[str, Any], previous_health: Optional[Dict[str, Any]] = None) -> Optional[DeviceInfo]:
+        """
+        Evalúa UNA lectura normalizada (p.ej. del LiveFeed) con los umbrales y metadatos
+        del snapshot actual, sin consultar Mongo.
+        """
+        data = self.get()
+        meta = data["metadata"].get(norm_doc.get("device_id"), {})
+        doc = dict(norm_doc)
+        # Igual que get_latest_by_device: la ubicación registrada tiene prioridad
+        if meta.get("location"): doc["location"] = meta["location"]
+
+        if data.get("plan") is not None:
+            manager = DeviceManager.from_plan(data["plan"], dict(previous_health or {}))
+        else:
+            manager = DeviceManager(data["thresholds"], dict(previous_health or {}))
+        infos = manager.get_all_devices_info(DatabaseConnection()._rows_to_dataframe([doc]))
+        return infos[0] if infos else None
+
+    def refresh_device(self, device_id: str, last_update: Optional[datetime] = None,
+                       previous_health: Optional[Dict[str, Any]] = None) -> Tuple[str, Optional[DeviceInfo]]:
+        """
+        Refresco rápido de UNA tarjeta: un find_one indexado por fuente y evaluación con el
+        plan de umbrales y metadatos ya cacheados en el snapshot (sin leer 'devices' ni la config).
+        Retorna ("updated", DeviceInfo) | ("unchanged", None) si la última lectura no es más nueva
+        que last_update | ("not_found", None).
+        """
+        norm_doc = DatabaseConnection().get_latest_doc(device_id)
+        if not norm_doc: return "not_found", None
+        ts = norm_doc.get("timestamp")
+        if last_update is not None and ts is not None and ts <= last_update:
+            return "unchanged", None
+        return "updated", self.evaluate_doc(norm_doc, previous_health)
+
+    @staticmethod
+    def _build_empty() -> Dict[str, Any]:
+        return {"df": None, "devices": [], "health_states": {}, "thresholds": {}, "metadata": {}, "plan": None,
+                "view": FleetView([]),
+                "updated_at": 0.0, "elapsed": 0.0, "version": 0, "full": True, "changed": None,
+                "error": "Snapshot no disponible"}
+
+
+@st.cache_resource(show_spinner=False)
+def get_fleet_snapshot() -> FleetSnapshot:
+    """Instancia única por proceso (compartida entre sesiones)."""
+    snapshot = FleetSnapshot()
+    snapshot.start()
+    return snapshot
@@ -0,0 +1,152 @@
+import os
+import json
+import threading
+from pathlib import Path
+from urllib.parse import quote
+from datetime import datetime, date, timedelta, timezone
+from typing import List, Optional, Iterable
+
+import pandas as pd
+
+# pyarrow llega como dependencia de streamlit; si falta, el archivo queda deshabilitado
+try:
+    import pyarrow  # noqa: F401
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+
+class HistoryArchive:
+    """
+    Archivo local columnar (Parquet) de telemetría YA normalizada.
+
+    Layout en disco:
+        <base>/device=<device_id>/<YYYY-MM-DD>.parquet   (un archivo por dispositivo y día)
+        <base>/manifest.json                             (días cerrados ya archivados)
+
+    Un día se archiva completo (todos los dispositivos) una sola vez, cuando ya está cerrado:
+    pasaron CLOSE_LAG_DAYS días completos desde él (hora de Chile), para que la telemetría
+    atrasada (buffer del dispositivo, réplica de una fuente secundaria) alcance a llegar.
+    Los días abiertos siempre se consultan a Mongo.
+    """
+
+    DEFAULT_DIR = Path(__file__).resolve().parent.parent / "data" / "archive"
+    MANIFEST_FILE = "manifest.json"
+
+    # Días completos que deben pasar antes de considerar un día "cerrado" (0 = solo hoy queda abierto)
+    CLOSE_LAG_DAYS = int(os.getenv("HISTORY_ARCHIVE_CLOSE_LAG_DAYS", 2))
+
+    _lock = threading.Lock()
+
+    def __init__(self, base_dir: Optional[str] = None):
+        self.base_dir = Path(base_dir or os.getenv("HISTORY_ARCHIVE_DIR") or self.DEFAULT_DIR)
+        self.enabled = PARQUET_AVAILABLE
+
+    # --- DÍAS ---
+    @staticmethod
+    def today_local() -> date:
+        """Día actual en hora de Chile (UTC-3), igual que los timestamps normalizados."""
+        return datetime.now(timezone(timedelta(hours=-3))).date()
+
+    def is_closed(self, day: date) -> bool:
+        return day < self.today_local() - timedelta(days=self.CLOSE_LAG_DAYS)
+
+    @staticmethod
+    def days_between(start: datetime, end: datetime) -> List[date]:
+        d, last = start.date(), end.date()
+        days = []
+        while d <= last:
+            days.append(d)
+            d += timedelta(days=1)
+        return days
+
+    # --- MANIFEST ---
+    def _manifest_path(self) -> Path:
+        return self.base_dir / self.MANIFEST_FILE
+
+    def archived_days(self) -> set:
+        path = self._manifest_path()
+        if not path.exists(): return set()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return {date.fromisoformat(d) for d in json.load(f).get("days", [])}
+        except Exception as e:
+            print(f"[history_archive] Manifest ilegible, se ignora: {e}")
+            return set()
+
+    def missing_closed_days(self, days: Iterable[date]) -> List[date]:
+        """Días cerrados del rango que aún no están en el archivo."""
+        if not self.enabled: return []
+        done = self.archived_days()
+        return [d for d in days if self.is_closed(d) and d not in done]
+
+    def _mark_days(self, days: Iterable[date]):
+        done = self.archived_days() | set(days)
+        self.base_dir.mkdir(parents=True, exist_ok=True)
+        tmp = self._manifest_path().with_suffix(".tmp")
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({"days": sorted(d.isoformat() for d in done)}, f)
+        os.replace(tmp, self._manifest_path())
+
+    # --- ESCRITURA ---
+    def _partition_path(self, device_id: str, day: date) -> Path:
+        return self.base_dir / f"device={quote(str(device_id), safe='')}" / f"{day.isoformat()}.parquet"
+
+    def write_days(self, df: pd.DataFrame, days: Iterable[date]) -> bool:
+        """
+        Guarda en el archivo los días indicados a partir de un DataFrame normalizado
+        (columnas timestamp, device_id, ...). Los días sin datos también se marcan como
+        archivados para no volver a consultarlos.
+        """
+        if not self.enabled: return False
+        days = [d for d in days if self.is_closed(d)]
+        if not days: return True
+
+        with self._lock:
+            try:
+                if df is not None and not df.empty:
+                    day_col = df['timestamp'].dt.date
+                    subset = df[day_col.isin(days)]
+                    for (dev_id, day), part in subset.groupby([subset['device_id'], subset['timestamp'].dt.date]):
+                        path = self._partition_path(dev_id, day)
+                        path.parent.mkdir(parents=True, exist_ok=True)
+                        # Eliminar columnas de sensores sin datos en esta partición
+                        part = part.dropna(axis=1, how='all')
+                        part.to_parquet(path, index=False)
+                self._mark_days(days)
+                print(f"[history_archive] {len(days)} días archivados en {self.base_dir}")
+                return True
+            except Exception as e:
+                print(f"[history_archive] Error archivando: {e}")
+                return False
+
+    # --- LECTURA ---
+    def _device_dirs(self, devices: Optional[List[str]]) -> List[Path]:
+        if not self.base_dir.exists(): return []
+        if devices:
+            dirs = [self.base_dir / f"device={quote(str(d), safe='')}" for d in devices]
+            return [d for d in dirs if d.exists()]
+        return [d for d in self.base_dir.iterdir() if d.is_dir() and d.name.startswith("device=")]
+
+    def read_range(self, start: datetime, end: datetime, devices: Optional[List[str]] = None,
+                   days: Optional[Iterable[date]] = None) -> pd.DataFrame:
+        """
+        Lee solo las particiones (dispositivo, día) del rango y aplica el filtro exacto de tiempo.
+        days permite restringir la lectura a un subconjunto de días del rango.
+        """
+        if not self.enabled: return pd.DataFrame()
+
+        wanted = sorted(d.isoformat() for d in (days if days is not None else self.days_between(start, end)))
+        frames = []
+        for dev_dir in self._device_dirs(devices):
+            for day in wanted:
+                f = dev_dir / f"{day}.parquet"
+                if not f.exists(): continue
+                try:
+                    frames.append(pd.read_parquet(f))
+                except Exception as e:
+                    print(f"[history_archive] Partición ilegible {f}: {e}")
+
+        if not frames: return pd.DataFrame()
+        df = pd.concat(frames, ignore_index=True)
+        return df[(df['timestamp'] >= start) & (df['timestamp'] <= end)]
@@ -0,0 +1,187 @@
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Any, Tuple
+
+from modules.database import DatabaseConnection
+
+
+class IndexAdvisor:
+    """
+    Verifica (y opcionalmente crea) los índices de telemetría de cada fuente y ejecuta
+    explain() sobre las formas de consulta que emite la app, reportando documentos y claves
+    examinados, COLLSCAN y sort en memoria.
+    Solo se crean índices en fuentes con escritura habilitada.
+    """
+
+    # Índices requeridos por las consultas de la app (cualquier índice con el mismo prefijo de campos sirve)
+    REQUIRED_INDEXES = [
+        [("device_id", 1), ("timestamp", -1)],       # Esquema propio
+        [("dispositivo_id", 1), ("timestamp", -1)],  # Esquema partner
+        [("timestamp", -1)],                         # Ventanas Date / ISO y 'último por dispositivo'
+    ]
+
+    # Misma ventana que el historial de gráficas (1 semana + margen)
+    WINDOW = timedelta(weeks=1, hours=1)
+
+    def __init__(self, db: DatabaseConnection):
+        self.db = db
+
+    # --- ÍNDICES ---
+    @staticmethod
+    def _fields(key) -> Tuple[str, ...]:
+        return tuple(field for field, _ in key)
+
+    def missing_indexes(self, source: Dict[str, Any]) -> List[List[Tuple[str, int]]]:
+        collection = source["client"][source["db"]][source["coll_telemetry"]]
+        existing = [self._fields(info["key"]) for info in collection.index_information().values()]
+        missing = []
+        for spec in self.REQUIRED_INDEXES:
+            fields = self._fields(spec)
+            if not any(idx[:len(fields)] == fields for idx in existing):
+                missing.append(spec)
+        return missing
+
+    def ensure_indexes(self, source: Dict[str, Any], create: bool = True) -> Dict[str, Any]:
+        """Retorna {"missing": [...], "created": [...], "errors": [...]} para una fuente."""
+        result = {"missing": [], "created": [], "errors": []}
+        collection = source["client"][source["db"]][source["coll_telemetry"]]
+        for spec in self.missing_indexes(source):
+            if not (create and source["writable"]):
+                result["missing"].append(spec)
+                continue
+            try:
+                result["created"].append(collection.create_index(spec))
+            except Exception as e:
+                result["missing"].append(spec)
+                result["errors"].append(f"{spec}: {str(e)[:100]}")
+        return result
+
+    # --- FORMAS DE CONSULTA ---
+    def _sample(self, source: Dict[str, Any]) -> Tuple[str, List[str]]:
+        """(device_id, claves crudas de sensores) del documento más reciente de la fuente."""
+        collection = source["client"][source["db"]][source["coll_telemetry"]]
+        doc = collection.find_one({}, self.db.TELEMETRY_PROJECTION, sort=[("timestamp", -1)])
+        if not doc: return "unknown", []
+        sensors = doc.get("sensors") or doc.get("datos") or {}
+        return self.db._normalize_document(doc).get("device_id", "unknown"), list(sensors)
+
+    def query_shapes(self, source: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Consultas representativas de cada lector de la app, con valores de muestra.
+        "projection" es la que envía ese lector (por defecto TELEMETRY_PROJECTION, None = documento completo).
+        """
+        device_id, sensor_keys = self._sample(source)
+        # Las gráficas proyectan solo los sensores graficados
+        graphs_projection = self.db.sensor_projection(sensor_keys)
+        by_device = {"$or": [{"device_id": device_id}, {"dispositivo_id": device_id}]}
+        by_devices = {"$or": [{"device_id": {"$in": [device_id]}}, {"dispositivo_id": {"$in": [device_id]}}]}
+
+        now_local = datetime.now(timezone.utc).astimezone(timezone(timedelta(hours=-3))).replace(tzinfo=None)
+        start = now_local - self.WINDOW
+        window = [{"timestamp": {"$gte": start}}, {"timestamp": {"$gte": start.isoformat()}}]
+        day = now_local - timedelta(days=1)
+        sort_desc = {"timestamp": -1}
+
+        # Último por dispositivo: una agregación por campo de dispositivo (DISTINCT_SCAN con índice)
+        latest = []
+        for field in self.db.DEVICE_KEY_FIELDS:
+            latest += [
+                {"name": f"dashboard_latest_{field}", "kind": "aggregate",
+                 "pipeline": self.db._latest_docs_pipeline(field)},
+                {"name": f"latest_for_devices_{field}", "kind": "aggregate",
+                 "pipeline": self.db._latest_docs_pipeline(field, {field: {"$in": [device_id]}})},
+            ]
+
+        return [
+            *latest,
+            {"name": "dashboard_scan", "kind": "find", "filter": {}, "projection": None,
+             "sort": sort_desc, "limit": self.db.LIVE_SCAN_LIMIT},
+            {"name": "latest_single_device", "kind": "find", "filter": by_device,
+             "projection": self.db.LATEST_PROJECTION, "sort": sort_desc, "limit": 1},
+            {"name": "fetch_data", "kind": "find", "filter": by_devices,
+             "sort": sort_desc, "limit": 5000 // max(len(self.db.sources), 1) + 100},
+            # Gráficas: carga bajo demanda de los dispositivos elegidos (ventana completa o incremental)
+            {"name": "graphs_window", "kind": "find", "sort": sort_desc, "projection": graphs_projection,
+             "filter": {"$and": [by_devices, {"$or": window}]}},
+            {"name": "graphs_incremental", "kind": "find", "sort": sort_desc, "projection": graphs_projection,
+             "filter": {"$and": [by_devices, {"$or": [
+                {"device_id": {"$nin": [device_id]}, "dispositivo_id": {"$nin": [device_id]}, "$or": window},
+                {"device_id": device_id, "timestamp": {"$gt": day}},
+                {"dispositivo_id": device_id, "timestamp": {"$gt": day}},
+            ]}]}},
+            {"name": "history_range", "kind": "find", "filter": {"$or": [
+                {"timestamp": {"$gte": start, "$lte": now_local}},
+                {"timestamp": {"$gte": start.isoformat(), "$lte": now_local.isoformat()}},
+            ]}},
+        ]
+
+    # --- EXPLAIN ---
+    def explain(self, source: Dict[str, Any], shape: Dict[str, Any]) -> Dict[str, Any]:
+        coll = source["coll_telemetry"]
+        if shape["kind"] == "aggregate":
+            cmd = {"aggregate": coll, "pipeline": shape["pipeline"], "cursor": {}, "allowDiskUse": True}
+        else:
+            cmd = {"find": coll, "filter": shape["filter"]}
+            projection = shape.get("projection", self.db.TELEMETRY_PROJECTION)
+            if projection: cmd["projection"] = projection
+            if shape.get("sort"): cmd["sort"] = shape["sort"]
+            if shape.get("limit"): cmd["limit"] = shape["limit"]
+        raw = source["client"][source["db"]].command({"explain": cmd, "verbosity": "executionStats"})
+        return self.summarize(raw)
+
+    @staticmethod
+    def summarize(explain: Dict[str, Any]) -> Dict[str, Any]:
+        """Resume un explain (find o aggregate, plan clásico o SBE)."""
+        stages, stats = set(), []
+
+        def walk(node):
+            if isinstance(node, dict):
+                for key, value in node.items():
+                    if key == "stage" and isinstance(value, str):
+                        stages.add(value)
+                    elif key == "executionStats" and isinstance(value, dict):
+                        stats.append(value)
+                    walk(value)
+            elif isinstance(node, list):
+                for item in node:
+                    walk(item)
+
+        walk(explain)
+        # Etapas de agregación que no se absorbieron en la consulta ($sort aquí = sort en memoria)
+        for stage in explain.get("stages", []):
+            stages.update(k for k in stage if k.startswith("$") and k != "$cursor")
+
+        docs = sum(s.get("totalDocsExamined", 0) for s in stats)
+        returned = sum(s.get("nReturned", 0) for s in stats)
+        return {
+            "docs_examined": docs,
+            "keys_examined": sum(s.get("totalKeysExamined", 0) for s in stats),
+            "returned": returned,
+            "millis": sum(s.get("executionTimeMillis", 0) for s in stats),
+            "docs_per_result": round(docs / returned, 1) if returned else None,
+            "collscan": "COLLSCAN" in stages,
+            "in_memory_sort": "SORT" in stages or "$sort" in stages,
+            "stages": sorted(stages),
+        }
+
+    # --- REPORTE ---
+    def report(self, create: bool = False) -> Dict[str, Dict[str, Any]]:
+        """
+        Revisa todas las fuentes de telemetría (en paralelo).
+        create=True crea los índices faltantes en fuentes escribibles antes de ejecutar los explain.
+        Retorna {fuente: {"indexes": {...}, "queries": [{"name", ...resumen | "error"}]}}.
+        """
+        def check_source(source):
+            try:
+                indexes = self.ensure_indexes(source, create=create)
+            except Exception as e:
+                indexes = {"missing": [], "created": [], "errors": [str(e)[:100]]}
+
+            queries = []
+            for shape in self.query_shapes(source):
+                try:
+                    queries.append({"name": shape["name"], **self.explain(source, shape)})
+                except Exception as e:
+                    queries.append({"name": shape["name"], "error": str(e)[:100]})
+            return {"indexes": indexes, "queries": queries}
+
+        return {s["name"]: rep for s, rep in self.db.fan_out(check_source, self.db._telemetry_sources(), timeout=None)}
@@ -0,0 +1,131 @@
+import os
+import threading
+from typing import Dict, Any, Optional, Tuple
+
+import streamlit as st
+
+from modules.database import DatabaseConnection
+
+
+class LiveFeed:
+    """
+    Tabla en memoria con la ÚLTIMA lectura normalizada de cada dispositivo, alimentada por
+    un hilo por fuente de telemetría:
+    - Change streams (requiere replica set; basta uno de un solo nodo).
+    - Si la fuente no los soporta: polling por watermark de _id cada POLL_SECONDS.
+    Las tarjetas del dashboard leen esta tabla sin volver a consultar Mongo.
+    """
+
+    POLL_SECONDS = float(os.getenv("LIVE_POLL_SECONDS", 1))
+    POLL_BATCH = 500
+
+    # Espera antes de reconectar un change stream que se cortó
+    RETRY_SECONDS = 5
+
+    # Solo operaciones que producen una lectura nueva
+    CHANGE_PIPELINE = [{"$match": {"operationType": {"$in": ["insert", "replace", "update"]}}}]
+
+    def __init__(self, db: DatabaseConnection):
+        self.db = db
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._latest: Dict[str, Tuple[int, Dict[str, Any]]] = {}  # device_id -> (versión, doc normalizado)
+        self.version = 0
+        # Modo por fuente: "change_stream" | "polling" | "error: ..."
+        self.status: Dict[str, str] = {}
+        self._threads = []
+
+    # --- CICLO DE VIDA ---
+    def start(self):
+        if self._threads: return
+        for source in self.db._telemetry_sources():
+            t = threading.Thread(target=self._watch_source, args=(source,), name=f"live-{source['name']}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        self._stop.set()
+
+    # --- TABLA DE ÚLTIMO ESTADO ---
+    def _apply(self, raw_doc: Dict[str, Any]):
+        norm_doc = self.db._normalize_document(raw_doc)
+        dev_id, ts = norm_doc.get("device_id"), norm_doc.get("timestamp")
+        if not dev_id or dev_id == "unknown" or ts is None: return
+
+        with self._lock:
+            current = self._latest.get(dev_id)
+            if current and current[1]["timestamp"] >= ts: return
+            self.version += 1
+            self._latest[dev_id] = (self.version, norm_doc)
+
+    def latest(self, device_id: str) -> Optional[Tuple[int, Dict[str, Any]]]:
+        """(versión, doc normalizado) de la última lectura recibida, o None."""
+        return self._latest.get(device_id)
+
+    # --- CHANGE STREAMS ---
+    def _watch_source(self, source: Dict[str, Any]):
+        name = source["name"]
+        collection = source["client"][source["db"]][source["coll_telemetry"]]
+        resume_token = None
+        streamed = False
+
+        while not self._stop.is_set():
+            try:
+                with collection.watch(self.CHANGE_PIPELINE, full_document="updateLookup",
+                                      resume_after=resume_token, max_await_time_ms=1000) as stream:
+                    streamed = True
+                    self.status[name] = "change_stream"
+                    print(f"[live_feed] Fuente '{name}': escuchando change stream")
+                    while not self._stop.is_set() and stream.alive:
+                        change = stream.try_next()
+                        if change is None: continue
+                        resume_token = stream.resume_token
+                        if change.get("fullDocument"):
+                            self._apply(change["fullDocument"])
+            except Exception as e:
+                if not streamed:
+                    # La fuente no soporta change streams (standalone, permisos, etc.)
+                    print(f"[live_feed] Fuente '{name}' sin change streams ({str(e)[:80]}), usando polling")
+                    self._poll_source(source)
+                    return
+                self.status[name] = f"error: {str(e)[:100]}"
+                print(f"[live_feed] Change stream de '{name}' interrumpido: {e}")
+                self._stop.wait(self.RETRY_SECONDS)
+
+    # --- FALLBACK: POLLING POR WATERMARK ---
+    def _poll_source(self, source: Dict[str, Any]):
+        name = source["name"]
+        collection = source["client"][source["db"]][source["coll_telemetry"]]
+        self.status[name] = "polling"
+        last_id, initialized = None, False
+
+        while not self._stop.is_set():
+            try:
+                if not initialized:
+                    # Arrancar desde el documento más nuevo (el snapshot ya cubre el estado previo)
+                    newest = collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+                    last_id = newest["_id"] if newest else None
+                    initialized = True
+                    docs = []
+                else:
+                    query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+                    docs = list(collection.find(query).sort("_id", 1).limit(self.POLL_BATCH))
+                for doc in docs:
+                    self._apply(doc)
+                    last_id = doc["_id"]
+                self.status[name] = "polling"
+            except Exception as e:
+                self.status[name] = f"error: {str(e)[:100]}"
+                print(f"[live_feed] Polling de '{name}' falló: {e}")
+                docs = []
+            # Lote completo: seguir leyendo sin esperar
+            if len(docs) < self.POLL_BATCH:
+                self._stop.wait(self.POLL_SECONDS)
+
+
+@st.cache_resource(show_spinner=False)
+def get_live_feed() -> LiveFeed:
+    """Instancia única por proceso (compartida entre sesiones)."""
+    feed = LiveFeed(DatabaseConnection())
+    feed.start()
+    return feed
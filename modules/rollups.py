@@ -0,0 +1,292 @@
+import pandas as pd
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Any, Optional
+
+from modules.database import DatabaseConnection
+
+
+# Resoluciones disponibles: nombre -> tamaño del bucket (de fina a gruesa)
+RESOLUTIONS = {
+    "1min": timedelta(minutes=1),
+    "15min": timedelta(minutes=15),
+    "1h": timedelta(hours=1),
+}
+
+# Mínimo de puntos por serie para que una resolución se considere "suficiente"
+MIN_POINTS_PER_SERIES = 300
+
+# Sufijos de las columnas agregadas en formato ancho (la media queda con el nombre del sensor)
+ROLLUP_SUFFIXES = ("__min", "__max", "__count")
+
+CHILE_OFFSET_MS = 3 * 3600 * 1000
+
+
+def pick_resolution(window: Optional[timedelta], min_points: int = MIN_POINTS_PER_SERIES) -> Optional[str]:
+    """
+    Elige la resolución MÁS GRUESA que todavía entrega al menos min_points en la ventana.
+    Retorna None si ninguna alcanza (usar datos crudos).
+    """
+    if window is None: return None
+    for name in reversed(list(RESOLUTIONS)):
+        if window / RESOLUTIONS[name] >= min_points:
+            return name
+    return None
+
+
+def rollup_frame(df: pd.DataFrame, resolution: str, sensors: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Calcula el rollup (min/max/mean/count por dispositivo, sensor y bucket) de un DataFrame
+    plano normalizado (timestamp, device_id, <sensores>...), p.ej. el cache de gráficas o el archivo local.
+    Formato ancho: timestamp (inicio del bucket), device_id, <sensor>, <sensor>__min, <sensor>__max, <sensor>__count.
+    """
+    if df is None or df.empty or resolution not in RESOLUTIONS: return df
+
+    excluded = {'timestamp', 'device_id', 'location', 'device_name'}
+    if sensors is None:
+        sensors = [c for c in df.select_dtypes(include=['number']).columns if c not in excluded]
+    sensors = [s for s in sensors if s in df.columns]
+    if not sensors: return pd.DataFrame()
+
+    freq = pd.Timedelta(RESOLUTIONS[resolution])
+    bucket = df['timestamp'].dt.floor(freq)
+    grouped = df[sensors].groupby([df['device_id'], bucket])
+    agg = grouped.agg(['mean', 'min', 'max', 'count'])
+
+    out = pd.DataFrame(index=agg.index)
+    for s in sensors:
+        out[s] = agg[(s, 'mean')]
+        out[f"{s}__min"] = agg[(s, 'min')]
+        out[f"{s}__max"] = agg[(s, 'max')]
+        out[f"{s}__count"] = agg[(s, 'count')]
+    out = out.reset_index()
+
+    # Buckets sin datos para ningún sensor no aportan
+    return out[out[[f"{s}__count" for s in sensors]].sum(axis=1) > 0]
+
+
+class RollupManager:
+    """
+    Rollups materializados en MongoDB (colecciones <telemetría>_rollup_<res>) calculados con
+    $group + $merge y mantenidos de forma INCREMENTAL con un watermark por fuente y resolución.
+
+    Los buckets se calculan en hora local de Chile (UTC-3, igual que _normalize_document):
+    - timestamps Date o ISO con zona se convierten a hora local;
+    - timestamps ISO sin zona se consideran ya locales.
+    Solo se materializa en fuentes con escritura habilitada.
+    """
+
+    STATE_COLLECTION = "telemetry_rollup_state"
+
+    # Margen para cubrir el desfase UTC/local al filtrar por timestamp crudo
+    MATCH_MARGIN = timedelta(hours=6)
+
+    # El watermark queda este margen antes del timestamp más nuevo procesado: los documentos
+    # que llegan atrasados dentro del margen se cuentan en la siguiente corrida
+    LATE_OVERLAP = timedelta(hours=1)
+
+    def __init__(self, db: DatabaseConnection):
+        self.db = db
+
+    @staticmethod
+    def collection_name(source: Dict[str, Any], resolution: str) -> str:
+        return f"{source['coll_telemetry']}_rollup_{resolution}"
+
+    # --- PIPELINE ---
+    @staticmethod
+    def _local_ts_expr() -> Dict[str, Any]:
+        """Expresión que lleva el timestamp crudo (Date / ISO / epoch) a hora local de Chile."""
+        ts = "$timestamp"
+        return {"$switch": {
+            "branches": [
+                {"case": {"$eq": [{"$type": ts}, "date"]},
+                 "then": {"$subtract": [ts, CHILE_OFFSET_MS]}},
+                {"case": {"$eq": [{"$type": ts}, "string"]},
+                 "then": {"$let": {
+                     "vars": {"d": {"$convert": {"input": ts, "to": "date", "onError": None, "onNull": None}}},
+                     "in": {"$cond": [
+                         {"$regexMatch": {"input": ts, "regex": r"(Z|[+-]\d{2}:?\d{2})$"}},
+                         {"$subtract": ["$$d", CHILE_OFFSET_MS]},
+                         "$$d"
+                     ]}
+                 }}},
+                {"case": {"$in": [{"$type": ts}, ["double", "int", "long", "decimal"]]},
+                 "then": {"$subtract": [
+                     {"$toDate": {"$cond": [{"$gt": [ts, 1e11]}, ts, {"$multiply": [ts, 1000]}]}},
+                     CHILE_OFFSET_MS
+                 ]}}
+            ],
+            "default": None
+        }}
+
+    @staticmethod
+    def _sensor_key_expr() -> Dict[str, Any]:
+        """Mismos alias que el adapter: temp/temperatura -> temperature, oxigeno/od/do -> oxygen."""
+        key = {"$toLower": {"$trim": {"input": "$kv.k"}}}
+        return {"$let": {"vars": {"k": key}, "in": {"$switch": {
+            "branches": [
+                {"case": {"$in": ["$$k", ["temp", "temperatura"]]}, "then": "temperature"},
+                {"case": {"$in": ["$$k", ["oxigeno", "od", "do"]]}, "then": "oxygen"},
+            ],
+            "default": "$$k"
+        }}}}
+
+    def build_pipeline(self, source: Dict[str, Any], resolution: str, since_local: Optional[datetime]) -> List[Dict[str, Any]]:
+        """Pipeline $group + $merge para una fuente y resolución, desde el bucket since_local (hora local)."""
+        size = RESOLUTIONS[resolution]
+        unit, bin_size = ("hour", int(size / timedelta(hours=1))) if size >= timedelta(hours=1) \
+            else ("minute", int(size / timedelta(minutes=1)))
+
+        pipeline = []
+        if since_local is not None:
+            raw_from = since_local - self.MATCH_MARGIN
+            # Instante absoluto (UTC) del límite: no depende de la zona horaria del servidor
+            raw_from_utc = (raw_from + timedelta(milliseconds=CHILE_OFFSET_MS)).replace(tzinfo=timezone.utc)
+            epoch_ms = raw_from_utc.timestamp() * 1000
+            pipeline.append({"$match": {"$or": [
+                {"timestamp": {"$gte": raw_from_utc}},
+                {"timestamp": {"$gte": raw_from.isoformat()}},
+                # Epoch en segundos (< 1e11, igual que _local_ts_expr) y en milisegundos
+                {"timestamp": {"$gte": epoch_ms / 1000, "$lt": 1e11}},
+                {"timestamp": {"$gte": epoch_ms}},
+            ]}})
+
+        pipeline += [
+            {"$project": {
+                "_id": 0,
+                "device_id": DatabaseConnection.DEVICE_KEY_EXPR,
+                "ts": self._local_ts_expr(),
+                "kv": {"$objectToArray": {"$ifNull": ["$sensors", {"$ifNull": ["$datos", {}]}]}}
+            }},
+            {"$match": {"ts": {"$ne": None}, "device_id": {"$ne": None}}},
+            {"$unwind": "$kv"},
+            {"$project": {
+                "device_id": 1,
+                "sensor": self._sensor_key_expr(),
+                "bucket": {"$dateTrunc": {"date": "$ts", "unit": unit, "binSize": bin_size}},
+                # Igual que el adapter: {value: x} -> float(x); número plano -> float; bool/string plano -> ignorado
+                "value": {"$switch": {
+                    "branches": [
+                        {"case": {"$eq": [{"$type": "$kv.v"}, "object"]},
+                         "then": {"$convert": {"input": "$kv.v.value", "to": "double", "onError": None, "onNull": None}}},
+                        {"case": {"$in": [{"$type": "$kv.v"}, ["double", "int", "long", "decimal"]]},
+                         "then": {"$toDouble": "$kv.v"}}
+                    ],
+                    "default": None
+                }}
+            }},
+            {"$match": {"value": {"$ne": None}}},
+        ]
+        if since_local is not None:
+            # Solo buckets cubiertos COMPLETOS por el $match (evita reemplazar buckets con datos parciales)
+            pipeline.append({"$match": {"bucket": {"$gte": since_local}}})
+
+        pipeline += [
+            {"$group": {
+                "_id": {"device_id": "$device_id", "sensor": "$sensor", "bucket": "$bucket"},
+                "min": {"$min": "$value"},
+                "max": {"$max": "$value"},
+                "sum": {"$sum": "$value"},
+                "count": {"$sum": 1}
+            }},
+            {"$merge": {
+                "into": self.collection_name(source, resolution),
+                "on": "_id",
+                "whenMatched": "replace",
+                "whenNotMatched": "insert"
+            }}
+        ]
+        return pipeline
+
+    # --- MANTENIMIENTO INCREMENTAL ---
+    @staticmethod
+    def _newest_local(collection) -> Optional[datetime]:
+        """Timestamp más nuevo de la colección (hora local naive); cada tipo BSON se ordena por separado."""
+        newest = None
+        for bson_type in ("date", "string", "number"):
+            doc = collection.find_one({"timestamp": {"$type": bson_type}}, {"timestamp": 1}, sort=[("timestamp", -1)])
+            ts = DatabaseConnection._parse_timestamp(doc["timestamp"]) if doc else None
+            if ts is not None and (newest is None or ts > newest):
+                newest = ts
+        return newest
+
+    def refresh(self, resolutions: Optional[List[str]] = None, full: bool = False) -> Dict[str, Dict[str, str]]:
+        """
+        Actualiza los rollups de todas las fuentes escribibles (en paralelo).
+        Cada corrida recalcula desde el inicio del bucket del watermark anterior, por lo que
+        el último bucket (posiblemente incompleto) se recalcula entero. El watermark es el
+        timestamp más nuevo procesado (sin pasar de ahora) menos LATE_OVERLAP.
+        Retorna {fuente: {resolución: "ok" | "error: ..."}}.
+        """
+        resolutions = resolutions or list(RESOLUTIONS)
+        now_local = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(milliseconds=CHILE_OFFSET_MS)
+
+        def refresh_source(source):
+            database = source["client"][source["db"]]
+            state = database[self.STATE_COLLECTION]
+            report = {}
+            for res in resolutions:
+                state_id = f"{source['coll_telemetry']}:{res}"
+                since = None
+                if not full:
+                    doc = state.find_one({"_id": state_id})
+                    if doc and doc.get("watermark"):
+                        mark = pd.Timestamp(doc["watermark"].replace(tzinfo=None))
+                        since = mark.floor(pd.Timedelta(RESOLUTIONS[res])).to_pydatetime()
+                try:
+                    telemetry = database[source["coll_telemetry"]]
+                    # Antes de agregar: todo lo que sea a lo más así de nuevo entra en esta corrida
+                    newest = self._newest_local(telemetry)
+                    pipeline = self.build_pipeline(source, res, since)
+                    list(telemetry.aggregate(pipeline, allowDiskUse=True))
+                    if newest is not None:
+                        mark = min(newest, now_local) - self.LATE_OVERLAP
+                        state.replace_one({"_id": state_id}, {"_id": state_id, "watermark": mark}, upsert=True)
+                    report[res] = "ok"
+                except Exception as e:
+                    report[res] = f"error: {str(e)[:100]}"
+                    print(f"[rollups] Error en {source['name']} ({res}): {e}")
+            return report
+
+        sources = [s for s in self.db._telemetry_sources() if s["writable"]]
+        return {s["name"]: rep for s, rep in self.db.fan_out(refresh_source, sources, timeout=None)}
+
+    # --- LECTURA ---
+    def fetch(self, resolution: str, start: datetime, end: datetime,
+              devices: Optional[List[str]] = None, sensors: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Lee los rollups materializados de todas las fuentes (hora local naive) en el mismo
+        formato ancho que rollup_frame. Si un dispositivo aparece en varias fuentes, se combinan.
+        """
+        query = {"_id.bucket": {"$gte": start, "$lte": end}}
+        if devices: query["_id.device_id"] = {"$in": list(devices)}
+        if sensors: query["_id.sensor"] = {"$in": list(sensors)}
+
+        def load_rollup(source):
+            coll = source["client"][source["db"]][self.collection_name(source, resolution)]
+            return list(coll.find(query))
+
+        rows = []
+        for _, docs in self.db.fan_out(load_rollup, self.db._telemetry_sources()):
+            for d in docs:
+                key = d["_id"]
+                rows.append({
+                    "device_id": key["device_id"], "sensor": key["sensor"], "timestamp": key["bucket"],
+                    "min": d["min"], "max": d["max"], "sum": d["sum"], "count": d["count"]
+                })
+        if not rows: return pd.DataFrame()
+
+        long_df = pd.DataFrame(rows)
+        long_df["timestamp"] = pd.to_datetime(long_df["timestamp"], utc=True).dt.tz_localize(None)
+        long_df = long_df.groupby(["device_id", "timestamp", "sensor"]).agg(
+            min=("min", "min"), max=("max", "max"), sum=("sum", "sum"), count=("count", "sum")
+        )
+        long_df["mean"] = long_df["sum"] / long_df["count"]
+
+        wide = long_df[["mean", "min", "max", "count"]].unstack("sensor")
+        out = pd.DataFrame(index=wide.index)
+        for s in wide.columns.get_level_values(1).unique():
+            out[s] = wide[("mean", s)]
+            out[f"{s}__min"] = wide[("min", s)]
+            out[f"{s}__max"] = wide[("max", s)]
+            out[f"{s}__count"] = wide[("count", s)]
+        return out.reset_index().sort_values("timestamp")
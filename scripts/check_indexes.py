@@ -0,0 +1,49 @@
+import os
+import sys
+import argparse
+from dotenv import load_dotenv
+
+# Add root to pythonpath
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from modules.database import DatabaseConnection
+from modules.index_advisor import IndexAdvisor
+
+
+def check_indexes(create=False):
+    """
+    Revisa los índices de telemetría de cada fuente y ejecuta explain() sobre
+    las consultas de la app. Con --create crea los índices faltantes (solo fuentes escribibles).
+    """
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    load_dotenv(dotenv_path=os.path.join(root_dir, '.env'), override=True)
+
+    print("--- REVISIÓN DE ÍNDICES Y PLANES DE CONSULTA ---")
+    db = DatabaseConnection()
+    report = IndexAdvisor(db).report(create=create)
+
+    if not report:
+        print("  -> No hay fuentes de telemetría configuradas.")
+    for source, result in report.items():
+        idx = result["indexes"]
+        print(f"\n[{source}]")
+        for spec in idx["created"]: print(f"  Índice creado: {spec}")
+        for spec in idx["missing"]: print(f"  FALTA índice: {spec}")
+        for err in idx["errors"]: print(f"  Error de índice: {err}")
+
+        print(f"  {'consulta':<22} {'docs':>9} {'keys':>9} {'result':>8} {'ms':>6}  alertas")
+        for q in result["queries"]:
+            if "error" in q:
+                print(f"  {q['name']:<22} ERROR: {q['error']}")
+                continue
+            alertas = []
+            if q["collscan"]: alertas.append("COLLSCAN")
+            if q["in_memory_sort"]: alertas.append("SORT EN MEMORIA")
+            print(f"  {q['name']:<22} {q['docs_examined']:>9} {q['keys_examined']:>9} {q['returned']:>8} {q['millis']:>6}  {', '.join(alertas) or 'ok'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Revisa índices de telemetría y planes de consulta")
+    parser.add_argument("--create", action="store_true", help="Crear índices faltantes en fuentes escribibles")
+    args = parser.parse_args()
+    check_indexes(args.create)
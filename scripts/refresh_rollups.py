@@ -0,0 +1,38 @@
+import os
+import sys
+import argparse
+from dotenv import load_dotenv
+
+# Add root to pythonpath
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from modules.database import DatabaseConnection
+from modules.rollups import RollupManager, RESOLUTIONS
+
+
+def refresh_rollups(resolutions=None, full=False):
+    """
+    Actualiza los rollups materializados (1min / 15min / 1h) en las fuentes con escritura.
+    Pensado para ejecutarse periódicamente (cron / tarea programada): cada corrida solo
+    procesa los datos nuevos desde el último watermark.
+    """
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    load_dotenv(dotenv_path=os.path.join(root_dir, '.env'), override=True)
+
+    print("--- ACTUALIZANDO ROLLUPS ---")
+    db = DatabaseConnection()
+    report = RollupManager(db).refresh(resolutions=resolutions, full=full)
+
+    if not report:
+        print("  -> No hay fuentes con escritura habilitada.")
+    for source, results in report.items():
+        for res, status in results.items():
+            print(f"  [{source}] {res}: {status}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Actualiza los rollups de telemetría")
+    parser.add_argument("--full", action="store_true", help="Recalcular todo el histórico")
+    parser.add_argument("--res", nargs="+", choices=list(RESOLUTIONS), help="Resoluciones a actualizar")
+    args = parser.parse_args()
+    refresh_rollups(args.res, args.full)
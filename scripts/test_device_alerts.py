@@ -0,0 +1,58 @@
+"""
+Script de verificación de alertas en el refresco de una tarjeta
+Inserta en la fuente principal (escribible) una lectura de un dispositivo de prueba con alertas
+explícitas, refresca esa tarjeta como lo hace el botón "Actualizar" y verifica que el dispositivo
+queda CRITICAL. La lectura de prueba se elimina al terminar.
+"""
+import os
+import sys
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+
+# Add root to pythonpath
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from modules.database import DatabaseConnection
+from modules.device_manager import HealthStatus
+from modules.fleet_snapshot import FleetSnapshot
+
+load_dotenv()
+
+TEST_DEVICE_ID = "test_alerts_refresh"
+
+def test_refresh_keeps_alerts():
+    print("=" * 60)
+    print("VERIFICACIÓN DE ALERTAS AL REFRESCAR UNA TARJETA")
+    print("=" * 60)
+
+    db = DatabaseConnection()
+    source = next((s for s in db._telemetry_sources() if s["writable"]), None)
+    if source is None:
+        print("  → No hay fuente de telemetría escribible configurada")
+        return
+
+    collection = source["client"][source["db"]][source["coll_telemetry"]]
+    inserted = collection.insert_one({
+        "device_id": TEST_DEVICE_ID,
+        "timestamp": datetime.now(timezone.utc),
+        "sensors": {"temperature": {"value": 25.0}},
+        "alerts": ["Falla de bomba"],
+    })
+    try:
+        doc = db.get_latest_doc(TEST_DEVICE_ID)
+        assert doc and doc["alerts"] == ["Falla de bomba"], f"get_latest_doc perdió las alertas: {doc}"
+        print(f"  ✓ get_latest_doc trae las alertas: {doc['alerts']}")
+
+        status, info = FleetSnapshot().refresh_device(TEST_DEVICE_ID)
+        assert status == "updated" and info is not None, f"refresh_device: {status}"
+        assert info.health == HealthStatus.CRITICAL, f"se esperaba CRITICAL, quedó {info.health}"
+        print(f"  ✓ refresh_device: {info.device_id} -> {info.health.value}")
+    finally:
+        collection.delete_one({"_id": inserted.inserted_id})
+
+    print("=" * 60)
+    print("VERIFICACIÓN COMPLETADA")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    test_refresh_keeps_alerts()
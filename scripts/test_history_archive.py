@@ -0,0 +1,61 @@
+"""
+Script de verificación del archivo histórico local (Parquet)
+Verifica que un día reciente no se congela en el archivo antes de CLOSE_LAG_DAYS: un documento
+que llega atrasado para ese día queda incluido cuando el día finalmente se archiva.
+No requiere MongoDB (usa un directorio temporal).
+"""
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+# Add root to pythonpath
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from modules.history_archive import HistoryArchive
+
+
+def test_late_document():
+    print("=" * 60)
+    print("VERIFICACIÓN DE DATOS ATRASADOS EN EL ARCHIVO")
+    print("=" * 60)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        archive = HistoryArchive(tmp)
+        if not archive.enabled:
+            print("  → pyarrow no disponible: archivo deshabilitado, nada que verificar")
+            return
+
+        hoy = archive.today_local()
+        ayer = hoy - timedelta(days=1)
+        inicio_ayer = datetime.combine(ayer, datetime.min.time())
+
+        # 1. Ayer sigue abierto: no se archiva aunque se intente
+        a_tiempo = pd.DataFrame([{"timestamp": inicio_ayer + timedelta(hours=8), "device_id": "dev1", "ph": 7.0}])
+        assert not archive.is_closed(ayer), "ayer no debe estar cerrado"
+        assert archive.missing_closed_days([ayer]) == []
+        archive.write_days(a_tiempo, [ayer])
+        assert ayer not in archive.archived_days(), "ayer se archivó antes de tiempo"
+        print(f"  ✓ {ayer} queda abierto (CLOSE_LAG_DAYS={archive.CLOSE_LAG_DAYS})")
+
+        # 2. Llega un documento atrasado de ayer (buffer del dispositivo / réplica)
+        atrasado = pd.DataFrame([{"timestamp": inicio_ayer + timedelta(hours=23), "device_id": "dev1", "ph": 7.4}])
+        completo = pd.concat([a_tiempo, atrasado], ignore_index=True)
+
+        # 3. Pasan los días de gracia: el día se cierra y se archiva con ambos documentos
+        archive.today_local = lambda: hoy + timedelta(days=archive.CLOSE_LAG_DAYS)
+        assert archive.missing_closed_days([ayer]) == [ayer]
+        assert archive.write_days(completo, [ayer])
+        leidos = archive.read_range(inicio_ayer, inicio_ayer + timedelta(days=1), ["dev1"])
+        assert len(leidos) == 2, f"se esperaban 2 lecturas archivadas, hay {len(leidos)}"
+        print(f"  ✓ {ayer} archivado con el documento atrasado ({len(leidos)} lecturas)")
+
+    print("=" * 60)
+    print("VERIFICACIÓN COMPLETADA")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    test_late_document()
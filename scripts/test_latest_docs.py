@@ -0,0 +1,50 @@
+"""
+Script de verificación del 'último documento por dispositivo'
+Ejecuta explain() de las agregaciones del dashboard sobre cada fuente configurada y verifica que,
+con el índice {campo, timestamp}, se resuelven con DISTINCT_SCAN (sin COLLSCAN ni sort en memoria).
+"""
+import os
+import sys
+from dotenv import load_dotenv
+
+# Add root to pythonpath
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from modules.database import DatabaseConnection
+from modules.index_advisor import IndexAdvisor
+
+load_dotenv()
+
+def test_latest_docs_plan():
+    print("=" * 60)
+    print("VERIFICACIÓN DE PLANES 'ÚLTIMO POR DISPOSITIVO'")
+    print("=" * 60)
+
+    db = DatabaseConnection()
+    advisor = IndexAdvisor(db)
+
+    for source in db._telemetry_sources():
+        collection = source["client"][source["db"]][source["coll_telemetry"]]
+        indexed = db._indexed_key_fields(collection)
+        print(f"\n[{source['name']}] campos indexados: {sorted(indexed) or 'ninguno'}")
+
+        for field in db.DEVICE_KEY_FIELDS:
+            if field not in indexed:
+                print(f"  → {field}: sin índice {{{field}, timestamp}} (se usa la ventana acotada)")
+                continue
+
+            shape = {"kind": "aggregate", "pipeline": db._latest_docs_pipeline(field)}
+            plan = advisor.explain(source, shape)
+            print(f"  → {field}: etapas {plan['stages']} | docs {plan['docs_examined']} | keys {plan['keys_examined']}")
+
+            assert "DISTINCT_SCAN" in plan["stages"], f"{source['name']}.{field}: no usa DISTINCT_SCAN"
+            assert not plan["collscan"], f"{source['name']}.{field}: COLLSCAN"
+            assert "SORT" not in plan["stages"], f"{source['name']}.{field}: sort en memoria"
+            print(f"  ✓ {field}: plan por índice")
+
+    print("\n" + "=" * 60)
+    print("VERIFICACIÓN COMPLETADA")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    test_latest_docs_plan()
@@ -1,13 +1,17 @@
+import os
 import streamlit as st
 import pandas as pd
+import time
 from datetime import datetime
 from typing import List, Dict
 import re
+from functools import lru_cache
 
 from modules.database import DatabaseConnection
 from modules.config_manager import ConfigManager
-from modules.sensor_registry import SensorRegistry
-from modules.device_manager import DeviceManager, ConnectionStatus, HealthStatus, DeviceInfo
+from modules.device_manager import ConnectionStatus, HealthStatus, DeviceInfo
+from modules.fleet_snapshot import get_fleet_snapshot, FleetSnapshot
+from modules.live_feed import get_live_feed
 
 # --- SVGs CONSTANTS ---
 ICON_LOC = '<svg xmlns="http://www.w3.org/2000/svg" width="14" height="14" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2" stroke-linecap="round" stroke-linejoin="round" style="vertical-align: text-bottom; margin-right: 2px;"><path d="M20 10c0 6-8 12-8 12s-8-6-8-12a8 8 0 0 1 16 0Z"/><circle cx="12" cy="10" r="3"/></svg>'
@@ -24,88 +28,92 @@ def initialize_dashboard_state():
 def clean_html(html_str):
     return re.sub(r'\n\s+', ' ', html_str).strip()
 
+# CSS de tarjetas: se limpia UNA vez al importar (Streamlit exige re-emitirlo en cada rerun completo,
+# pero así cada rerun envía la versión compacta y sin trabajo de regex)
+DASHBOARD_CSS = clean_html("""
+<style>
+/* TARJETA: Contenedor principal con altura fija */
+.device-card {
+    background: white;
+    border-radius: 16px;
+    border: 1px solid #e2e8f0;
+    overflow: hidden;
+    box-shadow: 0 4px 6px -1px rgba(0,0,0,0.05), 0 2px 4px -1px rgba(0,0,0,0.03);
+    margin-bottom: 1rem;
+    min-height: 320px;
+    display: flex;
+    flex-direction: column;
+}
+
+/* TARJETA: Header */
+.device-card-header {
+    padding: 0.875rem 1rem;
+    display: flex;
+    justify-content: space-between;
+    align-items: center;
+}
+
+/* TARJETA: Cuerpo con altura fija */
+.device-card-body {
+    padding: 1rem;
+    flex: 1;
+    display: flex;
+    flex-direction: column;
+}
+
+/* TARJETA: Grid de sensores con altura fija */
+.sensor-grid {
+    display: grid;
+    grid-template-columns: 1fr 1fr;
+    gap: 0.625rem;
+    min-height: 145px;
+}
+
+/* TARJETA: Celda de sensor */
+.sensor-cell {
+    background: #f8fafc;
+    border: 1px solid #e2e8f0;
+    border-radius: 10px;
+    padding: 0.625rem 0.5rem;
+    text-align: center;
+}
+
+/* TARJETA: Footer */
+.device-card-footer {
+    margin-top: auto;
+    padding-top: 0.5rem;
+    border-top: 1px solid #f1f5f9;
+    display: flex;
+    justify-content: space-between;
+    align-items: center;
+    color: #94a3b8;
+    font-size: 0.65rem;
+}
+
+/* BOTON: Estilos base para todos los botones de tarjeta */
+div[data-testid="stColumn"] > div > div > div > div[data-testid="stButton"] button {
+    background: linear-gradient(135deg, #f8fafc 0%, #f1f5f9 100%) !important;
+    border: 1px solid #e2e8f0 !important;
+    border-radius: 12px !important;
+    color: #64748b !important;
+    font-weight: 600 !important;
+    padding: 10px 16px !important;
+    margin-top: 0.5rem !important;
+    transition: all 0.15s ease !important;
+}
+
+div[data-testid="stColumn"] > div > div > div > div[data-testid="stButton"] button:hover {
+    background: linear-gradient(135deg, #e0f2fe 0%, #bae6fd 100%) !important;
+    color: #0284c7 !important;
+}
+</style>
+""")
+
 def show_view():
     initialize_dashboard_state()
     
-    # --- CSS Global para tarjetas ---
-    st.markdown("""
-    <style>
-    /* TARJETA: Contenedor principal con altura fija */
-    .device-card {
-        background: white;
-        border-radius: 16px;
-        border: 1px solid #e2e8f0;
-        overflow: hidden;
-        box-shadow: 0 4px 6px -1px rgba(0,0,0,0.05), 0 2px 4px -1px rgba(0,0,0,0.03);
-        margin-bottom: 1rem;
-        min-height: 320px;
-        display: flex;
-        flex-direction: column;
-    }
-    
-    /* TARJETA: Header */
-    .device-card-header {
-        padding: 0.875rem 1rem;
-        display: flex;
-        justify-content: space-between;
-        align-items: center;
-    }
-    
-    /* TARJETA: Cuerpo con altura fija */
-    .device-card-body {
-        padding: 1rem;
-        flex: 1;
-        display: flex;
-        flex-direction: column;
-    }
-    
-    /* TARJETA: Grid de sensores con altura fija */
-    .sensor-grid {
-        display: grid;
-        grid-template-columns: 1fr 1fr;
-        gap: 0.625rem;
-        min-height: 145px;
-    }
-    
-    /* TARJETA: Celda de sensor */
-    .sensor-cell {
-        background: #f8fafc;
-        border: 1px solid #e2e8f0;
-        border-radius: 10px;
-        padding: 0.625rem 0.5rem;
-        text-align: center;
-    }
-    
-    /* TARJETA: Footer */
-    .device-card-footer {
-        margin-top: auto;
-        padding-top: 0.5rem;
-        border-top: 1px solid #f1f5f9;
-        display: flex;
-        justify-content: space-between;
-        align-items: center;
-        color: #94a3b8;
-        font-size: 0.65rem;
-    }
-    
-    /* BOTON: Estilos base para todos los botones de tarjeta */
-    div[data-testid="stColumn"] > div > div > div > div[data-testid="stButton"] button {
-        background: linear-gradient(135deg, #f8fafc 0%, #f1f5f9 100%) !important;
-        border: 1px solid #e2e8f0 !important;
-        border-radius: 12px !important;
-        color: #64748b !important;
-        font-weight: 600 !important;
-        padding: 10px 16px !important;
-        margin-top: 0.5rem !important;
-        transition: all 0.15s ease !important;
-    }
-    
-    div[data-testid="stColumn"] > div > div > div > div[data-testid="stButton"] button:hover {
-        background: linear-gradient(135deg, #e0f2fe 0%, #bae6fd 100%) !important;
-        color: #0284c7 !important;
-    }
-    </style>
-    """, unsafe_allow_html=True)
+    # --- CSS Global para tarjetas (precompilado al importar) ---
+    st.markdown(DASHBOARD_CSS, unsafe_allow_html=True)
     
     # --- Database Connection ---
     db = None
@@ -115,86 +123,90 @@ def show_view():
     try:
         db = DatabaseConnection()
         config_manager = ConfigManager(db)
-        thresholds = config_manager.get_all_configured_sensors()
+        fleet = get_fleet_snapshot()
     except Exception as e:
         st.error(f"Error Database Connection: {e}")
         return
 
     # --- Toolbar ---
-    c1, c2 = st.columns([6, 1])
+    c1, c_auto, c2 = st.columns([5, 1, 1])
     with c1:
         st.subheader("Vista General de Dispositivos")
+    with c_auto:
+        auto_refresh = st.toggle(
+            "Auto",
+            value=True,
+            key="dashboard_auto_refresh",
+            help="Modo pantalla: se actualiza solo. Las tarjetas toman las lecturas en vivo y la vista completa se recarga solo si cambian estados o KPIs. Apagado no se consulta nada hasta pulsar Actualizar."
+        )
     with c2:
         if st.button("Actualizar Todo", type="primary"):
-            # Limpiar caches para forzar recarga completa
+            # Pedir un snapshot nuevo al refresco compartido y limpiar caches de tarjetas
+            with st.spinner("Actualizando..."):
+                fleet.request_refresh()
             keys_to_delete = [k for k in st.session_state.keys() if k.startswith('live_data_')]
             for k in keys_to_delete:
                 del st.session_state[k]
             st.rerun()
     
     # --- Data Loading ---
-    all_devices = []
+    # Snapshot compartido entre sesiones: lecturas, umbrales y DeviceInfo ya evaluados
+    # por el refresco en segundo plano (sin consultas a Mongo por sesión)
+    snapshot = fleet.get()
+    if snapshot["error"] and not snapshot["devices"]:
+        st.error(f"Error fetching devices: {snapshot['error']}")
+        return
     
-    # CORREGIR: No usar estados previos al entrar al dashboard (causan estados incorrectos)
-    # Forzar recalculo completo cada vez para evitar mostrar estados stale
-    if 'device_health_states' in st.session_state:
-        del st.session_state['device_health_states']
+    thresholds = snapshot["thresholds"]
+    st.session_state['device_health_states'] = dict(snapshot["health_states"])
     
-    try:
-        df = db.get_latest_by_device()
-        prev_states = {}  # Siempre vacío para forzar actualización
-        
-        if df is None or df.empty:
-            all_devices = []
-        else:
-            try:
-                detected = SensorRegistry.discover_sensors_from_dataframe(df)
-                config_manager.sync_with_detected_sensors(detected)
-                global_thresholds = config_manager.get_all_configured_sensors() 
-                thresholds = global_thresholds
-                
-                all_meta = config_manager.get_device_metadata()
-                dev_specifics = {k: v.get('thresholds', {}) for k, v in all_meta.items()}
-                device_manager = DeviceManager(global_thresholds, prev_states, dev_specifics)
-            except: 
-                device_manager = DeviceManager(thresholds, prev_states)
-            
-            all_devices = device_manager.get_all_devices_info(df)
-            st.session_state['device_health_states'] = device_manager.get_health_states()
-
-    except Exception as e:
-        st.error(f"Error fetching devices: {str(e)}")
-        return
+    antiguedad = max(0, int(time.time() - snapshot["updated_at"]))
+    st.caption(f"Datos actualizados hace {antiguedad} s (refresco automático cada {int(fleet.refresh_seconds)} s)")
     
-    render_dashboard_content(all_devices, thresholds, config_manager)
+    render_dashboard_content(snapshot["view"], thresholds, config_manager, live=auto_refresh)
+    
+    if auto_refresh:
+        render_auto_refresh_watch(snapshot["view"].layout_version)
 
 
-def render_dashboard_content(all_devices, thresholds, config_manager):
-    """Renderiza el contenido del dashboard (KPIs, filtros, grid)"""
+def render_dashboard_content(view, thresholds, config_manager, live: bool = True):
+    """Renderiza el contenido del dashboard (KPIs, filtros, grid) a partir del FleetView del snapshot"""
     # --- KPI Cards ---
-    device_manager = DeviceManager(thresholds, {})
-    render_summary_metrics(device_manager, all_devices)
+    # Conteos precalculados por el snapshot (no se recorren todos los dispositivos por sesión)
+    render_summary_metrics(view.kpis)
     
     st.markdown("<br>", unsafe_allow_html=True)
     
+    # Alias/ubicaciones personalizados: re-indexar la vista solo si cambiaron desde el snapshot
+    if config_manager and view.metadata_version != ConfigManager.devices_version():
+        version = ConfigManager.devices_version()
+        view.sync_metadata(config_manager.get_device_metadata(), version)
+    
     # --- Filters ---
     with st.container(border=True):
         st.markdown("<div style='margin-bottom: 10px; font-weight: 600; color: #64748b; font-size: 0.9rem; display: flex; align-items: center; gap: 6px;'><svg xmlns='http://www.w3.org/2000/svg' width='16' height='16' viewBox='0 0 24 24' fill='none' stroke='currentColor' stroke-width='2' stroke-linecap='round' stroke-linejoin='round'><circle cx='11' cy='11' r='8'/><path d='m21 21-4.3-4.3'/></svg> Filtros y Búsqueda</div>", unsafe_allow_html=True)
-        filtered_devices = render_filters(all_devices, config_manager)
+        filters = render_filters(view)
     
     st.markdown("<br>", unsafe_allow_html=True)
     
     # --- Grid ---
-    if not all_devices and not filtered_devices:
+    if not view.devices:
          render_empty_state()
          return
-         
-    if not filtered_devices and all_devices:
-        st.info("No se encontraron dispositivos con los filtros actuales.")
-        return
         
-    render_device_grid(filtered_devices, thresholds, config_manager)
+    render_device_grid(view, filters, thresholds, config_manager, live)
+
 
+# Intervalo del modo auto (mismo que el refresco del snapshot)
+AUTO_REFRESH_SECONDS = float(os.getenv("FLEET_REFRESH_SECONDS") or FleetSnapshot.DEFAULT_REFRESH_SECONDS)
+
+# Intervalo de las tarjetas en vivo, separado del polling del LiveFeed: cada tarjeta visible de
+# cada sesión se re-ejecuta a este ritmo. Cada re-ejecución solo lee LiveFeed.latest() y, sin
+# lecturas nuevas, reutiliza el HTML memoizado de _render_card; para pantallas que deben reflejar
+# los datos al segundo se puede bajar hasta CARD_REFRESH_MIN_SECONDS
+CARD_REFRESH_MIN_SECONDS = 1.0
+CARD_REFRESH_DEFAULT_SECONDS = 5.0
+CARD_REFRESH_SECONDS = max(CARD_REFRESH_MIN_SECONDS, float(os.getenv("DASHBOARD_CARD_REFRESH_SECONDS") or CARD_REFRESH_DEFAULT_SECONDS))
 
 # Import fragment with fallback
 try:
@@ -203,26 +215,60 @@ except ImportError:
     try:
         from streamlit import experimental_fragment as fragment
     except ImportError:
-        def fragment(func):
-            return func
+        def fragment(func=None, **kwargs):
+            return func if func is not None else (lambda f: f)
 
 
-@fragment
-def render_live_device_card(device_obj: DeviceInfo, thresholds: Dict, config_manager: ConfigManager):
+@fragment(run_every=AUTO_REFRESH_SECONDS)
+def render_auto_refresh_watch(layout_version: int):
+    """
+    Temporizador del modo auto: el snapshot se mantiene al día con la sonda de cambios
+    (probe_changes) y cada tarjeta toma sus propios cambios; aquí solo se fuerza un rerun
+    completo cuando cambian estados o la composición de la flota (KPIs, filtros).
+    """
+    if get_fleet_snapshot().get()["view"].layout_version != layout_version:
+        st.rerun()
+
+
+def _device_card(device_obj: DeviceInfo, thresholds: Dict, config_manager: ConfigManager, device_meta: Dict = None):
     """
     Renderiza la tarjeta con actualizacion PARCIAL gracias a @fragment.
+    En modo auto se re-ejecuta cada CARD_REFRESH_SECONDS y toma la última lectura del LiveFeed
+    (change streams / polling) sin consultar Mongo.
     Incluye paginacion minimalista para sensores.
+    device_meta: alias/ubicación ya resueltos para toda la página (get_device_infos).
     """
     dev_id = device_obj.device_id
     state_key = f"live_data_{dev_id}"
+    live_key = f"live_data_ver_{dev_id}"
     page_key = f"sensor_page_{dev_id}"
     
-    # Inicializar estados
-    if state_key not in st.session_state:
+    # Versión más reciente del dispositivo en el snapshot compartido (sonda de cambios)
+    try:
+        device_obj = get_fleet_snapshot().get()["view"].by_id.get(dev_id) or device_obj
+    except Exception as e:
+        print(f"[dashboard] Snapshot no disponible para {dev_id}: {e}")
+    
+    # Inicializar estados (o tomar el snapshot si es más nuevo / cambió de estado)
+    shown = st.session_state.get(state_key)
+    if shown is None or (device_obj.last_update and (shown.last_update is None or device_obj.last_update > shown.last_update)) \
+            or (device_obj.last_update == shown.last_update and (device_obj.connection, device_obj.health) != (shown.connection, shown.health)):
         st.session_state[state_key] = device_obj
     if page_key not in st.session_state:
         st.session_state[page_key] = 0
     
+    # --- ACTUALIZACION EN VIVO ---
+    try:
+        live = get_live_feed().latest(dev_id)
+        if live and live[0] != st.session_state.get(live_key):
+            st.session_state[live_key] = live[0]
+            shown = st.session_state[state_key]
+            if shown.last_update is None or live[1]["timestamp"] > shown.last_update:
+                info = get_fleet_snapshot().evaluate_doc(live[1], st.session_state.get('device_health_states', {}))
+                if info: st.session_state[state_key] = info
+    except Exception as e:
+        print(f"[dashboard] Live feed no disponible para {dev_id}: {e}")
+    
     current_device = st.session_state[state_key]
     current_page = st.session_state[page_key]
     
@@ -236,15 +282,16 @@ def render_live_device_card(device_obj: DeviceInfo, thresholds: Dict, config_man
         current_page = 0
         st.session_state[page_key] = 0
     
-    # --- RENDER HTML DE LA TARJETA ---
-    raw_html = build_card_html(
+    # --- RENDER HTML DE LA TARJETA (memoizado) ---
+    card_html = build_card_html(
         current_device, 
         thresholds, 
         config_manager,
         sensor_page=current_page,
-        total_pages=total_pages
+        total_pages=total_pages,
+        device_meta=device_meta
     )
-    st.markdown(clean_html(raw_html), unsafe_allow_html=True)
+    st.markdown(card_html, unsafe_allow_html=True)
     
     # --- BARRA DE CONTROLES ---
     if total_pages > 1:
@@ -275,47 +322,49 @@ def render_live_device_card(device_obj: DeviceInfo, thresholds: Dict, config_man
     # --- LOGICA DE REFRESH ---
     if refresh:
         try:
-            db = DatabaseConnection()
-            new_df = db.get_latest_for_single_device(dev_id)
-            if not new_df.empty:
-                cfg = ConfigManager(db)
-                # 1. Obtener umbrales globales
-                global_thresholds = cfg.get_all_configured_sensors()
-                
-                # 2. Obtener umbrales ESPECIFICOS del dispositivo
-                all_meta = cfg.get_device_metadata()
-                dev_specifics = {k: v.get('thresholds', {}) for k, v in all_meta.items()}
-                
-                # 3. Recuperar estados previos para evitar flasheos
-                prev_states = st.session_state.get('device_health_states', {})
-                
-                # 4. Crear DeviceManager con TODA la configuracion
-                mgr = DeviceManager(global_thresholds, prev_states, dev_specifics)
-                
-                new_infos = mgr.get_all_devices_info(new_df)
-                if new_infos:
-                    st.session_state[state_key] = new_infos[0]
+            # Camino rápido: última lectura indexada + umbrales/metadatos cacheados del snapshot
+            status, info = get_fleet_snapshot().refresh_device(
+                dev_id,
+                last_update=current_device.last_update,
+                # Estados previos para evitar flasheos
+                previous_health=st.session_state.get('device_health_states', {})
+            )
+            if status == "updated" and info:
+                st.session_state[state_key] = info
+            elif status == "unchanged":
+                st.toast("Sin lecturas nuevas")
         except Exception as e:
             st.toast(f"Error: {e}")
 
 
-def render_device_grid(devices, thresholds, config_manager=None):
+# Misma tarjeta con y sin temporizador: con "Auto" apagado solo se re-ejecuta al paginar o al pulsar Actualizar
+render_live_device_card = fragment(run_every=CARD_REFRESH_SECONDS)(_device_card)
+render_static_device_card = fragment(_device_card)
+
+
+def render_device_grid(view, filters, thresholds, config_manager=None, live: bool = True):
     
     with st.container():
         PER_PAGE = 9
-        total_pages = max(1, (len(devices) + PER_PAGE - 1) // PER_PAGE)
+        # Solo la página visible sale del snapshot
+        result = view.query(filters, st.session_state.dashboard_page, PER_PAGE)
+        if result["total"] == 0:
+            st.info("No se encontraron dispositivos con los filtros actuales.")
+            return
         
-        if st.session_state.dashboard_page >= total_pages: st.session_state.dashboard_page = 0
-        current_page = st.session_state.dashboard_page
+        total_pages = result["pages"]
+        st.session_state.dashboard_page = result["page"]
+        current_page = result["page"]
+        page_items = result["items"]
         
-        start = current_page * PER_PAGE
-        end = start + PER_PAGE
-        page_items = devices[start:end]
+        # Alias/ubicación de toda la página en una sola búsqueda (cache de ConfigManager)
+        page_meta = config_manager.get_device_infos([d.device_id for d in page_items]) if config_manager else {}
         
+        render_card = render_live_device_card if live else render_static_device_card
         cols = st.columns(3)
         for i, device in enumerate(page_items):
             with cols[i % 3]:
-                render_live_device_card(device, thresholds, config_manager)
+                render_card(device, thresholds, config_manager, page_meta.get(device.device_id))
                 
         if total_pages > 1:
             st.markdown("<br>", unsafe_allow_html=True)
@@ -345,9 +394,8 @@ def render_empty_state():
 </div>
     """), unsafe_allow_html=True)
 
-def render_summary_metrics(manager, devices):
+def render_summary_metrics(metrics):
     with st.container():
-        metrics = manager.calculate_summary_metrics(devices)
         cols = st.columns(6)
         def m(idx, label, key, bg, txt):
             with cols[idx]:
@@ -367,23 +415,8 @@ def build_kpi_html(label, value, bg_color, text_color):
         </div>
     """
 
-def render_filters(devices, config_manager=None):
-    alias_map = {}
-    custom_loc_map = {}
-    if config_manager:
-        meta = config_manager.get_device_metadata()
-        for dev_id, info in meta.items():
-            alias_map[dev_id] = info.get("alias", "")
-            custom_loc_map[dev_id] = info.get("location", "")
-
-    canonical_locations = set()
-    device_canon_map = {}
-    for d in devices:
-        eff_loc = custom_loc_map.get(d.device_id) or d.location
-        if eff_loc:
-             canonical_locations.add(eff_loc)
-             device_canon_map[d.device_id] = eff_loc
-    
+def render_filters(view):
+    """Widgets de filtro; retorna la especificación para FleetView.query."""
     with st.container(border=True):
         # Nueva distribución: search + filter + multiselect + checkbox (derecha)
         c1, c2, c3, c4 = st.columns([1.4, 0.8, 1.2, 0.6])
@@ -409,58 +442,122 @@ def render_filters(devices, config_manager=None):
                 help="Mostrar dispositivos que no han enviado datos recientemente"
             )
         
-        # Aplicar filtro de offline PRIMERO (antes de multiselects)
-        if not show_offline:
-            filtered = [d for d in devices if d.connection != ConnectionStatus.OFFLINE]
-        else:
-            filtered = devices
+        filters = {"search": search, "show_offline": show_offline}
         
-        # Calcular opciones para multiselects solo con dispositivos filtrados
+        # Opciones de los multiselects solo con dispositivos visibles
         # Esto evita que aparezcan dispositivos offline en las opciones cuando el checkbox está desmarcado
-        filtered_locations = set()
-        for d in filtered:
-            eff_loc = custom_loc_map.get(d.device_id) or d.location
-            if eff_loc:
-                filtered_locations.add(eff_loc)
-        
-        all_locations = sorted(list(filtered_locations))
-        all_aliases = sorted([alias_map.get(d.device_id, d.device_id) for d in filtered])
-        
-
+        options = view.options(show_offline)
 
         with c3:
-            dynamic_filter = []
             if filter_type == "Por Estado":
-                dynamic_filter = st.multiselect("Estado", ["Normal", "Alerta", "Crítico", "Offline"], label_visibility="collapsed")
-                if dynamic_filter:
-                    # Si el usuario selecciona 'Offline' explícitamente, usar la lista completa (no filtrada)
-                    # para poder mostrar los offline aunque el checkbox esté desmarcado
-                    search_list = devices if "Offline" in dynamic_filter else filtered
-                    res = []
-                    for d in search_list:
-                        s_str = "Offline" if d.connection == ConnectionStatus.OFFLINE else ("Crítico" if d.health == HealthStatus.CRITICAL else ("Alerta" if d.health == HealthStatus.WARNING else "Normal"))
-                        if s_str in dynamic_filter: res.append(d)
-                    filtered = res
+                # Si el usuario selecciona 'Offline' explícitamente, se muestran aunque el checkbox esté desmarcado
+                filters["status"] = st.multiselect("Estado", view.STATUS_LABELS, label_visibility="collapsed")
             elif filter_type == "Por Ubicación":
-                dynamic_filter = st.multiselect("Ubicación", all_locations, label_visibility="collapsed")
-                if dynamic_filter: filtered = [d for d in filtered if device_canon_map.get(d.device_id) in dynamic_filter]
+                filters["locations"] = st.multiselect("Ubicación", options["locations"], label_visibility="collapsed")
             elif filter_type == "Por Alias/ID":
-                dynamic_filter = st.multiselect("ID o Alias", all_aliases, label_visibility="collapsed")
-                if dynamic_filter: filtered = [d for d in filtered if alias_map.get(d.device_id, d.device_id) in dynamic_filter]
-
-        if search:
-            s = search.lower()
-            results = []
-            for d in filtered:
-                if any(s in x.lower() for x in [d.device_id, d.location, alias_map.get(d.device_id, ""), custom_loc_map.get(d.device_id, "")]):
-                    results.append(d)
-            filtered = results
-
-        filtered.sort(key=lambda x: alias_map.get(x.device_id, x.device_id.lower()))
-        return filtered
-
-def build_card_html(device: DeviceInfo, thresholds: Dict, config_manager: ConfigManager = None, sensor_page: int = 0, total_pages: int = 1) -> str:
-    """Genera el HTML de una tarjeta de dispositivo con altura fija."""
+                filters["aliases"] = st.multiselect("ID o Alias", options["aliases"], label_visibility="collapsed")
+
+        return filters
+
+# --- PLANTILLAS DE TARJETA (precompiladas UNA vez al importar) ---
+CARD_NO_DATA_HTML = clean_html(f'''
+    <div class="sensor-grid">
+        <div class="sensor-cell" style="grid-column: span 2; display:flex; flex-direction:column; align-items:center; justify-content:center; min-height:140px; background:transparent; border-style:dashed;">
+            <div style="opacity:0.4; margin-bottom:8px;">{ICON_WIFI_OFF}</div>
+            <div style="color:#94a3b8; font-size:0.75rem; font-weight:600;">Sin datos</div>
+        </div>
+    </div>
+''')
+
+# Layout horizontal para 2 sensores (Label a la izq, Valor a la der)
+CELL_ROW_TEMPLATE = clean_html('''
+    <div class="sensor-cell" style="{cell_style}">
+        <div style="{label_style} color:#64748b; font-weight:700; text-transform:uppercase; letter-spacing:0.5px;">{label}</div>
+        <div style="{value_style} color:#1e293b; font-weight:800;">{value:.2f}<span style="font-size:0.7rem; color:#94a3b8; font-weight:600; margin-left:4px;">{unit}</span></div>
+    </div>
+''')
+
+# Layout vertical estandar
+CELL_COLUMN_TEMPLATE = clean_html('''
+    <div class="sensor-cell" style="{cell_style}">
+        <div style="{label_style} color:#64748b; font-weight:700; text-transform:uppercase; letter-spacing:0.5px;">{label}</div>
+        <div style="{value_style} color:#1e293b; font-weight:800;">{value:.2f}<span style="font-size:0.65rem; color:#94a3b8; font-weight:600; margin-left:2px;">{unit}</span></div>
+    </div>
+''')
+
+CELL_PLACEHOLDER_HTML = '<div class="sensor-cell" style="background:transparent; border-style:dashed; opacity:0.3;"></div>'
+
+# Estilos por cantidad de sensores visibles: (celda, label, valor, grid)
+CELL_LAYOUTS = {
+    # 1 Sensor: Centrado vertical y horizontal, texto mas grande / 1 columna completa
+    1: ("display:flex; flex-direction:column; justify-content:center; height:100%;",
+        "font-size:0.8rem; margin-bottom:4px;", "font-size:1.8rem;", "grid-template-columns: 1fr;"),
+    # 2 Sensores: Centrado vertical (filas), texto mediano / 1 columna, 2 filas
+    2: ("display:flex; flex-direction:row; justify-content:space-between; align-items:center; padding:0 1.5rem; height:100%;",
+        "font-size:0.7rem;", "font-size:1.4rem;", "grid-template-columns: 1fr; grid-template-rows: 1fr 1fr;"),
+    # 3 o 4 Sensores: Grid 2x2 estandar
+    4: ("", "font-size:0.6rem; margin-bottom:2px;", "font-size:1.1rem;", "grid-template-columns: 1fr 1fr;"),
+}
+
+DOT_ACTIVE_HTML = '<span style="width:8px; height:8px; background:#0284c7; border-radius:50%; display:inline-block;"></span>'
+DOT_HTML = '<span style="width:6px; height:6px; background:#cbd5e1; border-radius:50%; display:inline-block;"></span>'
+
+ALERT_TEMPLATE = clean_html(f'''
+    <div style="background:#fef2f2; border-left:3px solid #ef4444; border-radius:6px; padding:6px 10px; color:#b91c1c; font-size:0.7rem; display:flex; align-items:center; gap:6px; margin-top:8px;">
+        {ICON_ALERT}
+        <span style="font-weight:600;">{{alert}}</span>
+    </div>
+''')
+
+CARD_TEMPLATE = clean_html(f'''
+<div class="device-card">
+    <div class="device-card-header" style="background:{{header_bg}};">
+        <div style="color:white; min-width:0; flex:1;">
+            <div style="font-weight:700; font-size:0.9rem; white-space:nowrap; overflow:hidden; text-overflow:ellipsis;">{{display_name}}</div>
+            <div style="font-size:0.7rem; opacity:0.9; display:flex; align-items:center; gap:4px; margin-top:2px;">
+                {ICON_LOC} {{display_loc}}
+            </div>
+        </div>
+        <div style="display:flex; align-items:center; gap:6px;">
+            <a href="?page=graficas&device_id={{device_id}}" target="_self" style="color:white; opacity:0.85; padding:4px; border-radius:4px; display:flex; text-decoration:none;" title="Ver Graficas">
+                {ICON_GRAPH_BTN}
+            </a>
+            <div style="background:rgba(255,255,255,0.2); color:white; border-radius:99px; padding:3px 10px; font-size:0.6rem; font-weight:700; border:1px solid rgba(255,255,255,0.3);">
+                {{status_txt}}
+            </div>
+        </div>
+    </div>
+    <div class="device-card-body" style="opacity:{{body_opacity}};">
+        {{sensors_html}}
+        {{page_indicator_html}}
+        {{alerts_html}}
+        <div class="device-card-footer">
+            <div style="white-space:nowrap; overflow:hidden; text-overflow:ellipsis; max-width:55%;" title="{{device_id}}">
+                ID: {{device_id}}
+            </div>
+            <div style="display:flex; align-items:center; gap:4px;">
+                {ICON_CLOCK} {{ts_str}}
+            </div>
+        </div>
+    </div>
+</div>
+''')
+
+# Estado visual: (color header, texto, opacidad del cuerpo)
+CARD_STATES = {
+    "offline": ("#64748b", "OFFLINE", "0.6"),
+    HealthStatus.CRITICAL: ("#dc2626", "CRITICO", "1"),
+    HealthStatus.WARNING: ("#d97706", "ALERTA", "1"),
+    "normal": ("#059669", "NORMAL", "1"),
+}
+
+
+def build_card_html(device: DeviceInfo, thresholds: Dict, config_manager: ConfigManager = None, sensor_page: int = 0, total_pages: int = 1, device_meta: Dict = None) -> str:
+    """
+    Genera el HTML (ya compacto) de una tarjeta de dispositivo con altura fija.
+    Solo resuelve lo que cambia entre tarjetas; el HTML se memoiza por ese estado (_render_card),
+    por lo que las re-ejecuciones del fragment sin cambios no vuelven a armar la tarjeta.
+    """
     
     # Obtener nombre y ubicación personalizados
     display_name = getattr(device, "external_alias", None)
@@ -469,136 +566,32 @@ def build_card_html(device: DeviceInfo, thresholds: Dict, config_manager: Config
         
     display_loc = device.location if device.location else "Sin ubicacion"
     
-    if config_manager:
-        meta = config_manager.get_device_info(device.device_id)
-        if (meta.get("alias") or "").strip(): 
-            display_name = meta.get("alias")
-        if (meta.get("location") or "").strip(): 
-            display_loc = meta.get("location")
+    if device_meta is None and config_manager:
+        device_meta = config_manager.get_device_info(device.device_id)
+    if device_meta:
+        if (device_meta.get("alias") or "").strip(): 
+            display_name = device_meta.get("alias")
+        if (device_meta.get("location") or "").strip(): 
+            display_loc = device_meta.get("location")
     
     # Determinar estado y colores
-    is_offline = device.connection == ConnectionStatus.OFFLINE
-    
-    if is_offline:
-        header_bg = "#64748b"
-        status_txt = "OFFLINE"
-        body_opacity = "0.6"
-    elif device.health == HealthStatus.CRITICAL:
-        header_bg = "#dc2626"
-        status_txt = "CRITICO"
-        body_opacity = "1"
-    elif device.health == HealthStatus.WARNING:
-        header_bg = "#d97706"
-        status_txt = "ALERTA"
-        body_opacity = "1"
+    if device.connection == ConnectionStatus.OFFLINE:
+        state = "offline"
+    elif device.health in (HealthStatus.CRITICAL, HealthStatus.WARNING):
+        state = device.health
     else:
-        header_bg = "#059669"
-        status_txt = "NORMAL"
-        body_opacity = "1"
+        state = "normal"
 
-    # Generar grid de sensores con paginacion y layout adaptativo
-    total_sensors = len(device.sensor_data) if device.sensor_data else 0
+    # Sensores visibles segun la pagina (con label/unidad ya resueltos)
     sensors_per_page = 4
-    
-    if total_sensors == 0:
-        # Sin datos
-        sensors_html = f'''
-            <div class="sensor-grid">
-                <div class="sensor-cell" style="grid-column: span 2; display:flex; flex-direction:column; align-items:center; justify-content:center; min-height:140px; background:transparent; border-style:dashed;">
-                    <div style="opacity:0.4; margin-bottom:8px;">{ICON_WIFI_OFF}</div>
-                    <div style="color:#94a3b8; font-size:0.75rem; font-weight:600;">Sin datos</div>
-                </div>
-            </div>
-        '''
-    else:
-        # Calcular slice de sensores segun la pagina
+    sensors = None
+    if device.sensor_data:
         start_idx = sensor_page * sensors_per_page
-        end_idx = start_idx + sensors_per_page
-        sensors_list = list(device.sensor_data.items())[start_idx:end_idx]
-        count = len(sensors_list)
-        
-        cells = []
-        # Generar celdas
-        for k, v in sensors_list:
+        sensors = []
+        for k, v in list(device.sensor_data.items())[start_idx:start_idx + sensors_per_page]:
             conf = thresholds.get(k, {})
-            label = conf.get("label", k.replace("_", " ").title())
-            unit = conf.get("unit", "")
-            
-            # Estilos base
-            cell_style = ""
-            
-            # Ajustes visuales segun cantidad
-            if count == 1:
-                # 1 Sensor: Centrado vertical y horizontal, texto mas grande
-                cell_style = "display:flex; flex-direction:column; justify-content:center; height:100%;"
-                label_style = "font-size:0.8rem; margin-bottom:4px;"
-                value_style = "font-size:1.8rem;"
-            elif count == 2:
-                # 2 Sensores: Centrado vertical (filas), texto mediano
-                cell_style = "display:flex; flex-direction:row; justify-content:space-between; align-items:center; padding:0 1.5rem; height:100%;"
-                label_style = "font-size:0.7rem;"
-                value_style = "font-size:1.4rem;"
-            else:
-                # 3 o 4 Sensores: Grid estandar
-                cell_style = ""
-                label_style = "font-size:0.6rem; margin-bottom:2px;"
-                value_style = "font-size:1.1rem;"
-
-            # Template de celda
-            if count == 2:
-                # Layout horizontal para 2 sensores (Label a la izq, Valor a la der)
-                cells.append(f'''
-                    <div class="sensor-cell" style="{cell_style}">
-                        <div style="{label_style} color:#64748b; font-weight:700; text-transform:uppercase; letter-spacing:0.5px;">{label}</div>
-                        <div style="{value_style} color:#1e293b; font-weight:800;">{v:.2f}<span style="font-size:0.7rem; color:#94a3b8; font-weight:600; margin-left:4px;">{unit}</span></div>
-                    </div>
-                ''')
-            else:
-                # Layout vertical estandar
-                cells.append(f'''
-                    <div class="sensor-cell" style="{cell_style}">
-                        <div style="{label_style} color:#64748b; font-weight:700; text-transform:uppercase; letter-spacing:0.5px;">{label}</div>
-                        <div style="{value_style} color:#1e293b; font-weight:800;">{v:.2f}<span style="font-size:0.65rem; color:#94a3b8; font-weight:600; margin-left:2px;">{unit}</span></div>
-                    </div>
-                ''')
-
-        # Definir Grid Layout basado en la cantidad
-        if count == 1:
-            # 1 columna completa
-            grid_style = "grid-template-columns: 1fr;"
-        elif count == 2:
-            # 1 columna, 2 filas (uno arriba, otro abajo)
-            grid_style = "grid-template-columns: 1fr; grid-template-rows: 1fr 1fr;"
-        else:
-            # Grid 2x2 estandar
-            grid_style = "grid-template-columns: 1fr 1fr;"
-            
-            # Rellenar placeholder si son 3
-            while len(cells) < 4:
-                cells.append('<div class="sensor-cell" style="background:transparent; border-style:dashed; opacity:0.3;"></div>')
-        
-        sensors_html = f'<div class="sensor-grid" style="{grid_style}">{ "".join(cells) }</div>'
-    
-    # Indicador de pagina (puntos) si hay multiples paginas
-    page_indicator_html = ""
-    if total_pages > 1:
-        dots = []
-        for i in range(total_pages):
-            if i == sensor_page:
-                dots.append('<span style="width:8px; height:8px; background:#0284c7; border-radius:50%; display:inline-block;"></span>')
-            else:
-                dots.append('<span style="width:6px; height:6px; background:#cbd5e1; border-radius:50%; display:inline-block;"></span>')
-        page_indicator_html = f'<div style="display:flex; justify-content:center; gap:6px; padding:8px 0;">{" ".join(dots)}</div>'
-
-    # Alertas
-    alerts_html = ""
-    if device.alerts:
-        alerts_html = f'''
-            <div style="background:#fef2f2; border-left:3px solid #ef4444; border-radius:6px; padding:6px 10px; color:#b91c1c; font-size:0.7rem; display:flex; align-items:center; gap:6px; margin-top:8px;">
-                {ICON_ALERT}
-                <span style="font-weight:600;">{device.alerts[0]}</span>
-            </div>
-        '''
+            sensors.append((conf.get("label", k.replace("_", " ").title()), conf.get("unit", ""), v))
+        sensors = tuple(sensors)
 
     # Timestamp
     ts_str = "--"
@@ -611,38 +604,45 @@ def build_card_html(device: DeviceInfo, thresholds: Dict, config_manager: Config
         else:
             ts_str = dt.strftime("%d/%m %H:%M:%S")
 
+    alert = device.alerts[0] if device.alerts else None
+    return _render_card(device.device_id, str(display_name), str(display_loc), state, sensors, sensor_page, total_pages, alert, ts_str)
+
+
+@lru_cache(maxsize=4096)
+def _render_card(device_id, display_name, display_loc, state, sensors, sensor_page, total_pages, alert, ts_str) -> str:
+    """HTML de la tarjeta para un estado visible dado (memoizado: misma entrada -> mismo HTML)."""
+    header_bg, status_txt, body_opacity = CARD_STATES[state]
+
+    # Generar grid de sensores con paginacion y layout adaptativo
+    if not sensors:
+        # Sin datos (o pagina vacia)
+        sensors_html = CARD_NO_DATA_HTML if sensors is None else f'<div class="sensor-grid" style="{CELL_LAYOUTS[4][3]}">{CELL_PLACEHOLDER_HTML * 4}</div>'
+    else:
+        count = len(sensors)
+        cell_style, label_style, value_style, grid_style = CELL_LAYOUTS[count if count < 3 else 4]
+        template = CELL_ROW_TEMPLATE if count == 2 else CELL_COLUMN_TEMPLATE
+        cells = [template.format(cell_style=cell_style, label_style=label_style, value_style=value_style,
+                                 label=label, value=value, unit=unit) for label, unit, value in sensors]
+        
+        # Rellenar placeholder si son 3
+        if count >= 3:
+            cells += [CELL_PLACEHOLDER_HTML] * (4 - count)
+        
+        sensors_html = f'<div class="sensor-grid" style="{grid_style}">{"".join(cells)}</div>'
+    
+    # Indicador de pagina (puntos) si hay multiples paginas
+    page_indicator_html = ""
+    if total_pages > 1:
+        dots = [DOT_ACTIVE_HTML if i == sensor_page else DOT_HTML for i in range(total_pages)]
+        page_indicator_html = f'<div style="display:flex; justify-content:center; gap:6px; padding:8px 0;">{" ".join(dots)}</div>'
+
+    # Alertas
+    alerts_html = ALERT_TEMPLATE.format(alert=alert) if alert else ""
+
     # Construir tarjeta completa
-    card = f'''
-    <div class="device-card">
-        <div class="device-card-header" style="background:{header_bg};">
-            <div style="color:white; min-width:0; flex:1;">
-                <div style="font-weight:700; font-size:0.9rem; white-space:nowrap; overflow:hidden; text-overflow:ellipsis;">{display_name}</div>
-                <div style="font-size:0.7rem; opacity:0.9; display:flex; align-items:center; gap:4px; margin-top:2px;">
-                    {ICON_LOC} {display_loc}
-                </div>
-            </div>
-            <div style="display:flex; align-items:center; gap:6px;">
-                <a href="?page=graficas&device_id={device.device_id}" target="_self" style="color:white; opacity:0.85; padding:4px; border-radius:4px; display:flex; text-decoration:none;" title="Ver Graficas">
-                    {ICON_GRAPH_BTN}
-                </a>
-                <div style="background:rgba(255,255,255,0.2); color:white; border-radius:99px; padding:3px 10px; font-size:0.6rem; font-weight:700; border:1px solid rgba(255,255,255,0.3);">
-                    {status_txt}
-                </div>
-            </div>
-        </div>
-        <div class="device-card-body" style="opacity:{body_opacity};">
-            {sensors_html}
-            {page_indicator_html}
-            {alerts_html}
-            <div class="device-card-footer">
-                <div style="white-space:nowrap; overflow:hidden; text-overflow:ellipsis; max-width:55%;" title="{device.device_id}">
-                    ID: {device.device_id}
-                </div>
-                <div style="display:flex; align-items:center; gap:4px;">
-                    {ICON_CLOCK} {ts_str}
-                </div>
-            </div>
-        </div>
-    </div>
-    '''
-    return card
\ No newline at end of file
+    return CARD_TEMPLATE.format(
+        header_bg=header_bg, status_txt=status_txt, body_opacity=body_opacity,
+        display_name=display_name, display_loc=display_loc, device_id=device_id,
+        sensors_html=sensors_html, page_indicator_html=page_indicator_html,
+        alerts_html=alerts_html, ts_str=ts_str
+    )
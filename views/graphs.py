@@ -1,19 +1,26 @@
 """
 Página de Gráficas y Tendencias - Versión Optimizada
-Arquitectura: Carga completa -> DataFrame cacheado -> Filtrado en memoria
+Arquitectura: Carga bajo demanda (solo dispositivos y sensores elegidos) -> Store persistente con
+actualización incremental -> Filtrado en memoria
 """
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime, timedelta, timezone
 from typing import List, Dict, Optional
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import OrderedDict
+import json
+import os
 import time
+import threading
 
 from modules.database import DatabaseConnection
 from modules.config_manager import ConfigManager
 from modules.device_manager import DeviceManager, ConnectionStatus
+from modules.rollups import pick_resolution, rollup_frame, RollupManager, RESOLUTIONS
+from modules.downsampling import downsample_frame
 
 # =============================================================================
 # ICONOS SVG INLINE
@@ -55,6 +62,7 @@ SENSOR_ALIASES = {
     "ph": "ph",
     "PH": "ph",
     "Ph": "ph",
+    "pH": "ph",
     # Oxigeno
     "oxigeno": "oxygen",
     "oxygen": "oxygen",
@@ -119,236 +127,794 @@ def get_sensor_display_info(sensor_name: str, sensor_config: dict) -> tuple:
 
 
 # =============================================================================
-# ARQUITECTURA OPTIMIZADA: Carga completa + Cache + Filtrado en memoria
+# ARQUITECTURA OPTIMIZADA: Carga bajo demanda + Cache incremental + Filtrado en memoria
 # =============================================================================
 
-# TTL de 24 horas (86400 segundos) para evitar recargas constantes
-# El usuario puede forzar la recarga con el botón "Actualizar"
-@st.cache_data(ttl=86400, show_spinner=False)
-def cargar_historial_completo() -> pd.DataFrame:
+# Ventana del historial de gráficas (1 semana + margen de 1 hora)
+HISTORIAL_VENTANA = timedelta(weeks=1, hours=1)
+
+# TTL de 24 horas (86400 segundos): al vencer se hace una actualización INCREMENTAL
+# El usuario puede forzar la actualización con el botón "Actualizar"
+# Las series que nadie usa durante el TTL se descartan del store
+HISTORIAL_TTL_SECONDS = 86400
+
+# Alias de sensores del adapter (DatabaseConnection._normalize_sensor_key)
+ADAPTER_SENSOR_ALIASES = ["temp", "temperatura", "oxigeno", "od", "do"]
+
+# Presupuesto de puntos por serie: columnas de píxel del gráfico (ancho típico a pantalla completa).
+# Cada columna conserva a lo más 4 puntos (primero, último, mínimo y máximo).
+# Es una COTA SUPERIOR fija, no el ancho real: Streamlit no informa al servidor el ancho del
+# contenedor, así que en pantallas angostas (móvil) llegan más puntos de los que se dibujan.
+# Si la app se usa sobre todo en pantallas chicas conviene bajar GRAPHS_CHART_WIDTH_PX.
+GRAPHS_CHART_WIDTH_PX = int(os.getenv("GRAPHS_CHART_WIDTH_PX", 1400))
+
+# Sobre esta cantidad de puntos por figura (sumando todos sus trazos) se usa Scattergl (WebGL)
+GRAPHS_WEBGL_POINTS = int(os.getenv("GRAPHS_WEBGL_POINTS", 20000))
+
+# Memoria máxima (MB) del cache de figuras ya construidas (compartido entre sesiones)
+GRAPHS_FIGURE_CACHE_MB = float(os.getenv("GRAPHS_FIGURE_CACHE_MB", 64))
+
+
+class DeviceHistory:
+    """
+    Historial ordenado por (device_id, timestamp) con el rango de filas de cada dispositivo.
+    Seleccionar dispositivos y ventana es un searchsorted sobre los timestamps de cada rango:
+    no se copia ni se recorre el historial completo. Inmutable: se reconstruye al cambiar los datos.
+    Cada fila es una lectura de un sensor (las demás columnas de sensores quedan en NaN).
+    """
+
+    def __init__(self, df: pd.DataFrame, start: Optional[datetime] = None, versions: Optional[Dict[tuple, int]] = None):
+        self.start = start  # Inicio de la ventana cruda: desde aquí el historial está completo
+        self.versions = dict(versions or {})  # (device_id, sensor) -> versión de la serie (claves del cache de figuras)
+        self.ranges: Dict[str, tuple] = {}  # device_id -> (fila inicial, fila final exclusiva)
+        if df is None or df.empty or 'timestamp' not in df.columns or 'device_id' not in df.columns:
+            self.df = df if df is not None else pd.DataFrame()
+            self.ts = np.array([], dtype='datetime64[ns]')
+            return
+
+        devices = df['device_id'].to_numpy()
+        order = np.lexsort((df['timestamp'].to_numpy(dtype='datetime64[ns]'), devices))
+        self.df = df.iloc[order].reset_index(drop=True)
+        self.ts = self.df['timestamp'].to_numpy(dtype='datetime64[ns]')
+
+        devices = devices[order]
+        starts = np.flatnonzero(np.r_[True, devices[1:] != devices[:-1]])
+        ends = np.r_[starts[1:], len(devices)]
+        self.ranges = {devices[a]: (int(a), int(b)) for a, b in zip(starts, ends)}
+
+    def __len__(self) -> int:
+        return len(self.df)
+
+    @property
+    def empty(self) -> bool:
+        return self.df.empty
+
+    def window(self, device_id: str, delta: Optional[timedelta]) -> tuple:
+        """Rango de filas de un dispositivo dentro de [t_max - delta, t_max] (t_max propio del dispositivo)."""
+        a, b = self.ranges[device_id]
+        if delta is None:
+            return a, b
+        t_min = self.ts[b - 1] - pd.Timedelta(delta).to_timedelta64()
+        return a + int(np.searchsorted(self.ts[a:b], t_min, side='left')), b
+
+    def t_max(self) -> tuple:
+        """((device_id, último timestamp), ...): fin de la ventana de cada dispositivo."""
+        return tuple((d, self.ts[b - 1]) for d, (a, b) in sorted(self.ranges.items()))
+
+    def select(self, devices: Optional[List[str]], delta: Optional[timedelta]) -> pd.DataFrame:
+        """Filas de los dispositivos (todos si la lista está vacía) ordenadas por dispositivo y timestamp."""
+        spans = [self.window(d, delta) for d in sorted(set(devices or self.ranges)) if d in self.ranges]
+        spans = [(a, b) for a, b in spans if b > a]
+        if not spans:
+            return self.df.iloc[0:0]
+        if len(spans) == 1:
+            return self.df.iloc[spans[0][0]:spans[0][1]]
+        return self.df.take(np.concatenate([np.arange(a, b) for a, b in spans]))
+
+
+@st.cache_resource(show_spinner=False)
+def get_historial_store() -> dict:
+    """
+    Store persistente (compartido entre sesiones) del historial de gráficas, cargado BAJO DEMANDA:
+    solo los dispositivos y sensores que alguien graficó, dentro de la ventana HISTORIAL_VENTANA.
+    - series: {(device_id, sensor): DataFrame(timestamp, <sensor>)} ordenado por timestamp.
+      Se REEMPLAZAN en cada actualización, nunca se modifican in-place.
+    - devices: {device_id: {"sensors", "start", "loaded_at", "used_at"}}. Todas las series de un
+      dispositivo se cargan y actualizan juntas, por lo que comparten high-water-mark.
+    - hwm: high-water-mark {(fuente, device_id): {tipo: timestamp_crudo}} con el timestamp
+      más nuevo visto por fuente y dispositivo, en su formato original de BD (Date / ISO / epoch).
+    - refresh_requested_at: último "Actualizar"; las series cargadas antes se actualizan al usarse.
+    - series_version: {(device_id, sensor): versión} de cada serie; cambia solo cuando esa serie
+      cambia, así las figuras cacheadas de las demás siguen vigentes.
+    - version: contador del que salen las versiones de las series (nunca se repite una versión,
+      ni siquiera si una serie se descarta y se vuelve a cargar).
+    """
+    return {"series": {}, "series_version": {}, "devices": {}, "hwm": {}, "version": 0, "refresh_requested_at": 0.0,
+            "lock": threading.Lock()}
+
+
+def claves_crudas(sensores: List[str]) -> List[str]:
+    """
+    Claves crudas (sensors.<clave> / datos.<clave>) que el adapter y SENSOR_ALIASES llevan a los
+    sensores estándar pedidos (temp/temperatura -> temperature, oxigeno/od/do -> oxygen, ...).
+    Mongo proyecta distinguiendo mayúsculas: se incluyen las variantes habituales de cada alias.
+    """
+    def estandar(key):
+        norm = DatabaseConnection._normalize_sensor_key(key)
+        return SENSOR_ALIASES.get(norm, norm)
+
+    objetivo = set(sensores)
+    candidatas = set(sensores) | set(SENSOR_ALIASES) | set(ADAPTER_SENSOR_ALIASES)
+    variantes = {v for k in candidatas for v in (k, k.lower(), k.upper(), k.capitalize())}
+    return sorted(k for k in variantes if estandar(k) in objetivo)
+
+
+def _tipo_timestamp(raw_ts) -> Optional[str]:
+    """Clasifica el timestamp crudo; Mongo solo compara $gt entre valores del mismo tipo BSON."""
+    if isinstance(raw_ts, datetime): return "date"
+    if isinstance(raw_ts, str): return "str"
+    if isinstance(raw_ts, (int, float)) and not isinstance(raw_ts, bool): return "num"
+    return None
+
+
+def _query_incremental(source_hwm: Dict[str, Dict[str, object]], start_date: datetime, start_date_iso: str) -> dict:
+    """
+    Construye la query de una fuente:
+    - Dispositivos conocidos: solo documentos más nuevos que su high-water-mark.
+    - Dispositivos nuevos: toda la ventana (igual que la carga completa).
+    Sin high-water-marks (primera carga) equivale a la query de ventana original.
     """
-    Carga TODO el historial de datos sin límite.
-    Esta función se cachea por 24 HORAS para evitar recargas innecesarias.
+    # Query con filtro de fecha (Soporta Date objects y ISO Strings)
+    window = [
+        {"timestamp": {"$gte": start_date}},        # Para objetos Date (Victor)
+        {"timestamp": {"$gte": start_date_iso}}     # Para strings ISO (Martin)
+    ]
+    if not source_hwm:
+        return {"$or": window}
     
-    Para obtener datos nuevos, el usuario debe presionar "Actualizar".
+    known_ids = list(source_hwm.keys())
+    clauses = [{
+        "device_id": {"$nin": known_ids},
+        "dispositivo_id": {"$nin": known_ids},
+        "$or": window
+    }]
+    for dev_id, marks in source_hwm.items():
+        for value in marks.values():
+            clauses.append({"device_id": dev_id, "timestamp": {"$gt": value}})
+            clauses.append({"dispositivo_id": dev_id, "timestamp": {"$gt": value}})
+    return {"$or": clauses}
+
+
+def _limpiar_historial(df: pd.DataFrame) -> pd.DataFrame:
+    """Normaliza columnas, elimina outliers físicos y timestamps inválidos."""
+    # Normalizar columnas de sensores
+    df = normalize_sensor_columns(df)
     
-    Arquitectura basada en recomendación: 
-    - Crear la solicitud una vez
-    - Trabajar en un DataFrame que haga toda la pega
-    - Sin límite de datos
+    # =====================================================================
+    # LIMPIEZA DE OUTLIERS Y DATOS IMPOSIBLES
+    # =====================================================================
+    # Temperatura: 0 a 60 (Biofloc no se congela ni hierve)
+    if 'temperature' in df.columns:
+        cnt_pre = len(df)
+        df = df[(df['temperature'].isna()) | ((df['temperature'] >= 0) & (df['temperature'] <= 60))]
+        if len(df) < cnt_pre:
+            print(f"[graphs.py] Filtrados {cnt_pre - len(df)} registros con Temperatura fuera de rango (0-60)")
+
+    # pH: 0 a 14 (Rango físico químico)
+    if 'ph' in df.columns:
+        df = df[(df['ph'].isna()) | ((df['ph'] >= 0) & (df['ph'] <= 14))]
+
+    # =====================================================================
+    # FILTRAR TIMESTAMPS INVÁLIDOS
+    # Excluir registros con fechas anteriores a 2020 (datos corruptos)
+    # Esto elimina timestamps epoch=0 que aparecen como 1970
+    # =====================================================================
+    if 'timestamp' in df.columns and not df.empty:
+        fecha_minima_valida = pd.Timestamp('2020-01-01')
+        registros_antes = len(df)
+        df = df[df['timestamp'] >= fecha_minima_valida]
+        registros_filtrados = registros_antes - len(df)
+        if registros_filtrados > 0:
+            print(f"[graphs.py] Filtrados {registros_filtrados} registros con timestamps inválidos (<2020)")
+    
+    return df
+
+
+def _cargar_fuentes(db: DatabaseConnection, hwm: dict, cut_off_time: datetime,
+                    dispositivos: List[str], sensores: List[str]) -> tuple:
     """
-    try:
-        start_time_total = time.time()
-        db = DatabaseConnection()
-        
-        if not db.sources:
-            return pd.DataFrame()
-        
-        all_norm_docs = []
-        
-        # Definir TIEMPO DE CORTE común para todas las fuentes
-        # Esto asegura que si una fuente tarda más en cargar, no incluya datos
-        # posteriores al inicio de la carga, manteniendo la sincronización.
-        cut_off_time = datetime.now(timezone.utc).astimezone(timezone(timedelta(hours=-3))).replace(tzinfo=None)
-        print(f"[graphs.py] Tiempo de corte de sincronización: {cut_off_time}")
-        
-        # Calcular fecha de inicio para la consulta (1 semana atrás + margen de 1 hora)
-        # Esto reduce drásticamente la cantidad de datos transferidos
-        start_date = cut_off_time - timedelta(weeks=1, hours=1)
-        # Crear versiones del timestamp para diferentes formatos de BD
-        start_date_iso = start_date.isoformat()
-        
-        print(f"[graphs.py] Limitando consulta a datos desde: {start_date}")
+    Descarga de todas las fuentes los documentos de los dispositivos indicados posteriores a su
+    high-water-mark, proyectando solo las claves crudas de los sensores pedidos.
+    Retorna (df_normalizado, hwm_actualizado). No modifica el hwm recibido.
+    """
+    # Calcular fecha de inicio para la consulta (ventana + margen)
+    # Esto reduce drásticamente la cantidad de datos transferidos
+    start_date = cut_off_time - HISTORIAL_VENTANA
+    # Crear versiones del timestamp para diferentes formatos de BD
+    start_date_iso = start_date.isoformat()
+    
+    print(f"[graphs.py] Limitando consulta a datos desde: {start_date}")
+    
+    filtro_dispositivos = {"$or": [{"device_id": {"$in": dispositivos}}, {"dispositivo_id": {"$in": dispositivos}}]}
+    projection = db.sensor_projection(claves_crudas(sensores))
 
-        def load_source_data(source):
-            """Función auxiliar para cargar datos de una fuente individual."""
+    def load_source_data(source):
+        """Función auxiliar para cargar datos de una fuente individual."""
+        try:
+            source_hwm = {dev_id: marks for (src, dev_id), marks in hwm.items() if src == source["name"]}
+            query = {"$and": [filtro_dispositivos, _query_incremental(source_hwm, start_date, start_date_iso)]}
+            
+            # Cargar documentos proyectados (intenta sort, fallback a sin sort)
             try:
-                database = source["client"][source["db"]]
-                collection = database[source["coll_telemetry"]]
-                
-                # Proyección optimizada
-                projection = {
-                    '_id': 1, 'timestamp': 1, 'device_id': 1, 'dispositivo_id': 1,
-                    'sensors': 1, 'datos': 1, 'location': 1, 'metadata': 1
-                }
-                
-                # Construir Query con filtro de fecha (Soporta Date objects y ISO Strings)
-                # Usamos $or para cubrir ambos casos sin saber el esquema a priori
-                query = {
-                    "$or": [
-                        {"timestamp": {"$gte": start_date}},        # Para objetos Date (Victor)
-                        {"timestamp": {"$gte": start_date_iso}}     # Para strings ISO (Martin)
-                    ]
-                }
-                
-                # Cargar documentos (intenta sort, fallback a sin sort)
-                try:
-                    cursor = collection.find(query, projection).sort('timestamp', -1)
-                    raw_documents = list(cursor)
-                except Exception as sort_error:
-                    print(f"[graphs.py] Sort falló para {source['name']}: {sort_error}")
-                    cursor = collection.find(query, projection)
-                    raw_documents = list(cursor)
-                
-                print(f"[graphs.py] Fuente '{source['name']}': {len(raw_documents)} documentos cargados")
-                
-                # Normalizar documentos y FILTRAR por cut_off_time
-                source_docs = []
-                docs_futuros = 0
-                for doc in raw_documents:
-                    norm_doc = db._normalize_document(doc)
-                    ts = norm_doc.get("timestamp")
-                    
-                    if ts is not None and norm_doc.get("device_id") != "unknown":
-                        # Filtro de sincronización: ignorar datos posteriores al corte
-                        if ts > cut_off_time:
-                            docs_futuros += 1
-                            continue
-                            
-                        source_docs.append(norm_doc)
-                
-                print(f"[graphs.py] Fuente '{source['name']}': {len(source_docs)} documentos válidos ({docs_futuros} ignorados por ser posteriores al corte)")
-                return source_docs
-                
-            except Exception as e:
-                print(f"[graphs.py] ERROR cargando fuente {source['name']}: {str(e)}")
-                return []
+                raw_documents = list(db._telemetry_cursor(source, query, projection=projection))
+            except Exception as sort_error:
+                print(f"[graphs.py] Sort falló para {source['name']}: {sort_error}")
+                raw_documents = list(db._telemetry_cursor(source, query, sort=False, projection=projection))
+            
+            modo = "incremental" if source_hwm else "completa"
+            print(f"[graphs.py] Fuente '{source['name']}' ({modo}): {len(raw_documents)} documentos cargados")
+            
+            # Normalizar por lotes y FILTRAR por cut_off_time y high-water-mark
+            df = db._normalize_batch(raw_documents)
+            if df.empty:
+                return df, {}
+            
+            validos = df['timestamp'].notna() & (df['device_id'] != "unknown")
+            
+            # Filtro de sincronización: ignorar datos posteriores al corte
+            futuros = validos & (df['timestamp'] > cut_off_time)
+            validos &= ~futuros
+            
+            raw_ts = pd.Series([doc.get("timestamp") for doc in raw_documents], index=df.index, dtype=object)
+            tipos = raw_ts.map(_tipo_timestamp)
+            con_tipo = validos & tipos.notna()
+            
+            source_marks = {}
+            for (dev_id, tipo), grupo in raw_ts[con_tipo].groupby([df['device_id'][con_tipo], tipos[con_tipo]]):
+                # Descartar lo ya cargado (docs traidos por la clausula de otro esquema)
+                prev = source_hwm.get(dev_id, {}).get(tipo)
+                if prev is not None:
+                    ya_cargados = grupo.index[(grupo <= prev).to_numpy(dtype=bool)]
+                    validos[ya_cargados] = False
+                    grupo = grupo.drop(ya_cargados)
+                if not grupo.empty:
+                    source_marks.setdefault(dev_id, {})[tipo] = grupo.max()
+            
+            source_df = df[validos]
+            print(f"[graphs.py] Fuente '{source['name']}': {len(source_df)} documentos válidos ({int(futuros.sum())} ignorados por ser posteriores al corte)")
+            return source_df, source_marks
+            
+        except Exception as e:
+            print(f"[graphs.py] ERROR cargando fuente {source['name']}: {str(e)}")
+            return pd.DataFrame(), {}
+
+    partes = []
+    new_hwm = {k: dict(v) for k, v in hwm.items()}
+    
+    # EJECUCIÓN PARALELA: Cargar todas las fuentes al mismo tiempo (pool compartido de la capa de datos)
+    # Esto reduce drásticamente el "gap" de tiempo entre una y otra
+    # Sin deadline: es una carga masiva que se cachea
+    for source, (source_df, marks) in db.fan_out(load_source_data, timeout=None):
+        if not source_df.empty:
+            partes.append(source_df)
+        for dev_id, dev_marks in marks.items():
+            new_hwm.setdefault((source["name"], dev_id), {}).update(dev_marks)
+    
+    df = pd.concat(partes, ignore_index=True) if partes else pd.DataFrame()
+    return df, new_hwm
+
 
-        # EJECUCIÓN PARALELA: Cargar todas las fuentes al mismo tiempo
-        # Esto reduce drásticamente el "gap" de tiempo entre una y otra
-        with ThreadPoolExecutor(max_workers=len(db.sources)) as executor:
-            future_to_source = {executor.submit(load_source_data,  s): s for s in db.sources}
+def _actualizar_series(store: dict, nuevos_dev: Dict[str, set], vencidos: Dict[str, set]):
+    """
+    Carga en el store las series de los dispositivos indicados (llamar con store["lock"] tomado).
+    - nuevos_dev: ventana completa (dispositivo nuevo o con sensores nuevos; se recargan todas sus series).
+    - vencidos: incremental desde el high-water-mark del dispositivo.
+    """
+    start_time_total = time.time()
+    db = DatabaseConnection()
+    if not db.sources:
+        return
+    
+    # Definir TIEMPO DE CORTE común para todas las fuentes
+    # Esto asegura que si una fuente tarda más en cargar, no incluya datos
+    # posteriores al inicio de la carga, manteniendo la sincronización.
+    cut_off_time = datetime.now(timezone.utc).astimezone(timezone(timedelta(hours=-3))).replace(tzinfo=None)
+    print(f"[graphs.py] Tiempo de corte de sincronización: {cut_off_time}")
+    
+    a_cargar = {**vencidos, **nuevos_dev}
+    hwm = {k: v for k, v in store["hwm"].items() if k[1] in vencidos}
+    sensores = sorted(set().union(*a_cargar.values()))
+    nuevos, new_hwm = _cargar_fuentes(db, hwm, cut_off_time, list(a_cargar), sensores)
+    
+    # Limpieza (solo los documentos nuevos, ya en formato flat)
+    nuevos = _limpiar_historial(nuevos) if not nuevos.empty else nuevos
+    por_dispositivo = dict(tuple(nuevos.groupby('device_id', sort=False))) if not nuevos.empty else {}
+    
+    inicio = cut_off_time - HISTORIAL_VENTANA
+    ahora = time.time()
+    for dev_id, dev_sensores in a_cargar.items():
+        filas = por_dispositivo.get(dev_id, pd.DataFrame(columns=['timestamp']))
+        for sensor in dev_sensores:
+            previa = store["series"].get((dev_id, sensor)) if dev_id in vencidos else None
+            nueva = filas[['timestamp', sensor]].dropna(subset=[sensor]) if sensor in filas.columns \
+                else pd.DataFrame({'timestamp': pd.Series(dtype='datetime64[ns]'), sensor: pd.Series(dtype=float)})
             
-            for future in as_completed(future_to_source):
-                docs = future.result()
-                all_norm_docs.extend(docs)
-        
-        if not all_norm_docs:
-            return pd.DataFrame()
-        
-        # Convertir a DataFrame flat
-        df = db._parse_historical_flat(all_norm_docs)
-        
-        # Normalizar columnas de sensores
-        df = normalize_sensor_columns(df)
+            partes = [d for d in (previa, nueva) if d is not None and not d.empty]
+            serie = pd.concat(partes, ignore_index=True) if len(partes) > 1 else (partes[0] if partes else nueva)
+            # Descartar registros que salieron de la ventana y ordenar por timestamp ascendente
+            serie = serie[serie['timestamp'] >= inicio]
+            if not serie['timestamp'].is_monotonic_increasing:
+                serie = serie.sort_values('timestamp', kind='stable')
+            serie = serie.reset_index(drop=True)
+            
+            if not nueva.empty or previa is None or len(serie) != len(previa):
+                store["version"] += 1
+                store["series_version"][(dev_id, sensor)] = store["version"]
+            store["series"][(dev_id, sensor)] = serie
         
-        # =====================================================================
-        # LIMPIEZA DE OUTLIERS Y DATOS IMPOSIBLES
-        # =====================================================================
-        # Temperatura: 0 a 60 (Biofloc no se congela ni hierve)
-        if 'temperature' in df.columns:
-            cnt_pre = len(df)
-            df = df[(df['temperature'].isna()) | ((df['temperature'] >= 0) & (df['temperature'] <= 60))]
-            if len(df) < cnt_pre:
-                print(f"[graphs.py] Filtrados {cnt_pre - len(df)} registros con Temperatura fuera de rango (0-60)")
+        store["devices"][dev_id] = {"sensors": set(dev_sensores), "start": inicio, "loaded_at": ahora, "used_at": ahora}
+    
+    store["hwm"] = {k: v for k, v in store["hwm"].items() if k[1] not in a_cargar}
+    store["hwm"].update(new_hwm)
+    
+    elapsed_time = time.time() - start_time_total
+    print(f"[graphs.py] Tiempo total de carga y procesamiento: {elapsed_time:.2f} segundos ({len(nuevos)} registros nuevos, {len(a_cargar)} dispositivos, sensores: {sensores})")
 
-        # pH: 0 a 14 (Rango físico químico)
-        if 'ph' in df.columns:
-            df = df[(df['ph'].isna()) | ((df['ph'] >= 0) & (df['ph'] <= 14))]
 
-        # =====================================================================
-        # FILTRAR TIMESTAMPS INVÁLIDOS
-        # Excluir registros con fechas anteriores a 2020 (datos corruptos)
-        # Esto elimina timestamps epoch=0 que aparecen como 1970
-        # =====================================================================
-        if 'timestamp' in df.columns and not df.empty:
-            fecha_minima_valida = pd.Timestamp('2020-01-01')
-            registros_antes = len(df)
-            df = df[df['timestamp'] >= fecha_minima_valida]
-            registros_filtrados = registros_antes - len(df)
-            if registros_filtrados > 0:
-                print(f"[graphs.py] Filtrados {registros_filtrados} registros con timestamps inválidos (<2020)")
-        
-        # Ordenar por timestamp ascendente
-        if 'timestamp' in df.columns and not df.empty:
-            df = df.sort_values('timestamp', ascending=True)
-        
-        elapsed_time = time.time() - start_time_total
-        print(f"[graphs.py] Tiempo total de carga y procesamiento: {elapsed_time:.2f} segundos")
+def _descartar_sin_uso(store: dict, ahora: float):
+    """Libera las series de dispositivos que nadie graficó durante el TTL (llamar con el lock tomado)."""
+    for dev_id, estado in list(store["devices"].items()):
+        if ahora - estado["used_at"] > HISTORIAL_TTL_SECONDS:
+            for sensor in estado["sensors"]:
+                store["series"].pop((dev_id, sensor), None)
+                store["series_version"].pop((dev_id, sensor), None)
+            store["hwm"] = {k: v for k, v in store["hwm"].items() if k[1] != dev_id}
+            del store["devices"][dev_id]
+
+
+def cargar_series(dispositivos: List[str], sensores: List[str]) -> DeviceHistory:
+    """
+    Devuelve el historial de la ventana HISTORIAL_VENTANA de solo los dispositivos y sensores pedidos.
+    - Series nuevas: se consultan solo esos dispositivos proyectando solo esos sensores (con alias).
+      Si el dispositivo ya tenía otras series cacheadas, se recargan junto con ellas.
+    - Series cacheadas: se reutilizan; al vencer el TTL de 24 HORAS o tras "Actualizar" se
+      actualizan de forma incremental.
+    La memoria y la transferencia escalan con lo que se grafica, no con la flota completa.
+    """
+    store = get_historial_store()
+    
+    with store["lock"]:
+        ahora = time.time()
+        _descartar_sin_uso(store, ahora)
         
-        # DEBUG: Mostrar t_max por dispositivo inmediatamente después de cargar
-        if 'timestamp' in df.columns and 'device_id' in df.columns and not df.empty:
-            print(f"\n[graphs.py] === DATOS CARGADOS (t_max por dispositivo) ===")
-            device_summary = df.groupby('device_id')['timestamp'].agg(['max', 'count']).reset_index()
-            for _, row in device_summary.iterrows():
-                print(f"  - {row['device_id']}: último dato = {row['max']} ({row['count']} registros)")
-            print(f"  [Hora actual del servidor: no disponible, ver hora en consola]")
+        nuevos_dev, vencidos = {}, {}
+        for dev_id in dispositivos:
+            estado = store["devices"].get(dev_id)
+            if estado is None or not set(sensores) <= estado["sensors"]:
+                nuevos_dev[dev_id] = set(sensores) | (estado["sensors"] if estado else set())
+            elif ahora - estado["loaded_at"] > HISTORIAL_TTL_SECONDS or estado["loaded_at"] < store["refresh_requested_at"]:
+                vencidos[dev_id] = estado["sensors"]
         
-        return df
+        if nuevos_dev or vencidos:
+            try:
+                _actualizar_series(store, nuevos_dev, vencidos)
+            except Exception as e:
+                st.error(f"Error cargando historial: {str(e)}")
         
-    except Exception as e:
-        st.error(f"Error cargando historial: {str(e)}")
-        return pd.DataFrame()
+        partes, inicios, versiones = [], [], {}
+        for dev_id in dispositivos:
+            estado = store["devices"].get(dev_id)
+            if estado is None:
+                continue
+            estado["used_at"] = ahora
+            inicios.append(estado["start"])
+            for sensor in sensores:
+                serie = store["series"].get((dev_id, sensor))
+                if serie is not None and not serie.empty:
+                    partes.append(serie.assign(device_id=dev_id))
+                    versiones[(dev_id, sensor)] = store["series_version"][(dev_id, sensor)]
+    
+    # Una fila por lectura de cada sensor; desde el inicio más tardío todas las series están completas
+    df = pd.concat(partes, ignore_index=True) if partes else pd.DataFrame()
+    return DeviceHistory(df, start=max(inicios) if inicios else None, versions=versiones)
+
+
+def solicitar_actualizacion():
+    """Botón "Actualizar": las series cacheadas se actualizan (incremental) la próxima vez que se usen."""
+    get_historial_store()["refresh_requested_at"] = time.time()
+
+
+def catalogo_dispositivos(latest_df: pd.DataFrame) -> Dict[str, List[str]]:
+    """
+    Dispositivos con datos dentro de la ventana del historial y sus sensores (nombres estándar),
+    a partir del último documento de cada uno (más los sensores ya cacheados). No lee el historial.
+    """
+    if latest_df is None or latest_df.empty or 'timestamp' not in latest_df.columns:
+        return {}
+    
+    inicio = datetime.now(timezone.utc).astimezone(timezone(timedelta(hours=-3))).replace(tzinfo=None) - HISTORIAL_VENTANA
+    cacheados = get_historial_store()["devices"]
+    sensor_data = latest_df['sensor_data'] if 'sensor_data' in latest_df.columns else [{}] * len(latest_df)
+    
+    catalogo = {}
+    for dev_id, ts, sensores in zip(latest_df['device_id'], latest_df['timestamp'], sensor_data):
+        if pd.isna(ts) or ts < inicio:
+            continue
+        nombres = [
+            SENSOR_ALIASES.get(k.lower().strip(), k.lower().strip())
+            for k, v in (sensores or {}).items()
+            if isinstance(v, dict) or (isinstance(v, (int, float)) and not isinstance(v, bool))
+        ]
+        estado = cacheados.get(dev_id)
+        if estado:
+            nombres += sorted(estado["sensors"])
+        catalogo[dev_id] = list(dict.fromkeys(nombres))
+    return catalogo
 
 
 def filtrar_dataframe(
-    df: pd.DataFrame, 
+    history: DeviceHistory, 
     dispositivos: List[str], 
-    delta: Optional[timedelta],
-    debug: bool = False
+    delta: Optional[timedelta]
 ) -> pd.DataFrame:
     """
-    Filtra el DataFrame cacheado por dispositivos y rango de tiempo.
-    Esta operación es rápida porque trabaja en memoria.
+    Filtra el historial por dispositivos y rango de tiempo.
+    Cada dispositivo es un rango contiguo ordenado por timestamp: el corte es un searchsorted,
+    sin copiar el historial ni hacer merge.
     
     IMPORTANTE: El filtro de tiempo se aplica POR DISPOSITIVO para evitar que
     un dispositivo con mayor latencia "oculte" los datos de otro.
     """
-    if df.empty:
-        return df
+    if history.empty:
+        return history.df
     
-    df_filtrado = df.copy()
-    
-    # Filtrar por dispositivos
-    if dispositivos and 'device_id' in df_filtrado.columns:
-        df_filtrado = df_filtrado[df_filtrado['device_id'].isin(dispositivos)]
-    
-    # DEBUG: Mostrar t_max por dispositivo ANTES del filtro de tiempo
-    if debug and 'timestamp' in df_filtrado.columns and 'device_id' in df_filtrado.columns:
-        pre_filter = df_filtrado.groupby('device_id').agg({
-            'timestamp': ['min', 'max', 'count']
-        }).reset_index()
-        pre_filter.columns = ['device_id', 't_min', 't_max', 'count']
-        print(f"\n[filtrar_dataframe] ANTES del filtro de tiempo:")
-        for _, row in pre_filter.iterrows():
-            print(f"  - {row['device_id']}: {row['t_min']} -> {row['t_max']} ({row['count']} registros)")
-    
-    # Filtrar por rango de tiempo POR DISPOSITIVO
-    # Esto evita que un dispositivo con latencia diferente "oculte" a otro
-    if delta is not None and 'timestamp' in df_filtrado.columns and 'device_id' in df_filtrado.columns:
-        # Calcular t_max y t_min por dispositivo (vectorizado, mucho más rápido que apply)
-        device_times = df_filtrado.groupby('device_id')['timestamp'].max().reset_index()
-        device_times.columns = ['device_id', 't_max']
-        device_times['t_min'] = device_times['t_max'] - delta
-        
-        # DEBUG: Mostrar los límites calculados
-        if debug:
-            print(f"\n[filtrar_dataframe] Límites para delta={delta}:")
-            for _, row in device_times.iterrows():
-                print(f"  - {row['device_id']}: t_max={row['t_max']}, filtrando desde t_min={row['t_min']}")
-        
-        # Merge para obtener t_min por registro
-        df_filtrado = df_filtrado.merge(device_times[['device_id', 't_min']], on='device_id', how='left')
-        
-        # Filtrar y limpiar
-        df_filtrado = df_filtrado[df_filtrado['timestamp'] >= df_filtrado['t_min']]
-        df_filtrado = df_filtrado.drop(columns=['t_min'])
-        
-        # DEBUG: Mostrar resultado después del filtro
-        if debug:
-            post_filter = df_filtrado.groupby('device_id')['timestamp'].agg(['min', 'max', 'count']).reset_index()
-            post_filter.columns = ['device_id', 't_min', 't_max', 'count']
-            print(f"\n[filtrar_dataframe] DESPUÉS del filtro de tiempo:")
-            for _, row in post_filter.iterrows():
-                print(f"  - {row['device_id']}: {row['t_min']} -> {row['t_max']} ({row['count']} registros)")
-    elif delta is not None and 'timestamp' in df_filtrado.columns:
-        # Fallback: filtro global si no hay device_id
-        t_max = df_filtrado['timestamp'].max()
-        if pd.notna(t_max):
-            t_min = t_max - delta
-            df_filtrado = df_filtrado[df_filtrado['timestamp'] >= t_min]
-    
-    return df_filtrado
+    return history.select(dispositivos, delta)
+
+
+def aplicar_resolucion(df_filtrado: pd.DataFrame, delta: Optional[timedelta], params: List[str]) -> tuple:
+    """
+    Elige la resolución más gruesa que aún da suficientes puntos para la ventana y agrega
+    los datos filtrados a ese nivel (mean/min/max/count por bucket).
+    Retorna (df_para_graficar, resolucion) con resolucion=None si se grafican datos crudos.
+    """
+    resolucion = pick_resolution(delta)
+    if resolucion is None or df_filtrado is None or df_filtrado.empty:
+        return df_filtrado, None
+    return rollup_frame(df_filtrado, resolucion, params), resolucion
+
+
+def combinar_tramos(
+    history: DeviceHistory,
+    df_filtrado: pd.DataFrame,
+    dispositivos: List[str],
+    delta: timedelta,
+    params: List[str]
+) -> tuple:
+    """
+    Ventanas más largas que el historial crudo (p.ej. un ciclo de cultivo de 60-120 días):
+    - Tramo reciente: rollup_frame sobre los datos crudos en memoria.
+    - Tramo antiguo: rollups materializados en MongoDB (RollupManager.fetch), solo de los
+      dispositivos y sensores seleccionados.
+    Ambos tramos usan la misma resolución y se cortan en un borde de bucket, por lo que
+    forman una sola serie. La memoria queda acotada por la cantidad de buckets, no por la ventana.
+    Retorna (df_para_graficar, resolucion, hay_tramo_antiguo).
+    """
+    resolucion = pick_resolution(delta) or list(RESOLUTIONS)[-1]
+    size = pd.Timedelta(RESOLUTIONS[resolucion])
+    if history.start is None:
+        return pd.DataFrame(), resolucion, False
+    inicio_crudo = pd.Timestamp(history.start)
+    # Primer bucket completo cubierto por los datos crudos
+    borde = inicio_crudo.ceil(size)
+
+    reciente = df_filtrado[df_filtrado['timestamp'] >= borde] if not df_filtrado.empty else df_filtrado
+    reciente = rollup_frame(reciente, resolucion, params) if not reciente.empty else pd.DataFrame()
+
+    # Inicio de la ventana POR DISPOSITIVO (t_max propio - delta), igual que filtrar_dataframe
+    t_min_dev = {d: pd.Timestamp(history.ts[history.ranges[d][1] - 1]) - delta
+                 for d in dispositivos if d in history.ranges}
+    antiguo = pd.DataFrame()
+    if t_min_dev and min(t_min_dev.values()) < borde:
+        # Los rollups guardan el sensor en minúsculas con solo algunos alias unificados
+        nombres = set(params) | {alias for alias, std in SENSOR_ALIASES.items() if std in params}
+        try:
+            antiguo = RollupManager(DatabaseConnection()).fetch(
+                resolucion, min(t_min_dev.values()).to_pydatetime(), (borde - size).to_pydatetime(),
+                devices=list(t_min_dev), sensors=sorted({n.lower() for n in nombres})
+            )
+        except Exception as e:
+            print(f"[graphs.py] Error leyendo rollups para el tramo antiguo: {e}")
+        if not antiguo.empty:
+            antiguo = antiguo[antiguo['timestamp'] >= antiguo['device_id'].map(t_min_dev)]
+            # Llevar columnas (y sus sufijos __min/__max/__count) al nombre estándar del sensor
+            def nombre_estandar(col):
+                base, sep, sufijo = col.partition('__')
+                return SENSOR_ALIASES.get(base, base) + sep + sufijo
+            antiguo = antiguo.rename(columns=nombre_estandar)
+            antiguo = antiguo.loc[:, ~antiguo.columns.duplicated()]
+            print(f"[graphs.py] Tramo antiguo ({resolucion}): {len(antiguo)} buckets desde rollups")
+
+    partes = [d for d in (antiguo, reciente) if not d.empty]
+    if not partes:
+        return pd.DataFrame(), resolucion, False
+    plot_df = pd.concat(partes, ignore_index=True)
+    plot_df = plot_df.sort_values(['device_id', 'timestamp'], kind='stable').reset_index(drop=True)
+    return plot_df, resolucion, not antiguo.empty
+
+
+def resumen_por_dispositivo(data: pd.DataFrame, param: str, agregado: bool = False) -> pd.DataFrame:
+    """
+    Mínimo / Promedio / Mediana / Máximo / Registros de un sensor por dispositivo.
+    Con datos agregados (tramos de rollup) se usan las columnas del bucket: promedio ponderado
+    por cantidad de lecturas, mín/máx exactos y mediana aproximada sobre los promedios de bucket.
+    """
+    if not agregado:
+        return data.groupby('device_name')[param].agg(
+            Mínimo='min',
+            Promedio='mean',
+            Mediana='median',
+            Máximo='max',
+            Registros='count'
+        )
+    counts = data[f"{param}__count"]
+    grouped = data.assign(_sum=data[param] * counts).groupby('device_name')
+    registros = grouped[f"{param}__count"].sum()
+    return pd.DataFrame({
+        'Mínimo': grouped[f"{param}__min"].min(),
+        'Promedio': grouped['_sum'].sum() / registros,
+        'Mediana': grouped[param].median(),
+        'Máximo': grouped[f"{param}__max"].max(),
+        'Registros': registros.astype(int),
+    })
+
+
+
+# =============================================================================
+# CACHE DE FIGURAS: figura serializada + estadísticas por (selección, sensor, opciones, versiones de las series)
+# =============================================================================
+
+class FigureCache:
+    """
+    Cache LRU con presupuesto de memoria (bytes) de figuras ya construidas.
+    La clave incluye la versión de cada serie (dispositivo, sensor) graficada: cuando una serie
+    cambia, sus figuras dejan de pedirse y salen por LRU; las de otras series siguen vigentes.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[tuple, tuple]" = OrderedDict()  # clave -> (valor, bytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+    def get(self, key: tuple) -> Optional[dict]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key: tuple, value: dict, size: int):
+        with self._lock:
+            if size > self.max_bytes:
+                return
+            anterior = self._items.pop(key, None)
+            if anterior is not None:
+                self._bytes -= anterior[1]
+            self._items[key] = (value, size)
+            self._bytes += size
+            # Desalojar las menos usadas recientemente hasta volver al presupuesto
+            while self._bytes > self.max_bytes:
+                _, (_, liberados) = self._items.popitem(last=False)
+                self._bytes -= liberados
+
+
+@st.cache_resource(show_spinner=False)
+def get_figure_cache() -> FigureCache:
+    """Instancia única por proceso (compartida entre sesiones)."""
+    return FigureCache(int(GRAPHS_FIGURE_CACHE_MB * 1024 * 1024))
+
+
+def tamano_grafico(grafico: dict) -> int:
+    """Bytes aproximados de una entrada: JSON de la figura + tablas de estadísticas."""
+    if not grafico:
+        return 0
+    return (len(grafico["figure"])
+            + int(grafico["stats"].memory_usage(deep=True).sum())
+            + int(grafico["promedios"].memory_usage(deep=True)))
+
+
+def construir_grafico(
+    filtered_df: pd.DataFrame,
+    plot_df: pd.DataFrame,
+    param: str,
+    label: str,
+    unit: str,
+    resolucion: Optional[str],
+    tiered: bool,
+    use_shared_scale: bool,
+    full_resolution: bool,
+    delta: Optional[timedelta]
+) -> dict:
+    """
+    Construye la figura de un sensor (trazos por dispositivo, SMA, banda mín/máx) y sus estadísticas.
+    Sin full_resolution cada serie se reduce a GRAPHS_CHART_WIDTH_PX columnas (cota fija, no el ancho real).
+    Retorna {"figure": JSON de la figura, "promedios": Serie por dispositivo, "promedio_global",
+    "stats": tabla formateada}, o {} si no hay datos del sensor.
+    """
+    unit_str = f" ({unit})" if unit else ""
+    
+    # Datos limpios para este gráfico
+    chart_data = filtered_df[['timestamp', 'device_id', 'device_name', param]].dropna(subset=[param])
+    
+    # Serie a graficar: agregada (resolución elegida) o cruda
+    band_cols = [f"{param}__min", f"{param}__max"]
+    if resolucion and param in plot_df.columns and all(c in plot_df.columns for c in band_cols):
+        series_data = plot_df[['timestamp', 'device_id', 'device_name', param, f"{param}__count"] + band_cols].dropna(subset=[param])
+    else:
+        series_data = chart_data
+    
+    # Ventana por tramos: las métricas salen de los buckets combinados; si no, de los datos crudos
+    agregado = tiered and series_data is not chart_data
+    stats_data = series_data if agregado else chart_data
+    
+    if stats_data.empty:
+        return {}
+    
+    # Ya viene ordenado por dispositivo y timestamp desde el historial (y el rollup)
+    resumen = resumen_por_dispositivo(stats_data, param, agregado)
+    
+    # Calcular promedios por dispositivo
+    if agregado:
+        promedio_global = (resumen['Promedio'] * resumen['Registros']).sum() / resumen['Registros'].sum()
+    else:
+        promedio_global = chart_data[param].mean()
+    
+    # Calcular rango Y si se comparte escala
+    if use_shared_scale:
+        y_min = resumen['Mínimo'].min()
+        y_max = resumen['Máximo'].max()
+        y_margin = (y_max - y_min) * 0.1 if y_max != y_min else 1
+        y_range = [y_min - y_margin, y_max + y_margin]
+    else:
+        y_range = None
+    
+    # Crear figura con múltiples trazos
+    fig = go.Figure()
+    
+    # Colores distintivos para cada dispositivo
+    colors = ['#3b82f6', '#ef4444', '#10b981', '#f59e0b', '#8b5cf6', '#ec4899', '#06b6d4', '#84cc16']
+    
+    # Calcular ventana de SMA basada en cantidad de datos
+    n_total = len(series_data)
+    window = 5 if n_total < 1000 else (20 if n_total < 10000 else 50)
+    
+    # Preparar la serie de cada dispositivo
+    device_series = []
+    for dev_name, dev_sorted in series_data.groupby('device_name', sort=True):
+        # Solo se reordena si dos dispositivos comparten alias
+        if not dev_sorted['timestamp'].is_monotonic_increasing:
+            dev_sorted = dev_sorted.sort_values('timestamp', kind='stable')
+    
+        # Tendencia calculada sobre la serie completa (antes de reducir puntos)
+        if len(dev_sorted) > window:
+            dev_sorted = dev_sorted.assign(_sma=dev_sorted[param].rolling(window=window, min_periods=1).mean())
+    
+        # Reducción mín/máx por píxel (la banda del rollup también conserva sus extremos)
+        if not full_resolution:
+            cols = [param] + (band_cols if series_data is not chart_data else [])
+            dev_sorted = downsample_frame(dev_sorted, cols, GRAPHS_CHART_WIDTH_PX)
+        device_series.append((dev_name, dev_sorted))
+    
+    # Figuras densas se dibujan con WebGL; todos los trazos del gráfico usan el mismo tipo
+    traces_per_device = 1 + (2 if series_data is not chart_data else 0)
+    n_points = sum(len(d) * (traces_per_device + ('_sma' in d.columns)) for _, d in device_series)
+    Scatter = go.Scattergl if n_points > GRAPHS_WEBGL_POINTS else go.Scatter
+    
+    # Agregar trazos por dispositivo
+    for idx, (dev_name, dev_sorted) in enumerate(device_series):
+        color = colors[idx % len(colors)]
+    
+        # Banda mín/máx del bucket (preserva picos al graficar promedios)
+        if series_data is not chart_data:
+            fig.add_trace(Scatter(
+                x=dev_sorted['timestamp'],
+                y=dev_sorted[f"{param}__max"],
+                mode='lines',
+                line=dict(width=0, color=color),
+                hoverinfo='skip',
+                legendgroup=dev_name,
+                showlegend=False
+            ))
+            fig.add_trace(Scatter(
+                x=dev_sorted['timestamp'],
+                y=dev_sorted[f"{param}__min"],
+                mode='lines',
+                line=dict(width=0, color=color),
+                fill='tonexty',
+                fillcolor=color,
+                opacity=0.15,
+                hoverinfo='skip',
+                legendgroup=dev_name,
+                showlegend=False
+            ))
+    
+        # Línea de valores reales (fina, semi-transparente)
+        fig.add_trace(Scatter(
+            x=dev_sorted['timestamp'],
+            y=dev_sorted[param],
+            mode='lines',
+            name=f'{dev_name}',
+            line=dict(color=color, width=1),
+            opacity=0.5,
+            hovertemplate=f'{dev_name}<br>%{{x}}<br>{label}: %{{y:.2f}}{unit}<extra></extra>',
+            legendgroup=dev_name
+        ))
+    
+        # Línea de tendencia (SMA) - gruesa, sólida
+        if '_sma' in dev_sorted.columns:
+            fig.add_trace(Scatter(
+                x=dev_sorted['timestamp'],
+                y=dev_sorted['_sma'],
+                mode='lines',
+                name=f'{dev_name} (Tendencia)',
+                line=dict(color=color, width=2.5),
+                opacity=1.0,
+                hoverinfo='skip',
+                legendgroup=dev_name,
+                showlegend=True
+            ))
+    
+    # Personalización del layout
+    fig.update_layout(
+        hovermode="x unified",
+        legend=dict(
+            orientation="h",
+            yanchor="bottom",
+            y=1.02,
+            xanchor="right",
+            x=1,
+            title=None
+        ),
+        margin=dict(l=20, r=20, t=30, b=20),
+        height=380,
+        template="plotly_white",
+        xaxis=dict(
+            tickformat="%H:%M" if (delta and delta <= timedelta(hours=24)) else "%d/%m %H:%M",
+            showgrid=True,
+            gridcolor='rgba(0,0,0,0.05)'
+        ),
+        yaxis=dict(
+            showgrid=True,
+            gridcolor='rgba(0,0,0,0.05)',
+            range=y_range,
+            title=f'{label}{unit_str}'
+        )
+    )
+    
+    # Estadísticas ya formateadas para la tabla
+    stats = resumen.reset_index()
+    for col in ['Mínimo', 'Promedio', 'Mediana', 'Máximo']:
+        stats[col] = stats[col].map('{:.2f}'.format)
+    stats = stats.rename(columns={'device_name': 'Dispositivo'})
+    
+    return {
+        "figure": fig.to_json(),
+        "promedios": resumen['Promedio'],
+        "promedio_global": float(promedio_global),
+        "stats": stats,
+    }
 
 
 def show_view():
@@ -359,9 +925,11 @@ def show_view():
     with col_h2:
         if st.button("Actualizar", type="secondary", help="Recargar datos desde la base de datos"):
             print(f"\n[graphs.py] ========================================")
-            print(f"[graphs.py] BOTÓN ACTUALIZAR PRESIONADO - Limpiando cache...")
+            print(f"[graphs.py] BOTÓN ACTUALIZAR PRESIONADO - Actualización incremental...")
             print(f"[graphs.py] ========================================")
-            cargar_historial_completo.clear()
+            solicitar_actualizacion()
+            # Regenerar las gráficas visibles (descarga solo lo nuevo de las series elegidas)
+            st.session_state.graphs_last_params = None
             st.rerun()
     
     # --- CONEXION Y CONFIG ---
@@ -374,26 +942,30 @@ def show_view():
         st.error(f"Error de conexión: {str(e)}")
         return
     
-    # --- CARGA INICIAL DE DATOS (CACHEADA POR 24 HORAS) ---
-    with st.spinner("Cargando historial completo (solo la primera vez, después será instantáneo)..."):
-        df_completo = cargar_historial_completo()
+    # --- CATÁLOGO DE DISPOSITIVOS Y SENSORES (último documento; el historial se carga bajo demanda) ---
+    try:
+        latest_df = db.get_latest_by_device()
+    except Exception as e:
+        print(f"[graphs.py] Error obteniendo último estado de dispositivos: {e}")
+        latest_df = None
+    catalogo = catalogo_dispositivos(latest_df)
     
-    if df_completo is None or df_completo.empty:
+    if not catalogo:
         st.warning("No se encontraron datos en la base de datos.")
         st.markdown(f"{ICON_LIGHTBULB} Verifica que los dispositivos estén enviando datos correctamente.", unsafe_allow_html=True)
         return
     
     # Mostrar info de cache
-    total_registros = len(df_completo)
-    fecha_min_data = df_completo['timestamp'].min()
-    fecha_max_data = df_completo['timestamp'].max()
+    store = get_historial_store()
+    series_cacheadas = list(store["series"].values())
+    total_registros = sum(len(serie) for serie in series_cacheadas)
     
     # --- FILTROS EN CONTENEDOR ---
     with st.container(border=True):
         st.markdown(f"<div style='margin-bottom: 10px; font-weight: 600; color: #475569;'>{ICON_SETTINGS} Configuración de Visualización</div>", unsafe_allow_html=True)
         
         # Info del dataset cargado
-        st.markdown(f"<span style='font-size: 0.85rem; color: #64748b;'>{ICON_DATABASE} Dataset: {total_registros:,} registros | Desde: {fecha_min_data.strftime('%d/%m/%Y %H:%M') if pd.notna(fecha_min_data) else 'N/A'}</span>", unsafe_allow_html=True)
+        st.markdown(f"<span style='font-size: 0.85rem; color: #64748b;'>{ICON_DATABASE} Cache: {len(series_cacheadas)} series (dispositivo, sensor) | {total_registros:,} registros | Se cargan solo los dispositivos y parámetros elegidos</span>", unsafe_allow_html=True)
         
         c_time, c_dev, c_param = st.columns([1, 1, 1])
         
@@ -407,6 +979,11 @@ def show_view():
                 "24 Horas": timedelta(hours=24),
                 "3 Días": timedelta(days=3),
                 "1 Semana": timedelta(weeks=1),
+                # Más allá del historial crudo: tramo antiguo desde rollups materializados
+                "30 Días": timedelta(days=30),
+                "60 Días": timedelta(days=60),
+                "90 Días": timedelta(days=90),
+                "120 Días": timedelta(days=120),
             }
             time_keys = list(time_options.keys())
             
@@ -428,12 +1005,11 @@ def show_view():
             )
             delta = time_options[selected_range]
         
-        # Obtener dispositivos disponibles del historial
-        all_devices = sorted(df_completo['device_id'].unique().tolist())
+        # Dispositivos con datos dentro de la ventana del historial
+        all_devices = sorted(catalogo)
         
         # Obtener estado actual de conexión de los dispositivos usando DeviceManager
         try:
-            latest_df = db.get_latest_by_device()
             if latest_df is not None and not latest_df.empty:
                 # Usar DeviceManager para evaluar el estado de conexión real
                 device_manager = DeviceManager({}, {})
@@ -502,20 +1078,10 @@ def show_view():
                 placeholder="Seleccionar dispositivos..."
             )
         
-        # Filtrar para obtener parámetros disponibles
-        excluded = ['timestamp', 'device_id', 'location', 'id', '_id', 'lat', 'lon', 'device_name']
-        numeric_cols = df_completo.select_dtypes(include=['number']).columns
-        params = [c for c in numeric_cols if c not in excluded]
-        
-        # Filtrar parámetros disponibles para dispositivos seleccionados
-        available_params = []
-        if selected_devices:
-            subset_df = df_completo[df_completo['device_id'].isin(selected_devices)]
-            for col in params:
-                if col in subset_df.columns and subset_df[col].notna().any():
-                    available_params.append(col)
-        else:
-            available_params = params
+        # Parámetros disponibles para los dispositivos seleccionados (según el catálogo)
+        available_params = list(dict.fromkeys(
+            p for dev_id in (selected_devices or all_devices) for p in catalogo.get(dev_id, [])
+        ))
         
         # Calcular default inicial para parámetros
         default_params = None
@@ -587,13 +1153,31 @@ def show_view():
         st.session_state.graphs_prev_params = selected_params
         st.session_state.graphs_last_params = current_params
         
-        # Filtrar datos
+        # Filtrar datos (crudos para métricas, agregados a la resolución elegida para las curvas)
         with st.spinner("Generando gráficas..."):
-            filtered_df = filtrar_dataframe(df_completo, selected_devices, delta, debug=False)
+            # Carga bajo demanda (cacheada por dispositivo y sensor)
+            history = cargar_series(selected_devices, selected_params)
+            filtered_df = filtrar_dataframe(history, selected_devices, delta)
+            if delta > HISTORIAL_VENTANA:
+                plot_df, resolucion, tramo_antiguo = combinar_tramos(history, filtered_df, selected_devices, delta, selected_params)
+            else:
+                (plot_df, resolucion), tramo_antiguo = aplicar_resolucion(filtered_df, delta, selected_params), False
             st.session_state.graphs_data_loaded = filtered_df
+            st.session_state.graphs_plot_data = plot_df
+            st.session_state.graphs_resolution = resolucion
+            st.session_state.graphs_tiered = delta > HISTORIAL_VENTANA
+            st.session_state.graphs_tiered_found = tramo_antiguo
+            st.session_state.graphs_series_versions = history.versions
+            # Los rollups del tramo antiguo no tienen versión en el store: su tamaño los identifica
+            st.session_state.graphs_data_key = (tuple(sorted(selected_devices)), delta, history.t_max(), resolucion,
+                                                tramo_antiguo, len(plot_df) if tramo_antiguo else None)
     
     # Obtener datos de sesión
     filtered_df = st.session_state.graphs_data_loaded
+    plot_df = st.session_state.get('graphs_plot_data', filtered_df)
+    resolucion = st.session_state.get('graphs_resolution')
+    # Ventana por tramos: métricas y curvas salen de los buckets combinados (crudo reciente + rollups)
+    tiered = st.session_state.get('graphs_tiered', False) and plot_df is not None and not plot_df.empty
     
     # Si no hay datos, mostrar mensaje instructivo
     if filtered_df is None:
@@ -606,7 +1190,7 @@ def show_view():
         return
     
     # Si filtered_df está vacío
-    if filtered_df.empty:
+    if filtered_df.empty and not tiered:
         st.warning("No hay datos para la selección actual.")
         return
     
@@ -617,18 +1201,60 @@ def show_view():
     
     filtered_df = filtered_df.copy()
     filtered_df['device_name'] = filtered_df['device_id'].apply(get_display_name)
+    
+    if st.session_state.get('graphs_tiered') and not st.session_state.get('graphs_tiered_found'):
+        st.info("No hay rollups materializados anteriores a la última semana para esta selección; "
+                "se muestran solo los datos recientes. Ejecuta scripts/refresh_rollups.py para generarlos.")
+    
+    if plot_df is None or plot_df.empty:
+        plot_df, resolucion = filtered_df, None
+    else:
+        plot_df = plot_df.copy()
+        plot_df['device_name'] = plot_df['device_id'].apply(get_display_name)
 
+    # Opción de escala compartida (con estado persistente)
+    c_scale, c_full = st.columns(2)
+    with c_scale:
+        use_shared_scale = st.checkbox(
+            "Usar escala Y compartida entre dispositivos", 
+            value=True,
+            key="graphs_shared_scale"
+        )
+    with c_full:
+        full_resolution = st.checkbox(
+            "Resolución completa (todos los puntos)",
+            value=False,
+            key="graphs_full_resolution",
+            disabled=tiered,
+            help="Por defecto se grafican promedios por bucket en ventanas largas y cada serie se reduce "
+                 "a mín/máx por píxel (conserva picos y cruces de umbral). Actívalo para enviar todos los "
+                 "puntos crudos e inspeccionarlos al hacer zoom."
+        )
+
+    # Resolución completa: datos crudos, sin promedios ni reducción de puntos
+    # (no aplica a ventanas por tramos: los datos crudos solo cubren la última semana)
+    full_resolution = full_resolution and not tiered
+    if full_resolution:
+        plot_df, resolucion = filtered_df, None
+    
     # --- INFO DE RANGO ---
-    t_min = filtered_df['timestamp'].min()
-    t_max = filtered_df['timestamp'].max()
+    rango_df = plot_df if tiered else filtered_df
+    t_min = rango_df['timestamp'].min()
+    t_max = rango_df['timestamp'].max()
     intervalo_str = f"{t_min.strftime('%d/%m %H:%M')} - {t_max.strftime('%d/%m %H:%M')}"
     
     # Info de dispositivos en datos
-    devices_in_data = filtered_df['device_name'].nunique()
+    devices_in_data = rango_df['device_name'].nunique()
+    
+    resolucion_str = f"Promedios de {resolucion} (con rango mín/máx)" if resolucion else "Datos crudos"
+    if tiered and st.session_state.get('graphs_tiered_found'):
+        resolucion_str += " | Tramo antiguo desde rollups"
+    if not full_resolution:
+        resolucion_str += f" | Máx. {GRAPHS_CHART_WIDTH_PX} columnas de píxel por serie"
     
     st.markdown(
         f"""<div style='text-align: center; color: #64748b; font-size: 0.9rem; margin: 10px 0;'>
-        {ICON_CHART} Mostrando: {intervalo_str} | Registros: {len(filtered_df):,} | Dispositivos: {devices_in_data}
+        {ICON_CHART} Mostrando: {intervalo_str} | Lecturas: {len(filtered_df):,} | Dispositivos: {devices_in_data} | Resolución: {resolucion_str}
         </div>""", 
         unsafe_allow_html=True
     )
@@ -636,33 +1262,35 @@ def show_view():
     # --- GRÁFICOS ---
     st.markdown("<br>", unsafe_allow_html=True)
     
-    # Opción de escala compartida (con estado persistente)
-    use_shared_scale = st.checkbox(
-        "Usar escala Y compartida entre dispositivos", 
-        value=True,
-        key="graphs_shared_scale"
-    )
-
+    cache = get_figure_cache()
+    versiones = st.session_state.get('graphs_series_versions', {})
+    # Identidad de los datos cargados: selección, ventana (t_max de cada dispositivo) y tramo antiguo
+    data_key = st.session_state.get('graphs_data_key')
+    nombres = tuple((d, get_display_name(d)) for d in (data_key[0] if data_key else ()))
+    
     for param in selected_params:
         label, unit = get_sensor_display_info(param, sensor_config)
         unit_str = f" ({unit})" if unit else ""
         
-        # Datos limpios para este gráfico
-        chart_data = filtered_df[['timestamp', 'device_id', 'device_name', param]].dropna(subset=[param])
+        # Figura y estadísticas memoizadas: reruns sin cambios de datos (checkbox, expander) no las reconstruyen
+        # La versión de cada serie (dispositivo, param) invalida solo las figuras de ese sensor
+        series = tuple(versiones.get((d, param)) for d, _ in nombres)
+        clave = (data_key, nombres, param, series, label, unit, delta, resolucion, tiered, use_shared_scale, full_resolution)
+        grafico = cache.get(clave)
+        if grafico is None:
+            grafico = construir_grafico(filtered_df, plot_df, param, label, unit, resolucion, tiered,
+                                        use_shared_scale, full_resolution, delta)
+            cache.put(clave, grafico, tamano_grafico(grafico))
         
-        if chart_data.empty:
+        if not grafico:
             continue
-        
-        # Ordenar por dispositivo y timestamp
-        chart_data = chart_data.sort_values(['device_name', 'timestamp'])
 
         with st.container(border=True):
             # Header del gráfico con promedios por dispositivo
             st.markdown(f"### {label}{unit_str}")
             
-            # Calcular promedios por dispositivo
-            promedios_dispositivos = chart_data.groupby('device_name')[param].mean()
-            promedio_global = chart_data[param].mean()
+            promedios_dispositivos = grafico["promedios"]
+            promedio_global = grafico["promedio_global"]
             
             # Mostrar promedios por dispositivo en columnas dinámicas
             num_dispositivos = len(promedios_dispositivos)
@@ -685,104 +1313,12 @@ def show_view():
                     help=f"Promedio combinado de todos los dispositivos"
                 )
             
-            # Calcular rango Y si se comparte escala
-            if use_shared_scale:
-                y_min = chart_data[param].min()
-                y_max = chart_data[param].max()
-                y_margin = (y_max - y_min) * 0.1 if y_max != y_min else 1
-                y_range = [y_min - y_margin, y_max + y_margin]
-            else:
-                y_range = None
-            
-            # Crear figura con múltiples trazos
-            fig = go.Figure()
-            
-            # Colores distintivos para cada dispositivo
-            colors = ['#3b82f6', '#ef4444', '#10b981', '#f59e0b', '#8b5cf6', '#ec4899', '#06b6d4', '#84cc16']
-            
-            # Calcular ventana de SMA basada en cantidad de datos
-            n_total = len(chart_data)
-            window = 5 if n_total < 1000 else (20 if n_total < 10000 else 50)
-            
-            # Agregar trazos por dispositivo
-            for idx, (dev_name, dev_data) in enumerate(chart_data.groupby('device_name', sort=False)):
-                color = colors[idx % len(colors)]
-                dev_sorted = dev_data.sort_values('timestamp')
-                
-                # Línea de valores reales (fina, semi-transparente)
-                fig.add_trace(go.Scatter(
-                    x=dev_sorted['timestamp'],
-                    y=dev_sorted[param],
-                    mode='lines',
-                    name=f'{dev_name}',
-                    line=dict(color=color, width=1),
-                    opacity=0.5,
-                    hovertemplate=f'{dev_name}<br>%{{x}}<br>{label}: %{{y:.2f}}{unit}<extra></extra>',
-                    legendgroup=dev_name
-                ))
-                
-                # Línea de tendencia (SMA) - gruesa, sólida
-                if len(dev_sorted) > window:
-                    sma = dev_sorted[param].rolling(window=window, min_periods=1).mean()
-                    fig.add_trace(go.Scatter(
-                        x=dev_sorted['timestamp'],
-                        y=sma,
-                        mode='lines',
-                        name=f'{dev_name} (Tendencia)',
-                        line=dict(color=color, width=2.5),
-                        opacity=1.0,
-                        hoverinfo='skip',
-                        legendgroup=dev_name,
-                        showlegend=True
-                    ))
-            
-            # Personalización del layout
-            fig.update_layout(
-                hovermode="x unified",
-                legend=dict(
-                    orientation="h",
-                    yanchor="bottom",
-                    y=1.02,
-                    xanchor="right",
-                    x=1,
-                    title=None
-                ),
-                margin=dict(l=20, r=20, t=30, b=20),
-                height=380,
-                template="plotly_white",
-                xaxis=dict(
-                    tickformat="%H:%M" if (delta and delta <= timedelta(hours=24)) else "%d/%m %H:%M",
-                    showgrid=True,
-                    gridcolor='rgba(0,0,0,0.05)'
-                ),
-                yaxis=dict(
-                    showgrid=True,
-                    gridcolor='rgba(0,0,0,0.05)',
-                    range=y_range,
-                    title=f'{label}{unit_str}'
-                )
-            )
-            
-            st.plotly_chart(fig, width='stretch')
+            st.plotly_chart(json.loads(grafico["figure"]), width='stretch')
             
             # --- ESTADÍSTICAS ---
             with st.expander("Estadísticas Detalladas", expanded=False):
-                stats = chart_data.groupby('device_name')[param].agg(
-                    Mínimo='min',
-                    Promedio='mean',
-                    Mediana='median',
-                    Máximo='max',
-                    Registros='count'
-                ).reset_index()
-                
-                # Formatear columnas numéricas
-                for col in ['Mínimo', 'Promedio', 'Mediana', 'Máximo']:
-                    stats[col] = stats[col].map('{:.2f}'.format)
-                
-                stats = stats.rename(columns={'device_name': 'Dispositivo'})
-                
                 st.dataframe(
-                    stats,
+                    grafico["stats"],
                     width='stretch',
                     hide_index=True
                 )
\ No newline at end of file
@@ -1,13 +1,14 @@
 import streamlit as st
 import pandas as pd
-from datetime import datetime, timedelta, timezone, time as dt_time
+from datetime import datetime, timedelta, time as dt_time
 from io import BytesIO
 from typing import List, Dict, Optional
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import time
 
 from modules.database import DatabaseConnection
 from modules.config_manager import ConfigManager
+from modules.device_manager import ThresholdEngine
+from modules.history_archive import HistoryArchive
 
 # ICONOS SVG
 ICON_SEARCH = '<svg xmlns="http://www.w3.org/2000/svg" width="16" height="16" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2" stroke-linecap="round" stroke-linejoin="round"><circle cx="11" cy="11" r="8"/><line x1="21" y1="21" x2="16.65" y2="16.65"/></svg>'
@@ -20,13 +21,85 @@ ICON_LIST = '<svg xmlns="http://www.w3.org/2000/svg" width="16" height="16" view
 ICON_CPU = '<svg xmlns="http://www.w3.org/2000/svg" width="16" height="16" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2" stroke-linecap="round" stroke-linejoin="round"><rect x="4" y="4" width="16" height="16" rx="2" ry="2"/><rect x="9" y="9" width="6" height="6"/><line x1="9" y1="1" x2="9" y2="4"/><line x1="15" y1="1" x2="15" y2="4"/><line x1="9" y1="20" x2="9" y2="23"/><line x1="15" y1="20" x2="15" y2="23"/><line x1="20" y1="9" x2="23" y2="9"/><line x1="20" y1="14" x2="23" y2="14"/><line x1="1" y1="9" x2="4" y2="9"/><line x1="1" y1="14" x2="4" y2="14"/></svg>'
 
 # =============================================================================
-# FUNCIÓN DE CARGA OPTIMIZADA (Paralela + Caché por Rango)
+# FUNCIÓN DE CARGA OPTIMIZADA (Archivo local + Paralela + Caché por Rango)
 # =============================================================================
+def _tramos_contiguos(days: List) -> List[tuple]:
+    """Agrupa una lista de días en tramos contiguos [(inicio, fin), ...]."""
+    tramos = []
+    for d in sorted(days):
+        if tramos and d - tramos[-1][1] == timedelta(days=1):
+            tramos[-1] = (tramos[-1][0], d)
+        else:
+            tramos.append((d, d))
+    return tramos
+
+
 @st.cache_data(ttl=3600, show_spinner=False)
 def cargar_datos_rango(start_date: datetime, end_date: datetime, devices: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Carga datos del rango combinando el archivo local Parquet y MongoDB.
+    - Días cerrados ya archivados: lectura local de las particiones (dispositivo, día).
+    - Días cerrados sin archivar: se consultan UNA vez a Mongo (todos los dispositivos) y se archivan.
+    - Día abierto (hoy): siempre desde Mongo.
+    Sin pyarrow disponible, se consulta todo el rango a Mongo como antes.
+    """
+    if start_date.tzinfo: start_date = start_date.replace(tzinfo=None)
+    if end_date.tzinfo: end_date = end_date.replace(tzinfo=None)
+    
+    archive = HistoryArchive()
+    if not archive.enabled:
+        return _consultar_mongo_rango(start_date, end_date, devices)[0]
+    
+    start_time_total = time.time()
+    days = archive.days_between(start_date, end_date)
+    faltantes = set(archive.missing_closed_days(days))
+    archivados = [d for d in days if archive.is_closed(d) and d not in faltantes]
+    abiertos = [d for d in days if not archive.is_closed(d)]
+    
+    partes = []
+    
+    # 1. Completar el archivo con los días cerrados faltantes (una consulta por tramo contiguo)
+    for tramo_ini, tramo_fin in _tramos_contiguos(list(faltantes)):
+        t0 = datetime.combine(tramo_ini, dt_time.min)
+        t1 = datetime.combine(tramo_fin, dt_time.max)
+        df_tramo, completo = _consultar_mongo_rango(t0, t1, None)
+        
+        # Solo se archiva si TODAS las fuentes respondieron (evita congelar días incompletos)
+        if completo:
+            archive.write_days(df_tramo, [d for d in faltantes if tramo_ini <= d <= tramo_fin])
+        
+        if not df_tramo.empty:
+            df_tramo = df_tramo[(df_tramo['timestamp'] >= start_date) & (df_tramo['timestamp'] <= end_date)]
+            if devices: df_tramo = df_tramo[df_tramo['device_id'].isin(devices)]
+            partes.append(df_tramo)
+    
+    # 2. Días cerrados ya archivados: lectura local
+    if archivados:
+        partes.append(archive.read_range(start_date, end_date, devices, days=archivados))
+    
+    # 3. Día abierto: MongoDB
+    if abiertos:
+        t0 = max(start_date, datetime.combine(abiertos[0], dt_time.min))
+        partes.append(_consultar_mongo_rango(t0, end_date, devices)[0])
+    
+    partes = [p for p in partes if p is not None and not p.empty]
+    if not partes: return pd.DataFrame()
+    
+    df = pd.concat(partes, ignore_index=True)
+    if 'timestamp' in df.columns:
+        df = df.sort_values('timestamp', ascending=False)
+    
+    elapsed = time.time() - start_time_total
+    print(f"[history.py] Rango {start_date.date()} - {end_date.date()}: {len(archivados)} días desde archivo, "
+          f"{len(faltantes)} archivados ahora, {len(abiertos)} abiertos desde Mongo -> {len(df)} registros en {elapsed:.2f}s")
+    return df
+
+
+def _consultar_mongo_rango(start_date: datetime, end_date: datetime, devices: Optional[List[str]] = None) -> tuple:
     """
     Carga datos corrigiendo desfases de zona horaria (UTC vs Local).
     Estrategia: Busca 2 días extra alrededor del rango para capturar datos UTC y luego normaliza a Local.
+    Retorna (DataFrame, completo) donde completo indica que todas las fuentes respondieron sin error.
     """
     start_time_total = time.time()
     
@@ -40,19 +113,16 @@ def cargar_datos_rango(start_date: datetime, end_date: datetime, devices: Option
 
     try:
         db = DatabaseConnection()
-        if not db.sources: return pd.DataFrame()
+        if not db.sources: return pd.DataFrame(), False
 
         mongo_start_iso = mongo_start_date.isoformat()
         mongo_end_iso = mongo_end_date.isoformat()
         
-        all_norm_docs = []
+        partes = []
 
         def load_source(source):
             source_name = source.get('name', 'Unknown')
             try:
-                database = source["client"][source["db"]]
-                collection = database[source["coll_telemetry"]]
-                
                 # Base Query de tiempo EXTENDIDA AMBOS LADOS (+/- 2 DIAS)
                 time_query = {
                     "$or": [
@@ -61,82 +131,44 @@ def cargar_datos_rango(start_date: datetime, end_date: datetime, devices: Option
                     ]
                 }
                 
-                projection = {
-                    '_id': 1, 'timestamp': 1, 'device_id': 1, 'dispositivo_id': 1,
-                    'sensors': 1, 'datos': 1, 'location': 1, 'metadata': 1
-                }
-                
-                cursor = collection.find(time_query, projection)
-                raw_docs = list(cursor)
+                # Proyección mínima del adapter, sin sort (se ordena en memoria)
+                raw_docs = list(db._telemetry_cursor(source, time_query, sort=False))
                 
                 print(f"[history.py] Fuente '{source_name}': {len(raw_docs)} docs cargados de MongoDB")
                 
-                valid_docs = []
-                rejected_device = 0
-                rejected_timestamp = 0
-                rejected_range = 0
+                # Normalización por lotes (timestamps ya en hora local de Chile, naive)
+                df = db._normalize_batch(raw_docs)
+                if df.empty: return df
+                
+                # Check 1: Timestamp y device_id válidos
+                invalid_ts = df['timestamp'].isna() | (df['device_id'] == "unknown")
+                
+                # Check 2: Filtro de dispositivos (EN MEMORIA)
+                wrong_device = ~invalid_ts & ~df['device_id'].isin(devices) if devices else pd.Series(False, index=df.index)
                 
-                for doc in raw_docs:
-                    norm = db._normalize_document(doc)
-                    
-                    # Check 1: Timestamp y device_id válidos
-                    if not norm.get("timestamp") or norm.get("device_id") == "unknown":
-                        rejected_timestamp += 1
-                        continue
-                        
-                    # Check 2: Filtro de dispositivos (EN MEMORIA)
-                    if devices and norm.get("device_id") not in devices:
-                        rejected_device += 1
-                        continue
-
-                    ts = norm["timestamp"]
-                    
-                    # Convertir a datetime si es string
-                    if isinstance(ts, str):
-                        ts = pd.to_datetime(ts, errors='coerce')
-                        if pd.isna(ts):
-                            rejected_timestamp += 1
-                            continue
-                    
-                    # CONVERSIÓN EXPLÍCITA A UTC-3 (CHILE)
-                    target_offset = timedelta(hours=-3)
-                    
-                    if isinstance(ts, datetime):
-                        if ts.tzinfo is not None:
-                            # Timestamp con zona horaria: convertir a local
-                            ts_utc = ts.astimezone(timezone.utc)
-                            ts_local = ts_utc + target_offset
-                            ts = ts_local.replace(tzinfo=None)
-                        else:
-                            # Naive: Asumimos ya está en hora local
-                            pass
-                    
-                    norm["timestamp"] = ts
-                    
-                    # Check 3: Filtro FINAL EXACTO
-                    if start_date <= ts <= end_date:
-                        valid_docs.append(norm)
-                    else:
-                        rejected_range += 1
-
-                print(f"[history.py] Fuente '{source_name}': {len(valid_docs)} docs válidos")
-                print(f"[history.py] Fuente '{source_name}': Rechazados -> device_filter={rejected_device}, timestamp_invalid={rejected_timestamp}, out_of_range={rejected_range}")
+                # Check 3: Filtro FINAL EXACTO
+                in_range = (df['timestamp'] >= start_date) & (df['timestamp'] <= end_date)
+                out_of_range = ~invalid_ts & ~wrong_device & ~in_range
                 
-                return valid_docs
+                valid_df = df[~invalid_ts & ~wrong_device & in_range]
+
+                print(f"[history.py] Fuente '{source_name}': {len(valid_df)} docs válidos")
+                print(f"[history.py] Fuente '{source_name}': Rechazados -> device_filter={int(wrong_device.sum())}, timestamp_invalid={int(invalid_ts.sum())}, out_of_range={int(out_of_range.sum())}")
+                
+                return valid_df
             except Exception as e:
                 print(f"[history.py] ERROR en {source_name}: {e}")
-                return []
+                raise
 
-        # Ejecución Paralela
-        with ThreadPoolExecutor(max_workers=len(db.sources)) as executor:
-            futures = [executor.submit(load_source, s) for s in db.sources]
-            for f in as_completed(futures):
-                all_norm_docs.extend(f.result())
+        # Ejecución Paralela (pool compartido de la capa de datos, sin deadline para rangos largos)
+        for _, source_df in db.fan_out(load_source, timeout=None):
+            if not source_df.empty: partes.append(source_df)
+        completo = all(st_.get("status") == "ok" for st_ in db.last_source_status.values())
 
-        if not all_norm_docs: return pd.DataFrame()
+        if not partes: return pd.DataFrame(), completo
 
-        # Convertir a DataFrame
-        df = db._parse_historical_flat(all_norm_docs)
+        # Unir fuentes (ya en formato flat)
+        df = pd.concat(partes, ignore_index=True)
         
         # Limpieza columnas
         try:
@@ -155,12 +187,29 @@ def cargar_datos_rango(start_date: datetime, end_date: datetime, devices: Option
             
         elapsed = time.time() - start_time_total
         print(f"[history.py] Total Global DataFrame: {len(df)} registros en {elapsed:.2f}s")
-        return df
+        return df, completo
 
     except Exception as e:
         print(f"[history.py] Error crítico: {e}")
         st.error(f"Error cargando datos: {e}")
-        return pd.DataFrame()
+        return pd.DataFrame(), False
+
+def resumen_fuera_de_rango(df: pd.DataFrame, engine: ThresholdEngine) -> tuple:
+    """
+    Evalúa TODO el rango cargado contra los umbrales compilados (una clasificación vectorizada).
+    Retorna (tabla por dispositivo y sensor con lecturas Warning / Crítico, {device_id: [sensores fuera de rango]}).
+    """
+    readings = ThresholdEngine.readings_from_wide(df, id_columns=("timestamp", "device_id"))
+    classified = engine.classify(readings)
+    classified = classified[classified["configured"]]
+    if classified.empty:
+        return pd.DataFrame(), {}
+
+    tabla = pd.crosstab([classified["device_id"], classified["sensor"]], classified["state"])
+    tabla = tabla.reindex(columns=[ThresholdEngine.STATE_OK, ThresholdEngine.STATE_WARNING, ThresholdEngine.STATE_CRITICAL], fill_value=0)
+    tabla.columns = ["OK", "Warning", "Crítico"]
+    tabla = tabla[(tabla["Warning"] + tabla["Crítico"]) > 0].reset_index()
+    return tabla, ThresholdEngine.breached_sensors(classified)
 
 def convert_df_to_csv(df):
     return df.to_csv(index=False).encode('utf-8')
@@ -346,6 +395,17 @@ def show_view():
         except Exception as e:
             st.error(f"Error métricas: {e}")
 
+        # --- FUERA DE RANGO (umbrales compilados sobre todo el rango) ---
+        try:
+            tabla, fuera = resumen_fuera_de_rango(df, config_manager.get_threshold_plan().engine)
+            if fuera:
+                detalle = " | ".join(f"{alias_map.get(d, d)}: {', '.join(sensores)}" for d, sensores in fuera.items())
+                with st.expander(f"Lecturas fuera de rango ({len(fuera)} dispositivos) — {detalle}", expanded=False):
+                    tabla.insert(1, "alias", tabla["device_id"].map(lambda x: alias_map.get(x, x)))
+                    st.dataframe(tabla, hide_index=True, use_container_width=True)
+        except Exception as e:
+            st.error(f"Error evaluando umbrales: {e}")
+
     # --- 3. SECCIÓN DE DESCARGA ---
     st.markdown("---")
     res_txt = f"Registros seleccionados: {len(df)}"
@@ -180,9 +180,9 @@ def show_view():
                     target_param = st.selectbox("2. Parámetro", valid_params, format_func=format_param_name)
                     
                     # Cargar Conf
-                    base_conf = config_manager.get_all_configured_sensors().get(target_param, {})
-                    dev_specifics = config_manager.get_device_thresholds(target_dev)
-                    current_conf = dev_specifics.get(target_param, base_conf)
+                    # Misma config efectiva que usa el DeviceManager (plan compilado)
+                    plan = config_manager.get_threshold_plan()
+                    current_conf = dict(plan.for_device(target_dev, target_param))
                     
                     # Get Values
                     d_cmin = float(current_conf.get("critical_min", 0.0))